@@ -86,6 +86,13 @@ def main():
     source_settings = config['source']
     source = Source(source_settings, args.hostname, args.port)
     
+    # Set up the repository backend (if defined)
+    if config.has_key('repository'):
+        klass_name = config['repository']['class']
+        mod = __import__('resync.repository', fromlist=[klass_name])
+        repository_klass = getattr(mod, klass_name)
+        source.add_repository(repository_klass(config['repository']))
+    
     # Set up and register the source inventory (if defined)
     if config.has_key('inventory_builder'):
         klass_name = config['inventory_builder']['class']
@@ -134,6 +141,9 @@ def main():
         print "\nStopping simulation and exiting gracefully..."
     finally:
         http_interface.stop()
+        if source.has_changememory:
+            source.changememory.close()
+        source.repository.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,6 +1,6 @@
 import time
-import urllib
 import datetime
+from connection import urlopen
 
 class Common(object):
     """containing common used functions"""
@@ -30,7 +30,7 @@ class Common(object):
     def get_size(basename):
         """download header of basename and returns size in Bytes"""
         try:
-            url_metadata=urllib.urlopen(basename).info()
+            url_metadata=urlopen(basename,method='HEAD').info()
             if len(url_metadata.getheaders("Content-Length"))>0:
                 return url_metadata.getheaders("Content-Length")[0]
         except Exception, e:
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+connection.py: A pool of persistent (keep-alive) HTTP connections shared by
+all requests to OAI-PMH endpoints and resource hosts
+
+urllib2 opens a new TCP (and TLS) connection for each request. The pool keeps
+idle HTTP/1.1 connections per host and hands them out again, so subsequent
+requests to the same host skip the connection setup. Requests go through the
+proxies of the *_proxy environment variables (except for no_proxy hosts),
+like those of urllib2.
+"""
+
+import base64
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import StringIO
+
+USER_AGENT="ResourceSync OAI-PMH Adapter"
+REDIRECT_CODES=(301,302,303,307)
+
+class ConnectionPool(object):
+    """Opens up to maxsize connections per host (or proxy), idle or in use;
+    a request waits up to timeout seconds for one of them to become idle.
+    Connections which have been idle for more than idle_timeout seconds are
+    discarded."""
+
+    def __init__(self,maxsize=4,idle_timeout=30,timeout=60):
+        self.maxsize=maxsize
+        self.idle_timeout=idle_timeout
+        self.timeout=timeout
+        self._idle={} # {(scheme,host,port,proxy): [(connection,last_used)]}
+        self._open={} # {(scheme,host,port,proxy): number of connections}
+        self._lock=threading.Lock()
+        self._released=threading.Condition(self._lock)
+
+    def urlopen(self,url,method='GET',redirects=5):
+        """request url and return a file-like PooledResponse
+        raises urllib2.HTTPError for error status codes and urllib2.URLError
+        if the host cannot be reached, just like urllib2.urlopen"""
+        parts=urlparse.urlsplit(url)
+        if parts.scheme not in ('http','https'):
+            return urllib2.urlopen(url)
+        key,path,headers=self.route(parts)
+        conn=self.get(key)
+        reused=conn is not None
+        while True:
+            if conn is None:
+                conn=self.connect(key)
+            try:
+                conn.request(method,path,headers=headers)
+                response=conn.getresponse()
+                break
+            except (httplib.HTTPException,socket.error), e:
+                conn.close()
+                if reused: # stale socket, closed by the server; reconnect
+                    conn=None
+                    reused=False
+                    continue
+                self.discard(key,None)
+                raise urllib2.URLError(e)
+        if response.status in REDIRECT_CODES and redirects>0:
+            location=response.getheader('location')
+            response.read()
+            self.release(key,conn,response)
+            return self.urlopen(urlparse.urljoin(url,location),method,redirects-1)
+        if response.status>=400:
+            body=response.read()
+            self.release(key,conn,response)
+            raise urllib2.HTTPError(url,response.status,response.reason,
+                                    response.msg,StringIO.StringIO(body))
+        return PooledResponse(self,key,conn,response,url,method)
+
+    def route(self,parts):
+        """returns the connection key (scheme,host,port,proxy), the request
+        path and the headers of a request to the split url parts; plain http
+        requests to all hosts share the connections to their proxy, https
+        requests are tunneled through it"""
+        headers={'User-Agent': USER_AGENT}
+        path=parts.path or '/'
+        if parts.query:
+            path+='?'+parts.query
+        proxy=urllib.getproxies().get(parts.scheme)
+        if not proxy or urllib.proxy_bypass(parts.hostname):
+            return ((parts.scheme,parts.hostname,parts.port,None),path,headers)
+        if '://' not in proxy:
+            proxy='http://'+proxy
+        proxy_parts=urlparse.urlsplit(proxy)
+        authorization=None
+        if proxy_parts.username is not None:
+            authorization='Basic '+base64.b64encode('%s:%s' % (
+                    urllib.unquote(proxy_parts.username),
+                    urllib.unquote(proxy_parts.password or '')))
+        proxy=(proxy_parts.hostname,proxy_parts.port or 80,authorization)
+        if parts.scheme=='https':
+            return ((parts.scheme,parts.hostname,parts.port,proxy),path,headers)
+        if authorization is not None:
+            headers['Proxy-Authorization']=authorization
+        return ((parts.scheme,None,None,proxy),
+                urlparse.urlunsplit(parts[:4]+('',)),headers)
+
+    def connect(self,key):
+        """open a new connection to (scheme,host,port,proxy)"""
+        scheme,host,port,proxy=key
+        if proxy is None:
+            if scheme=='https':
+                return httplib.HTTPSConnection(host,port,timeout=self.timeout)
+            return httplib.HTTPConnection(host,port,timeout=self.timeout)
+        if scheme=='https':
+            conn=httplib.HTTPSConnection(proxy[0],proxy[1],timeout=self.timeout)
+            headers={}
+            if proxy[2] is not None:
+                headers['Proxy-Authorization']=proxy[2]
+            conn.set_tunnel(host,port,headers)
+            return conn
+        return httplib.HTTPConnection(proxy[0],proxy[1],timeout=self.timeout)
+
+    def get(self,key):
+        """return an idle connection to key, or None if a new one may be
+        opened; waits while maxsize connections to key are in use and raises
+        urllib2.URLError if none is released within timeout seconds"""
+        deadline=time.time()+self.timeout
+        with self._lock:
+            while True:
+                idle=self._idle.get(key,[])
+                while len(idle)>0:
+                    conn,last_used=idle.pop()
+                    if time.time()-last_used<=self.idle_timeout:
+                        return conn
+                    conn.close()
+                    self._open[key]-=1
+                if self._open.get(key,0)<self.maxsize:
+                    self._open[key]=self._open.get(key,0)+1
+                    return None
+                remaining=deadline-time.time()
+                if remaining<=0:
+                    raise urllib2.URLError("no free connection to %s" % 
+                                           (key[1] or key[3][0]))
+                self._released.wait(remaining)
+
+    def release(self,key,conn,response):
+        """return a connection whose response has been read completely"""
+        if response.will_close:
+            self.discard(key,conn)
+            return
+        with self._lock:
+            self._idle.setdefault(key,[]).append((conn,time.time()))
+            self._released.notify()
+
+    def discard(self,key,conn):
+        """close a connection which is not returned to the pool (None if it
+        is closed already), so that another one may be opened"""
+        if conn is not None:
+            conn.close()
+        with self._lock:
+            self._open[key]-=1
+            self._released.notify()
+
+    def idle_count(self,key=None):
+        """number of idle connections (to key or in total)"""
+        with self._lock:
+            if key is not None:
+                return len(self._idle.get(key,[]))
+            return sum([len(idle) for idle in self._idle.values()])
+
+    def clear(self):
+        """close all idle connections"""
+        with self._lock:
+            for key,idle in self._idle.items():
+                for conn,last_used in idle:
+                    conn.close()
+                self._open[key]-=len(idle)
+            self._idle={}
+
+
+class PooledResponse(object):
+    """File-like response which returns its connection to the pool as soon
+    as the body has been read"""
+
+    def __init__(self,pool,key,conn,response,url,method='GET'):
+        self._pool=pool
+        self._key=key
+        self._conn=conn
+        self._response=response
+        self._url=url
+        if method=='HEAD': # no body, the connection can be released
+            response.read()
+        self._release()
+
+    def read(self,amt=None):
+        data=self._response.read(amt)
+        self._release()
+        return data
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self._response.status
+
+    def geturl(self):
+        return self._url
+
+    def close(self):
+        """release the connection; discard it if the body was not read"""
+        if self._conn is not None and not self._response.isclosed():
+            self._pool.discard(self._key,self._conn)
+            self._conn=None
+        self._release()
+
+    def __del__(self):
+        self.close()
+
+    def _release(self):
+        if self._conn is not None and self._response.isclosed():
+            self._pool.release(self._key,self._conn,self._response)
+            self._conn=None
+
+
+pool=ConnectionPool()
+
+def configure(maxsize=4,idle_timeout=30):
+    """set the limits of the shared pool"""
+    pool.maxsize=maxsize
+    pool.idle_timeout=idle_timeout
+
+def urlopen(url,method='GET'):
+    """request url through the shared pool"""
+    return pool.urlopen(url,method)
@@ -6,16 +6,21 @@ pyoai.py: The class handling OAI-PMH data access and resource information extrac
 Created by Peter Kalchgruber on 2012-09-01.
 """
 
-from urllib2 import urlopen, HTTPError, URLError
+from urllib2 import HTTPError, URLError
 from urllib import urlencode
-from xml.etree.ElementTree import  parse, ParseError, tostring
+from xml.etree.ElementTree import  parse, iterparse, ParseError, tostring
 from time import sleep
 import re
 import urlparse
 import datetime
 import time
+import sys
+import threading
+import Queue
 from dateutil import parser as dateutil_parser
 from common import Common
+from connection import urlopen
+from urlcheck import UrlChecker
 
 OAI_NS="http://www.openarchives.org/OAI/2.0/"
 DC_NS="http://purl.org/dc/elements/1.1/"
@@ -23,13 +28,18 @@ DC_NS="http://purl.org/dc/elements/1.1/"
 class Client(object):
     """OAI-PMH Client manages communication with an OAI-PMH endpoint"""
     
-    def __init__(self,endpoint,limit,checkurl):
+    def __init__(self,endpoint,limit,checkurl,streaming=False,prefetch=0,urlchecker=None):
         self.endpoint=endpoint
         self.granularity=None
         m = urlparse.urlparse(endpoint)
         self.baseurl=m.netloc
         self.limit=limit
         self.checkurl=checkurl
+        self.streaming=streaming # parse ListRecords responses incrementally
+        self.prefetch=prefetch # number of pages requested ahead of processing
+        if checkurl and urlchecker is None:
+            urlchecker=UrlChecker()
+        self.urlchecker=urlchecker # checks and caches availability of resources
         
     def get_date(self, datestring):
         """return datestamp of datetime.datetime object"""
@@ -75,48 +85,39 @@ class Client(object):
         except ParseError, e:
             print "ParseError %s" % e
     
-    def listRecords(self,afrom=None,delay=0):
+    def listRecords(self,afrom=None,delay=0,until=None,setspec=None,rtoken=None,checkpoint=None):
         """generator who list Records with informations about resources
-        afrom can be datetime.datetime object or datestamp in format YYYY-MM-DDTHH:MM:SSZ
+        afrom (and until) can be datetime.datetime object or datestamp in format YYYY-MM-DDTHH:MM:SSZ
+        setspec restricts the records to a set of the endpoint
+        rtoken continues a list at the given resumptionToken
+        checkpoint(page) is called as soon as all Records of a page are consumed,
+        page holds the responseDate and the next resumptionToken (if any)
+        if prefetch is set, the following pages are requested in a background
+        thread while the records of the current page are consumed
         """
-        if afrom:
-            if type(afrom)==datetime.datetime:  #if not datestamp convert to datestamp
-                if self.granularity is None:
-                    self.setGranularity()
-                afrom=self.get_date(afrom)
-                
-            params = urlencode({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', "from": afrom})
+        if self.prefetch>0:
+            return self.prefetchRecords(afrom,delay,until,setspec,rtoken,checkpoint)
+        return self.harvestRecords(afrom,delay,until,setspec,rtoken,checkpoint)
+    
+    def harvestRecords(self,afrom=None,delay=0,until=None,setspec=None,rtoken=None,checkpoint=None):
+        """generator who requests one ListRecords page after the other
+        and yields its Records"""
+        if rtoken:
+            params=self.resumeParams(rtoken)
         else:
-            params = urlencode({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'})
-            
+            params=self.listRecordsParams(afrom,until,setspec)
         while True:
                 try:
                     fh=urlopen(self.endpoint+"?"+params)
-                    etree=parse(fh)
-                    if (etree.getroot().tag == '{'+OAI_NS+"}OAI-PMH"): #check if it is an oai-pmh xml doc
-                        rdate=dateutil_parser.parse(etree.find('{'+OAI_NS+"}responseDate").text)
-                        for error in etree.findall('{'+OAI_NS+"}error"):
-                            raise NoRecordsException, (error.attrib['code'],error.text)
-                        listRecords=etree.find('{'+OAI_NS+"}ListRecords")
-                        for xmlrecords in listRecords.findall('{'+OAI_NS+"}record"):
-							header_node=xmlrecords.find('{'+OAI_NS+"}header")
-							header=self.buildHeader(header_node)
-							metadata_node=xmlrecords.find('{'+OAI_NS+"}metadata")
-							if metadata_node is not None:
-								resources=self.getDataIdentifiers(metadata_node[0])
-								for resource in resources: # for each found resource in data record
-									yield Record(header,resource,rdate)
-							else: #e.g. in case of deletion
-								yield Record(header,None,rdate)
-                        if listRecords.find('{'+OAI_NS+"}resumptionToken") is not None:
-                            rtoken=listRecords.find('{'+OAI_NS+"}resumptionToken").text
-                            if rtoken is not None:
-                                params = re.sub("&from=.*","",params)    #delete useless parameters
-                                params = re.sub("&resumptionToken=.*","",params)    #delete previous resumptionToken
-                                params += '&resumptionToken='+rtoken #add new resumptionToken
-                        else:
-                            break
-                        time.sleep(delay)
+                    page={}
+                    for record in self.readPage(fh,page):
+                        yield record
+                    if checkpoint is not None:
+                        checkpoint(page)
+                    if page.get('resumptionToken') is None:
+                        break
+                    params=self.resumeParams(page['resumptionToken'])
+                    time.sleep(delay)
                 except HTTPError, e:
                     if e.code == 503:
                         try:
@@ -142,6 +143,186 @@ class Client(object):
                 
                 except URLError, e:
                     raise URLError("While opening URL: %s with parameters %s an error turned up %s" % (self.endpoint, params, e))
+    
+    def prefetchRecords(self,afrom=None,delay=0,until=None,setspec=None,rtoken=None,checkpoint=None):
+        """generator who yields the Records read ahead by a
+        RecordPrefetcher; at most prefetch pages are read ahead of the
+        page whose Records are consumed, whatever their length"""
+        def harvest(checkpoint):
+            return self.harvestRecords(afrom,delay,until,setspec,rtoken,checkpoint)
+        prefetcher=RecordPrefetcher(harvest,self.prefetch)
+        prefetcher.start()
+        try:
+            while True:
+                kind,item=prefetcher.records.get()
+                if kind=='error':
+                    raise item[0], item[1], item[2]
+                if kind=='end':
+                    break
+                if kind=='page':
+                    prefetcher.consumed()
+                    if checkpoint is not None:
+                        checkpoint(item)
+                else:
+                    yield item
+        finally:
+            prefetcher.stop()
+    
+    def listRecordsParams(self,afrom=None,until=None,setspec=None):
+        """returns the url encoded parameters of the first ListRecords request"""
+        params={'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+        if afrom:
+            params['from']=self.datestamp(afrom)
+        if until:
+            params['until']=self.datestamp(until)
+        if setspec:
+            params['set']=setspec
+        return urlencode(params)
+    
+    def resumeParams(self,rtoken):
+        """returns the parameters of the request following a resumptionToken,
+        the resumptionToken is an exclusive argument"""
+        return urlencode({'verb': 'ListRecords', 'resumptionToken': rtoken})
+    
+    def datestamp(self,date):
+        """returns date as datestamp in the granularity of the endpoint,
+        date can be datetime.datetime object or datestamp"""
+        if type(date)==datetime.datetime:  #if not datestamp convert to datestamp
+            if self.granularity is None:
+                self.setGranularity()
+            date=self.get_date(date)
+        return date
+    
+    def dateWindows(self,afrom,until,number):
+        """splits afrom..until (datetime.datetime objects) into at most number
+        consecutive, non-overlapping from/until windows whose bounds are
+        aligned to the granularity of the endpoint; the until of the last
+        window is None, so the last window reaches up to the harvest time"""
+        if self.granularity is None:
+            self.setGranularity()
+        if self.granularity=="date":
+            unit=datetime.timedelta(days=1)
+            afrom=datetime.datetime(afrom.year,afrom.month,afrom.day)
+        else:
+            unit=datetime.timedelta(seconds=1)
+            afrom=afrom.replace(microsecond=0)
+        units=int((until-afrom).total_seconds()/unit.total_seconds())+1
+        size=max(1,-(-units//max(1,number))) # units per window, rounded up
+        windows=[]
+        start=afrom
+        while start<=until:
+            end=start+size*unit
+            windows.append((start,end-unit))
+            start=end
+        if len(windows)==0:
+            return [(afrom,None)]
+        windows[-1]=(windows[-1][0],None)
+        return windows
+    
+    def listSets(self):
+        """generator who lists the setSpecs of the endpoint"""
+        params=urlencode({'verb': 'ListSets'})
+        while True:
+            try:
+                fh=urlopen(self.endpoint+"?"+params)
+                etree=parse(fh)
+            except URLError, e:
+                raise URLError("While opening URL: %s with parameters %s an error turned up %s" % (self.endpoint, params, e))
+            if (etree.getroot().tag != '{'+OAI_NS+"}OAI-PMH"): #check if it is an oai-pmh xml doc
+                break
+            for error in etree.findall('{'+OAI_NS+"}error"):
+                raise NoRecordsException, (error.attrib['code'],error.text)
+            listSets=etree.find('{'+OAI_NS+"}ListSets")
+            for set_node in listSets.findall('{'+OAI_NS+"}set"):
+                yield set_node.findtext('{'+OAI_NS+"}setSpec")
+            rtoken=listSets.findtext('{'+OAI_NS+"}resumptionToken")
+            if not rtoken:
+                break
+            params=urlencode({'verb': 'ListSets', 'resumptionToken': rtoken})
+    
+    def topLevelSets(self):
+        """returns the setSpecs of the endpoint without the sets which are
+        contained in another listed set (e.g. a:b is part of set a)"""
+        setspecs=set(self.listSets())
+        toplevel=[]
+        for setspec in sorted(setspecs):
+            parts=setspec.split(':')
+            if not any(':'.join(parts[:i]) in setspecs for i in range(1,len(parts))):
+                toplevel.append(setspec)
+        return toplevel
+    
+    def readPage(self,fh,page):
+        """generator who yields the Records of a ListRecords response
+        the resumptionToken of the response (if any) is stored in page
+        if checkurl is set, the candidate resource urls of the records of the
+        page are checked before the first Record is yielded (see checkCandidates)"""
+        if self.streaming:
+            entries=self.iterparsePage(fh,page)
+        else:
+            entries=self.parsePage(fh,page)
+        if self.checkurl:
+            entries=list(entries)
+            self.checkCandidates([urls for header,urls,rdate in entries])
+        for header,urls,rdate in entries:
+            if urls is None: #e.g. in case of deletion
+                yield Record(header,None,rdate)
+            else:
+                for resource in self.selectResources(urls): # for each found resource in data record
+                    yield Record(header,resource,rdate)
+    
+    def parsePage(self,fh,page):
+        """parse the complete response into a tree and yield the
+        (header, candidate urls, response date) of its records"""
+        etree=parse(fh)
+        if (etree.getroot().tag == '{'+OAI_NS+"}OAI-PMH"): #check if it is an oai-pmh xml doc
+            rdate=dateutil_parser.parse(etree.find('{'+OAI_NS+"}responseDate").text)
+            page['responseDate']=rdate
+            for error in etree.findall('{'+OAI_NS+"}error"):
+                raise NoRecordsException, (error.attrib['code'],error.text)
+            listRecords=etree.find('{'+OAI_NS+"}ListRecords")
+            for record_node in listRecords.findall('{'+OAI_NS+"}record"):
+                yield self.buildEntry(record_node,rdate)
+            rtoken=listRecords.findtext('{'+OAI_NS+"}resumptionToken")
+            if rtoken:
+                page['resumptionToken']=rtoken
+    
+    def iterparsePage(self,fh,page):
+        """parse the response incrementally and yield the (header, candidate
+        urls, response date) of each record element as soon as it is closed;
+        finished record elements are discarded, so memory does not grow with
+        the size of the page"""
+        context=iterparse(fh,events=('start','end'))
+        event,root=next(context)
+        if root.tag != '{'+OAI_NS+"}OAI-PMH": #check if it is an oai-pmh xml doc
+            return
+        rdate=None
+        listRecords=None
+        for event,node in context:
+            if event=='start':
+                if node.tag=='{'+OAI_NS+"}ListRecords":
+                    listRecords=node
+            elif node.tag=='{'+OAI_NS+"}record" and listRecords is not None:
+                yield self.buildEntry(node,rdate)
+                listRecords.clear()
+            elif node.tag=='{'+OAI_NS+"}responseDate":
+                rdate=dateutil_parser.parse(node.text)
+                page['responseDate']=rdate
+            elif node.tag=='{'+OAI_NS+"}error":
+                raise NoRecordsException, (node.attrib['code'],node.text)
+            elif node.tag=='{'+OAI_NS+"}resumptionToken":
+                if node.text:
+                    page['resumptionToken']=node.text
+        if listRecords is None:
+            raise AttributeError("no ListRecords element in response")
+    
+    def buildEntry(self,record_node,rdate):
+        """returns header, candidate resource urls (None if the record has no
+        metadata) and response date of record_node"""
+        header=self.buildHeader(record_node.find('{'+OAI_NS+"}header"))
+        metadata_node=record_node.find('{'+OAI_NS+"}metadata")
+        if metadata_node is not None:
+            return (header,self.candidateIdentifiers(metadata_node[0]),rdate)
+        return (header,None,rdate)
                 
     def buildHeader(self,header_node):
         """extract header information of header_node into Header object"""
@@ -164,30 +345,101 @@ class Client(object):
     
     def getDataIdentifiers(self,metadata_node):
         """extract resource information of metadata_node"""
+        return self.selectResources(self.candidateIdentifiers(metadata_node))
+    
+    def candidateIdentifiers(self,metadata_node):
+        """extract the identifiers of metadata_node which look like resource urls"""
         identifiers=[]
         for children in metadata_node.findall('{'+DC_NS+'}identifier'):
             identifiers.append(children.text)
         for children in metadata_node.findall('{'+DC_NS+'}relation'):
             identifiers.append(children.text)
-        resources={}
+        starturl="(https?|ftp|file)://"
+        if self.limit:
+            starturl+=(self.baseurl+"[-A-Za-z0-9+&@#/%?=~_|!:,.;]*[-A-Za-z0-9+&@#/%=~_|]")
+        return [identifier for identifier in identifiers 
+                    if re.match(starturl,identifier) is not None]
+    
+    def checkCandidates(self,candidates):
+        """checks the lists of candidate urls of several records in rounds:
+        the urls at the same position of all lists at once, and the next url
+        of a list only if none before it is available, so selectResources
+        finds the results of its checks in the cache of the urlchecker"""
+        position=0
+        pending=[urls for urls in candidates if urls]
+        while pending:
+            alive=self.urlchecker.check([urls[position] for urls in pending])
+            pending=[urls for urls in pending 
+                        if not alive[urls[position]] and len(urls)>position+1]
+            position+=1
+    
+    def selectResources(self,identifiers):
+        """returns the first candidate identifier which is (if checkurl is set)
+        publicly available as resource"""
         for identifier in identifiers:
-            starturl="(https?|ftp|file)://"
-            if self.limit:
-                starturl+=(self.baseurl+"[-A-Za-z0-9+&@#/%?=~_|!:,.;]*[-A-Za-z0-9+&@#/%=~_|]")
-            if re.match(starturl,identifier) is not None:
-                try:
-                    if self.checkurl:
-                        urlh=urlopen(identifier)
-                    if not self.checkurl or urlh.getcode()==200:
-                        resource=re.sub("/$","",identifier) # delete final /
-                        return {resource: resource} #should be extended #debug
-                except HTTPError, e:
-                    #print "non public %s %s" % (identifier, e.getcode())
-                    pass
+            if not self.checkurl or self.urlchecker.alive(identifier):
+                resource=re.sub("/$","",identifier) # delete final /
+                return {resource: resource} #should be extended #debug
         return {}
                 
                 
         
+class RecordPrefetcher(threading.Thread):
+    """Background thread which consumes the Records of harvest(checkpoint)
+    and hands them over to the harvesting thread through a queue, followed
+    by the page after the Records of each page. The harvest keeps its delay
+    between requests; the next page is only requested while at most pages
+    page markers wait in the queue, so the pages in flight are bounded
+    however many Records they hold."""
+    
+    def __init__(self,harvest,pages):
+        super(RecordPrefetcher, self).__init__()
+        self.daemon=True
+        self.records=Queue.Queue()
+        self.pages=pages # pages read ahead of the consumer
+        self.waiting=0 # page markers in the queue
+        self._harvest=harvest
+        self._stop=threading.Event()
+        self._consumed=threading.Condition()
+    
+    def run(self):
+        try:
+            for record in self._harvest(self.page):
+                if not self.put(('record',record)):
+                    return
+            self.put(('end',None))
+        except Exception:
+            self.put(('error',sys.exc_info()))
+    
+    def page(self,page):
+        """put the marker of a read page into the queue and wait until the
+        consumer is close enough to request the next one"""
+        if not self.put(('page',page)):
+            return
+        with self._consumed:
+            self.waiting+=1
+            while self.waiting>self.pages and not self._stop.isSet():
+                self._consumed.wait(1)
+    
+    def consumed(self):
+        """called by the consumer for each page marker taken from the queue"""
+        with self._consumed:
+            self.waiting-=1
+            self._consumed.notify()
+    
+    def put(self,item):
+        """put item into queue, returns False if the prefetcher was stopped"""
+        if self._stop.isSet():
+            return False
+        self.records.put(item)
+        return True
+    
+    def stop(self):
+        """stop fetching pages, e.g. when the consumer quits early"""
+        self._stop.set()
+        with self._consumed:
+            self._consumed.notify()
+        
 class Record(object):
     """record about resource"""
     
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+urlcheck.py: Concurrent, cached availability checks of resource URLs
+
+Resource URLs found in OAI-PMH records are checked with HEAD requests by a
+bounded number of threads. Results are kept in a cache with a time to live
+and least recently used eviction, so a resource is not checked again on
+every poll of the endpoint.
+"""
+
+import collections
+import threading
+import time
+import Queue
+from urllib2 import HTTPError
+
+from connection import urlopen
+
+class UrlChecker(object):
+    """Checks whether URLs respond with status 200, using up to workers
+    threads; results are cached for ttl seconds, at most maxsize of them"""
+
+    def __init__(self,workers=8,ttl=3600,maxsize=100000):
+        self.workers=workers
+        self.ttl=ttl
+        self.maxsize=maxsize
+        self._cache=collections.OrderedDict() # {url: (alive, checked)}
+        self._lock=threading.Lock()
+
+    def alive(self,url):
+        """returns True if url is available"""
+        return self.check([url])[url]
+
+    def check(self,urls):
+        """returns {url: alive} for urls; urls which are not in the cache
+        are checked in parallel"""
+        results={}
+        unchecked=Queue.Queue()
+        for url in urls:
+            if url in results:
+                continue
+            alive=self.cached(url)
+            results[url]=alive
+            if alive is None:
+                unchecked.put(url)
+        def work():
+            while True:
+                try:
+                    url=unchecked.get_nowait()
+                except Queue.Empty:
+                    return
+                results[url]=self.is_alive(url)
+                self.store(url,results[url])
+        threads=[threading.Thread(target=work)
+                        for n in range(min(self.workers,unchecked.qsize()))]
+        for thread in threads:
+            thread.daemon=True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def is_alive(self,url):
+        """request url with HEAD (GET if the server does not support HEAD)
+        and return True if it responds with status 200"""
+        try:
+            try:
+                urlh=urlopen(url,method='HEAD')
+            except HTTPError, e:
+                if e.code not in (405,501):
+                    return False
+                urlh=urlopen(url)
+            urlh.close()
+            return urlh.getcode()==200
+        except Exception:
+            return False
+
+    def cached(self,url):
+        """returns the cached result for url, None if unknown or expired"""
+        with self._lock:
+            entry=self._cache.pop(url,None)
+            if entry is None or time.time()-entry[1]>self.ttl:
+                return None
+            self._cache[url]=entry # most recently used
+            return entry[0]
+
+    def store(self,url,alive):
+        """caches the result for url, evicts the least recently used"""
+        with self._lock:
+            self._cache.pop(url,None)
+            self._cache[url]=(alive,time.time())
+            while len(self._cache)>self.maxsize:
+                self._cache.popitem(last=False)
+
+    def __len__(self):
+        """number of cached results"""
+        return len(self._cache)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+changelog.py: An append-only change log in segment files
+
+Each segment holds the changes of a consecutive range of changeids in two
+files: <first changeid>.rec with one fixed-size record per change and
+<first changeid>.uri with the URIs the records point to. The record of a
+changeid is found by its position in the segment, so reading the changes
+from an old changeid seeks directly to them. Records also hold the time
+the change was recorded, which never decreases, so the first change since
+a point in time is found by binary search over the records. A new segment is started
+after segment_size changes; the oldest segments are removed once they are
+older than retention_age seconds or the log exceeds retention_size bytes.
+"""
+
+import os
+import re
+import time
+import struct
+import bisect
+import threading
+import logging
+
+from resync.resource_change import ResourceChange
+
+# changeid, timestamp, recording time, changetype, offset and length of
+# the URI
+RECORD = struct.Struct("<QddBQI")
+
+CHANGETYPES = ["CREATED", "UPDATED", "DELETED"]
+
+class Segment(object):
+    """The files of the changes first..first+count-1"""
+
+    def __init__(self, directory, first):
+        self.first = first
+        self.path = os.path.join(directory, "%020d" % first)
+        self.count = 0
+        self.uri_size = 0
+
+    @property
+    def last(self):
+        return self.first + self.count - 1
+
+    @property
+    def size(self):
+        """Number of bytes of the segment files"""
+        return self.count * RECORD.size + self.uri_size
+
+    @property
+    def mtime(self):
+        """Time of the latest change in the segment"""
+        return os.path.getmtime(self.path + ".rec")
+
+    def recover(self):
+        """Determines the number of changes of an existing segment; a record
+        or URI which was only partially written is discarded"""
+        count = os.path.getsize(self.path + ".rec") // RECORD.size
+        uri_size = os.path.getsize(self.path + ".uri")
+        with open(self.path + ".rec", "rb") as rec:
+            while count > 0:
+                rec.seek((count - 1) * RECORD.size)
+                record = RECORD.unpack(rec.read(RECORD.size))
+                if record[4] + record[5] <= uri_size:
+                    break
+                count -= 1
+        self.count = count
+        if count > 0:
+            self.uri_size = record[4] + record[5]
+        for (name, size) in ((".rec", count * RECORD.size),
+                             (".uri", self.uri_size)):
+            if os.path.getsize(self.path + name) > size:
+                with open(self.path + name, "r+b") as f:
+                    f.truncate(size)
+
+    def remove(self):
+        for name in (".rec", ".uri"):
+            if os.path.exists(self.path + name):
+                os.remove(self.path + name)
+
+    def recorded(self, changeid):
+        """The recording time of a change in the segment"""
+        with open(self.path + ".rec", "rb") as rec:
+            rec.seek((changeid - self.first) * RECORD.size)
+            return RECORD.unpack(rec.read(RECORD.size))[2]
+
+    def read(self, changeid, last, chunk_size=1000):
+        """Yields the changes changeid..last (at most to the end of the
+        segment), reading chunk_size records at a time"""
+        last = min(last, self.last)
+        with open(self.path + ".rec", "rb") as rec:
+            with open(self.path + ".uri", "rb") as uri:
+                rec.seek((changeid - self.first) * RECORD.size)
+                while changeid <= last:
+                    n = min(chunk_size, last - changeid + 1)
+                    data = rec.read(n * RECORD.size)
+                    records = [RECORD.unpack_from(data, i * RECORD.size)
+                               for i in range(len(data) // RECORD.size)]
+                    if len(records) == 0:
+                        return
+                    uri.seek(records[0][4])
+                    uris = uri.read(records[-1][4] + records[-1][5] -
+                                    records[0][4])
+                    for (cid, timestamp, recorded, changetype, offset,
+                         length) in records:
+                        start = offset - records[0][4]
+                        yield ResourceChange(
+                            uri=uris[start:start + length].decode('utf-8'),
+                            timestamp=timestamp, changeid=cid,
+                            changetype=CHANGETYPES[changetype])
+                    changeid += len(records)
+
+class SegmentedChangeLog(object):
+    """A durable log of changes with consecutive changeids"""
+
+    def __init__(self, directory, segment_size=100000, retention_age=None,
+                 retention_size=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_age = retention_age
+        self.retention_size = retention_size
+        self.logger = logging.getLogger('changelog')
+        self.lock = threading.Lock()
+        self.segments = [] # sorted by first changeid
+        self.rec = None # files of the segment being written
+        self.uri = None
+        self.last_recorded = None # recording time of the latest change
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        p = re.compile('(\d+)\.rec$')
+        for f in sorted(os.listdir(directory)):
+            m = p.match(f)
+            if m:
+                segment = Segment(directory, int(m.group(1)))
+                segment.recover()
+                if segment.count > 0:
+                    self.segments.append(segment)
+                else:
+                    segment.remove()
+        if len(self.segments) > 0:
+            self.logger.info("Opened change log %s with changes %d to %d" %
+                             (directory, self.first, self.last))
+
+    @property
+    def first(self):
+        """The oldest changeid in the log, None if it is empty"""
+        if len(self.segments) == 0 or self.segments[-1].count == 0:
+            return None
+        return self.segments[0].first
+
+    @property
+    def last(self):
+        """The latest changeid in the log, None if it is empty"""
+        if len(self.segments) == 0 or self.segments[-1].count == 0:
+            return None
+        return self.segments[-1].last
+
+    def __len__(self):
+        if self.first is None:
+            return 0
+        return self.last - self.first + 1
+
+    def append(self, changes, recorded=None):
+        """Appends changes with consecutive changeids, following the latest
+        changeid in the log, recorded at a time (default: now), and flushes
+        them to the segment files"""
+        if recorded is None:
+            recorded = time.time()
+        with self.lock:
+            if self.last_recorded is None and self.last is not None:
+                self.last_recorded = self.segments[-1].recorded(self.last)
+            if self.last_recorded is not None:
+                recorded = max(recorded, self.last_recorded)
+            self.last_recorded = recorded
+            for change in changes:
+                segment = self.segments[-1] if self.segments else None
+                if (segment is None or segment.count >= self.segment_size or
+                        change.changeid != segment.first + segment.count):
+                    segment = self.rollover(change.changeid)
+                elif self.rec is None:
+                    self.open_files(segment)
+                uri = change.uri.encode('utf-8')
+                self.uri.write(uri)
+                self.rec.write(RECORD.pack(change.changeid, change.timestamp,
+                    recorded, CHANGETYPES.index(change.changetype),
+                    segment.uri_size, len(uri)))
+                segment.uri_size += len(uri)
+                segment.count += 1
+            if self.rec is not None:
+                self.uri.flush()
+                self.rec.flush()
+
+    def rollover(self, changeid):
+        """Starts a new segment at changeid and applies the retention"""
+        self.close_files()
+        if len(self.segments) > 0 and self.segments[-1].count == 0:
+            self.segments.pop().remove()
+        segment = Segment(self.directory, changeid)
+        self.segments.append(segment)
+        self.open_files(segment)
+        self.expire()
+        return segment
+
+    def open_files(self, segment):
+        """Opens the files of a segment for appending"""
+        self.uri = open(segment.path + ".uri", "ab")
+        self.rec = open(segment.path + ".rec", "ab")
+
+    def expire(self):
+        """Removes the oldest segments according to the retention settings;
+        the segment being written is always kept"""
+        now = time.time()
+        size = sum(segment.size for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_old = (self.retention_age is not None and
+                       now - oldest.mtime > self.retention_age)
+            too_large = (self.retention_size is not None and
+                         size > self.retention_size)
+            if not (too_old or too_large):
+                break
+            self.logger.info("Removing changes %d to %d from the change log" %
+                                                    (oldest.first, oldest.last))
+            size -= oldest.size
+            self.segments.pop(0)
+            oldest.remove()
+
+    def changeid_since(self, since):
+        """The first changeid recorded at or after since; the changeid
+        following the latest change if there is none, None if the log is
+        empty"""
+        with self.lock:
+            segments = list(self.segments)
+            last = self.last
+        if last is None:
+            return None
+        try:
+            # the first segment whose latest change is recorded since
+            low, high = 0, len(segments)
+            while low < high:
+                middle = (low + high) // 2
+                if segments[middle].recorded(
+                        min(segments[middle].last, last)) < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low == len(segments):
+                return last + 1
+            segment = segments[low]
+            low, high = segment.first, min(segment.last, last)
+            while low < high:
+                middle = (low + high) // 2
+                if segment.recorded(middle) < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+        except IOError:
+            # removed by the retention in the meantime
+            return self.changeid_since(since)
+
+    def changes_from(self, changeid, to_changeid=None):
+        """Yields the changes from changeid up to (and including)
+        to_changeid or the latest change, in changeid order"""
+        with self.lock:
+            segments = list(self.segments)
+            last = self.last
+        if last is None:
+            return
+        if to_changeid is not None:
+            last = min(last, to_changeid)
+        firsts = [segment.first for segment in segments]
+        i = max(0, bisect.bisect_right(firsts, changeid) - 1)
+        changeid = max(changeid, firsts[0])
+        for segment in segments[i:]:
+            if changeid > last:
+                return
+            try:
+                for change in segment.read(changeid, last):
+                    yield change
+            except IOError:
+                # removed by the retention in the meantime
+                pass
+            changeid = segment.last + 1
+
+    def close_files(self):
+        for f in (self.rec, self.uri):
+            if f is not None:
+                f.close()
+        self.rec = self.uri = None
+
+    def close(self):
+        with self.lock:
+            self.close_files()
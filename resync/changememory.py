@@ -10,11 +10,15 @@ import logging
 import re
 import os
 import time
+import threading
+import Queue
+from array import array
 
 from resync.observer import Observer
-from resync.changeset import ChangeSet
+from resync.changeset import ChangeSet, compact_changes
 from resync.source import Source
 from resync.sitemap import Sitemap, Mapper
+from resync.changelog import SegmentedChangeLog
 
 class ChangeMemory(Observer):
     """An abstract change memory implementation that doesn't do anything.
@@ -26,6 +30,8 @@ class ChangeMemory(Observer):
         self.config = config
         self.uri_path = config['uri_path']
         self.max_changes = config['max_changes']
+        # collapse the changes of each URI in a changeset to the net effect
+        self.compact = config.get('compact', False)
         self.changes = [] # stores change events; sorted by event id
         source.register_observer(self)
         self.logger = logging.getLogger('changememory')
@@ -43,15 +49,117 @@ class ChangeMemory(Observer):
     def notify(self, change):
         """General procdures for incoming changes. Should be overridden."""
         pass
+    
+    def close(self):
+        """Releases the change memory at shutdown"""
+        pass
+
+class ChangeRing(object):
+    """A ring buffer of changes with consecutive changeids; holds at most
+    capacity changes (-1 for no limit), appending to a full buffer evicts
+    the oldest change. Changes are located by their changeid, so appends,
+    evictions and lookups take constant time. The time each change was
+    recorded is kept alongside; it never decreases, so the changes since
+    a point in time are found by binary search."""
+    
+    def __init__(self, capacity=-1):
+        self.capacity = capacity
+        self.slots = []
+        self.recorded = array('d') # recording time of the change in a slot
+        self.base = None # changeid of the change in the first slot
+        self.first = None # changeid of the oldest change
+        self.last = None # changeid of the latest change
+    
+    def __len__(self):
+        if self.last is None:
+            return 0
+        return self.last - self.first + 1
+    
+    def __iter__(self):
+        return self.changes_from(self.first)
+    
+    def position(self, changeid):
+        """The slot of a changeid"""
+        if self.capacity == -1:
+            return changeid - self.base
+        return (changeid - self.base) % self.capacity
+    
+    def append(self, change, recorded=None):
+        """Appends a change recorded at a time (default: now); returns the
+        evicted change, if any"""
+        if recorded is None:
+            recorded = time.time()
+        if self.last is not None:
+            recorded = max(recorded, self.recorded[self.position(self.last)])
+        evicted = None
+        if self.base is None:
+            self.base = self.first = change.changeid
+        if self.capacity == -1 or len(self.slots) < self.capacity:
+            self.slots.append(change)
+            self.recorded.append(recorded)
+        else:
+            position = self.position(change.changeid)
+            evicted = self.slots[position]
+            self.slots[position] = change
+            self.recorded[position] = recorded
+            self.first += 1
+        self.last = change.changeid
+        return evicted
+    
+    def first_recorded(self):
+        """The recording time of the oldest change, None if empty"""
+        if self.last is None:
+            return None
+        return self.recorded[self.position(self.first)]
+    
+    def changeid_since(self, since):
+        """The first changeid recorded at or after since; the changeid
+        following the latest change if there is none"""
+        if self.last is None:
+            return None
+        low, high = self.first, self.last + 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.recorded[self.position(middle)] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    def get(self, changeid):
+        """Returns the change with changeid, None if it is not stored"""
+        if self.last is None or not self.first <= changeid <= self.last:
+            return None
+        change = self.slots[self.position(changeid)]
+        if change.changeid != changeid:
+            return None
+        return change
+    
+    def changes_from(self, changeid, to_changeid=None):
+        """Yields the stored changes from changeid up to (and including)
+        to_changeid or the latest change, in changeid order; changes which
+        are evicted while iterating are skipped"""
+        if self.last is None:
+            return
+        last = self.last
+        if to_changeid is not None:
+            last = min(last, to_changeid)
+        for changeid in xrange(max(changeid, self.first), last + 1):
+            change = self.get(changeid)
+            if change is not None:
+                yield change
 
 # A dynamic in-memory change set
 class DynamicChangeSet(ChangeMemory):
-    """A change memory that stores changes in an in-memory list"""
+    """A change memory that stores changes in an in-memory ring buffer"""
 
     def __init__(self, source, config):
         super(DynamicChangeSet, self).__init__(source, config)
+        self.changes = ChangeRing(self.max_changes)
         self.latest_change_id = 0
         self.first_change_id = 0
+        # maximum number of changes per changeset; -1 for no limit
+        self.page_size = config.get('page_size', -1)
                 
     @property
     def base_uri(self):
@@ -63,24 +171,60 @@ class DynamicChangeSet(ChangeMemory):
         if from_changeid==None:
             from_changeid=self.first_change_id
         from_changeid = int(from_changeid)
-        changeset = ChangeSet()
-        for change in self.changes_from(from_changeid):
-            changeset.add(change)
-        changeset.capabilities[self.next_changeset_uri()] = {
-                "rel": "next http://www.openarchives.org/rs/changeset"}
-        changeset.capabilities[self.current_changeset_uri(from_changeid)] = {
-                "rel": "current http://www.openarchives.org/rs/changeset"}
+        changeset = ChangeSet(capabilities=self.capabilities(from_changeid))
+        changeset.add(self.changeset_changes(from_changeid))
         return changeset
     
+    def page(self, from_changeid):
+        """The first and last changeid of the changeset starting at
+        from_changeid, the last is None if it is not limited by page_size"""
+        first = max(int(from_changeid), self.first_change_id, 1)
+        if self.page_size == -1:
+            return (first, None)
+        return (first, first + self.page_size - 1)
+    
+    def changeset_changes(self, from_changeid):
+        """The changes of the changeset starting at from_changeid, at most
+        page_size of them; compacted per URI if configured"""
+        (first, last) = self.page(from_changeid)
+        changes = self.changes_from(first, last)
+        if self.compact:
+            return compact_changes(changes)
+        return changes
+    
+    def capabilities(self, from_changeid):
+        """The links of the changeset starting at from_changeid; if there
+        are more changes than fit into it, next links to the following page"""
+        (first, last) = self.page(from_changeid)
+        if last is not None and last < self.latest_change_id:
+            next_uri = self.base_uri + "/from/" + str(last + 1)
+        else:
+            next_uri = self.next_changeset_uri()
+        return {next_uri: {
+                    "rel": "next http://www.openarchives.org/rs/changeset"},
+                self.current_changeset_uri(from_changeid): {
+                    "rel": "current http://www.openarchives.org/rs/changeset"}}
+    
     def notify(self, change):
         """Simply store a change in the in-memory list"""
         super(DynamicChangeSet, self).notify(change)
-        change.changeid = self.latest_change_id + 1
-        self.latest_change_id = change.changeid
-        if self.max_changes != -1 and self.change_count >= self.max_changes:
-            del self.changes[0]
-            self.first_change_id = self.changes[0].changeid
-        self.changes.append(change)
+        self.notify_batch([change])
+    
+    def notify_batch(self, changes):
+        """Numbers and stores a list of changes"""
+        for change in changes:
+            change.changeid = self.latest_change_id + 1
+            self.latest_change_id = change.changeid
+        self.store(changes, time.time())
+    
+    def store(self, changes, recorded):
+        """Appends numbered changes to the ring buffer"""
+        evicted = False
+        for change in changes:
+            if self.changes.append(change, recorded) is not None:
+                evicted = True
+        if evicted:
+            self.first_change_id = self.changes.first
     
     def current_changeset_uri(self, from_changeid = None):
         """Constructs the URI of the current changeset."""
@@ -93,13 +237,18 @@ class DynamicChangeSet(ChangeMemory):
         """Constructs the URI of the next changeset"""
         return self.base_uri + "/from/" + str(self.latest_change_id + 1)
     
-    def changes_from(self, changeid):
-        """Returns all changes starting from (and including) a certain
-        changeid"""
-        changeid = int(changeid)
-        changes = [change for change in self.changes 
-                            if change.changeid >= changeid]
-        return sorted(changes, key=lambda change: change.changeid)
+    def changes_from(self, changeid, to_changeid=None):
+        """Iterates over all changes starting from (and including) a certain
+        changeid, up to (and including) to_changeid, in changeid order"""
+        return self.changes.changes_from(int(changeid), to_changeid)
+    
+    def changeid_since(self, since):
+        """The first changeid recorded at or after since (in seconds since
+        the epoch)"""
+        changeid = self.changes.changeid_since(since)
+        if changeid is None:
+            return self.latest_change_id + 1
+        return changeid
     
     def knows_changeid(self, changeid = None):
         """Returns true if changeid is known (= stored)"""
@@ -108,14 +257,81 @@ class DynamicChangeSet(ChangeMemory):
                     and (changeid <= self.latest_change_id))
         return known
 
+# A durable change memory
+class PersistentChangeSet(DynamicChangeSet):
+    """A dynamic change memory that also appends all changes to a segmented
+    change log on disk; the latest max_changes changes are served from
+    memory, older ones from the log, which survives restarts"""
+    
+    def __init__(self, source, config):
+        super(PersistentChangeSet, self).__init__(source, config)
+        self.changelog = SegmentedChangeLog(config['directory'],
+                                config.get('segment_size', 100000),
+                                config.get('retention_age'),
+                                config.get('retention_size'))
+        if self.changelog.last is not None:
+            self.first_change_id = self.changelog.first
+            self.latest_change_id = self.changelog.last
+    
+    def store(self, changes, recorded):
+        """Appends numbered changes to the change log, then to the ring
+        buffer, so that evicted changes are always found in the log"""
+        self.changelog.append(changes, recorded)
+        super(PersistentChangeSet, self).store(changes, recorded)
+        self.first_change_id = self.changelog.first
+    
+    def changeid_since(self, since):
+        """The first changeid recorded at or after since; looked up in the
+        change log if since is before the changes in memory"""
+        first_recorded = self.changes.first_recorded()
+        if first_recorded is None or since < first_recorded:
+            changeid = self.changelog.changeid_since(since)
+            if changeid is not None:
+                return changeid
+        return super(PersistentChangeSet, self).changeid_since(since)
+    
+    def changes_from(self, changeid, to_changeid=None):
+        """Iterates over all changes starting from (and including) a certain
+        changeid, up to (and including) to_changeid, in changeid order;
+        changes which are no longer in memory are read from the change log"""
+        changeid = int(changeid)
+        while True:
+            first_in_memory = self.changes.first
+            if first_in_memory is None:
+                first_in_memory = self.latest_change_id + 1
+            if changeid < first_in_memory:
+                last = first_in_memory - 1
+                if to_changeid is not None:
+                    last = min(last, to_changeid)
+                for change in self.changelog.changes_from(changeid, last):
+                    yield change
+                changeid = max(changeid, first_in_memory)
+            for change in self.changes.changes_from(changeid, to_changeid):
+                if change.changeid != changeid:
+                    break # evicted meanwhile, read them from the log
+                yield change
+                changeid += 1
+            else:
+                return
+    
+    def close(self):
+        self.changelog.close()
+
 # A static file-based change memory
 class StaticChangeSet(ChangeMemory):
-    """A changememory that periodically dumps changes to the file system"""
+    """A changememory that periodically dumps changes to the file system;
+    a full cache of changes is handed to a background thread which writes
+    it while new changes are collected in a fresh cache. If write_queue_size
+    caches are waiting to be written, incoming changes block."""
     
     def __init__(self, source, config):
         super(StaticChangeSet, self).__init__(source, config)
         self.uri_file = config['uri_file']
         self.previous_changeset_id = 0
+        self.write_queue = Queue.Queue(config.get('write_queue_size', 2))
+        self.writer = threading.Thread(target=self.write_changesets)
+        self.writer.daemon = True
+        self.writer.start()
     
     @property
     def base_uri(self):
@@ -151,11 +367,15 @@ class StaticChangeSet(ChangeMemory):
         """Constructs the filename the current changes to be written"""
         return "changeset%05d.xml" % (self.previous_changeset_id + 1)
     
-    def generate(self):
-        """Generates an inventory of changes"""
+    def generate(self, changes=None):
+        """Generates an inventory of changes, by default of the cached ones"""
+        if changes is None:
+            changes = self.changes
         changeset = ChangeSet()
-        for change in self.changes:
+        for change in changes:
             changeset.add(change)
+        if self.compact:
+            changeset.compact()
         changeset.capabilities[self.current_changeset_uri()] = {
                 "rel": "current http://www.openarchives.org/rs/changeset"}
         if self.previous_changeset_uri() is not None:
@@ -168,21 +388,66 @@ class StaticChangeSet(ChangeMemory):
         super(StaticChangeSet, self).notify(change)
         self.changes.append(change)
         if len(self.changes) >= self.config['max_changes']:
-            self.write_changeset()
-            del self.changes[:]
+            self.swap_changes()
     
-    def write_changeset(self):
-        """Writes all cached changes to a file; empties the cache"""
+    def notify_batch(self, changes):
+        """Stores a list of changes, writes a changeset whenever max_changes
+        changes are cached"""
+        i = 0
+        while i < len(changes):
+            n = max(1, self.config['max_changes'] - len(self.changes))
+            self.changes.extend(changes[i:i+n])
+            i += n
+            if len(self.changes) >= self.config['max_changes']:
+                self.swap_changes()
+    
+    def swap_changes(self):
+        """Hands the cached changes to the writer and starts a new cache;
+        blocks while the write queue is full"""
+        changes = self.changes
+        self.changes = []
+        self.write_queue.put(changes)
+    
+    def write_changesets(self):
+        """Writes the queued caches of changes until None is queued"""
+        while True:
+            changes = self.write_queue.get()
+            try:
+                if changes is None:
+                    return
+                self.write_changeset(changes)
+            except Exception as e:
+                self.logger.error("Cannot write changeset: %s" % e)
+            finally:
+                self.write_queue.task_done()
+    
+    def write_changeset(self, changes=None):
+        """Writes changes (by default the cached ones) to the next changeset
+        file"""
         then = time.time()
-        changeset = self.generate()
+        changeset = self.generate(changes)
         basename = Source.STATIC_FILE_PATH + "/" + self.current_changeset_file()
         s=Sitemap()
         s.max_sitemap_entries=self.config['max_sitemap_entries']
+        s.gzip=self.config.get('gzip', False)
         s.mapper=Mapper([self.source.base_uri, Source.STATIC_FILE_PATH])
         s.write(changeset, basename)
         now = time.time()
         self.previous_changeset_id = self.previous_changeset_id + 1
-        self.logger.info("Wrote static changeset..")
+        # the most recent changeset served links to the new file now
+        self.source.touch()
+        self.logger.info("Wrote static changeset in %f seconds" % (now - then))
+    
+    def flush(self):
+        """Waits until all queued changes are written"""
+        self.write_queue.join()
+    
+    def close(self):
+        """Writes the cached and all queued changes and stops the writer"""
+        if len(self.changes) > 0:
+            self.swap_changes()
+        self.write_queue.put(None)
+        self.writer.join()
     
     def ls_changeset_files(self, directory):
         """Returns the list of changesets in a directory"""
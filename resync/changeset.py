@@ -20,6 +20,38 @@ import collections
 from resource_container import ResourceContainer
 from resource_change import ResourceChange
 
+def compact_changes(changes):
+    """Collapses the changes of each URI to their net effect
+
+    A resource which did not exist before the first change (CREATED) and
+    does not exist after the last change (DELETED) is left out; otherwise
+    the last change is returned as CREATED, UPDATED or DELETED depending on
+    whether the resource existed before and after the changes. Returns a
+    list ordered by the position of the last change of each URI.
+    """
+    first = {} # {uri: changetype of the first change}
+    last = {} # {uri: (position, last change)}
+    for position, change in enumerate(changes):
+        first.setdefault(change.uri, change.changetype)
+        last[change.uri] = (position, change)
+    compacted = []
+    for (position, change) in sorted(last.values()):
+        existed = (first[change.uri] != "CREATED")
+        exists = (change.changetype != "DELETED")
+        if not existed and not exists:
+            continue
+        elif not existed:
+            changetype = "CREATED"
+        elif exists:
+            changetype = "UPDATED"
+        else:
+            changetype = "DELETED"
+        if changetype != change.changetype:
+            change = ResourceChange(resource=change, changeid=change.changeid,
+                                    changetype=changetype)
+        compacted.append(change)
+    return compacted
+
 class ChangeSet(ResourceContainer):
     """Class representing an Change Set"""
 
@@ -44,6 +76,10 @@ class ChangeSet(ResourceContainer):
         else:
             self.resources.append(resource)
 
+    def compact(self):
+        """Collapses the changes of each URI to their net effect"""
+        self.resources = compact_changes(self.resources)
+
     def add_changed_resources(self, resources, changeid=None, changetype=None):
         """Add items from a ResourceContainer resources to this ChangeSet
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+checkpoint.py: A small on-disk journal of the OAI-PMH harvest progress
+
+After each ListRecords page the source records the resumptionToken of the
+next page, the checkdate, the number of applied records and the from date
+of the harvest, so that a restarted adapter can continue the harvest
+instead of starting over. A bootstrap harvesting partitions (sets or date
+windows) additionally records the partitions and how many of them have been
+applied; the resumptionToken belongs to the partition being applied.
+"""
+
+import os
+import json
+import logging
+
+from dateutil import parser as dateutil_parser
+
+class HarvestCheckpoint(object):
+    """Reads and atomically writes the harvest progress as JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('checkpoint')
+
+    def load(self):
+        """Returns the saved progress as dict or None if there is none"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except ValueError as e:
+            self.logger.error("Ignoring corrupt checkpoint %s: %s" %
+                                                        (self.path, e))
+            return None
+        for key in ('lastcheckdate', 'fromdate'):
+            if state.get(key) is not None:
+                state[key] = dateutil_parser.parse(state[key])
+        return state
+
+    def save(self, lastcheckdate, resumptionToken=None, no_records=0,
+             fromdate=None, partitions=None):
+        """Replaces the saved progress; the file is written to a temporary
+        file first and renamed, so a crash never leaves a partial journal"""
+        state = {'lastcheckdate': self.isoformat(lastcheckdate),
+                 'resumptionToken': resumptionToken,
+                 'no_records': no_records,
+                 'fromdate': self.isoformat(fromdate),
+                 'partitions': partitions}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+
+    def clear(self):
+        """Removes the saved progress"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def isoformat(self, date):
+        if date is None:
+            return None
+        return date.isoformat()
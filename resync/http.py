@@ -8,16 +8,25 @@ Created by Bernhard Haslhofer on 2012-04-24.
 Copyright 2012, ResourceSync.org. All rights reserved.
 """
 
+import sys
 import threading
+import collections
+import Queue
 import os.path
 import logging
+import mimetypes
+import zlib
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+import tornado.locks
+import tornado.concurrent
 
 from resync.source import Source
 from resync.sitemap import Sitemap
+from resync.resource import Resource
 
 
 class HTTPInterface(threading.Thread):
@@ -39,6 +48,14 @@ class HTTPInterface(threading.Thread):
         self._stop = threading.Event()
         self.source = source
         self.port = source.port
+        self.response_cache = ResponseCache(
+                        source.config.get('response_cache_size', 16))
+        self.executor = SitemapExecutor(source.config.get('sitemap_workers', 2))
+        # options of the handlers which serve sitemaps
+        self.sitemap_options = dict(cache = self.response_cache,
+            executor = self.executor,
+            semaphore = tornado.locks.Semaphore(
+                            source.config.get('max_sitemap_requests', 4)))
         self.settings = dict(
             title=u"ResourceSync OAI-PMH Adapter",
             template_path=os.path.join(os.path.dirname(__file__), "templates"),
@@ -62,32 +79,47 @@ class HTTPInterface(threading.Thread):
                 self.handlers = self.handlers + \
                     [(r"/%s" % inventory_builder.path,
                         InventoryHandler, 
-                        dict(inventory_builder = inventory_builder))]
+                        dict(inventory_builder = inventory_builder,
+                             **self.sitemap_options)),
+                    (r"/%s" % inventory_builder.sitemap_path(0).replace(
+                                                "00000", "([0-9]{5})"),
+                        InventorySitemapHandler,
+                        dict(inventory_builder = inventory_builder,
+                             **self.sitemap_options))]
             elif inventory_builder.config['class'] == "StaticInventoryBuilder":
                 self.handlers = self.handlers + \
-                    [(r"/(sitemap\d*\.xml)",
-                        tornado.web.StaticFileHandler,
-                        dict(path = self.settings['static_path']))]
+                    [(r"/(sitemap\d*\.xml(?:\.gz)?)",
+                        PrecompressedFileHandler,
+                        dict(path = inventory_builder.current_path))]
         
         """Initialize changememory handlers"""
         if self.source.has_changememory:
             changememory = self.source.changememory
-            if changememory.config['class'] == "DynamicChangeSet":
+            if changememory.config['class'] in ("DynamicChangeSet",
+                                                "PersistentChangeSet"):
                 self.handlers = self.handlers + \
                     [(r"/%s" % changememory.uri_path, 
                         DynamicChangeSetHandler,
-                        dict(changememory = changememory)),
+                        dict(changememory = changememory,
+                             **self.sitemap_options)),
                     (r"/%s/from/([0-9]+)" % changememory.uri_path,
                         DynamicChangeSetDiffHandler,
-                        dict(changememory = changememory))]
+                        dict(changememory = changememory,
+                             **self.sitemap_options)),
+                    (r"/%s/since/([^/]+)" % changememory.uri_path,
+                        DynamicChangeSetSinceHandler,
+                        dict(changememory = changememory,
+                             **self.sitemap_options))]
             elif changememory.config['class'] == "StaticChangeSet":
                 self.handlers = self.handlers + \
                     [(r"/%s/%s" % (changememory.uri_path, 
                                     changememory.uri_file), 
                         StaticChangeSetHandler,
-                        dict(changememory = changememory)),
-                    (r"/%s/(changeset\d*\.xml)" % changememory.uri_path,
-                        tornado.web.StaticFileHandler,
+                        dict(changememory = changememory,
+                             **self.sitemap_options)),
+                    (r"/%s/(changeset\d*\.xml(?:\.gz)?)" % 
+                                                    changememory.uri_path,
+                        PrecompressedFileHandler,
                         dict(path = self.settings['static_path']))]
     
     def run(self):
@@ -103,6 +135,7 @@ class HTTPInterface(threading.Thread):
     def stop(self):
         self.logger.info("Stopping HTTP Interface")
         tornado.ioloop.IOLoop.instance().stop()
+        self.executor.shutdown()
         self._stop.set()
 
     def stopped(self):
@@ -146,41 +179,256 @@ class ResourceHandler(BaseRequestHandler):
             payload = self.source.resource_payload(basename)
             self.write(payload)
 
+def accepts_gzip(request):
+    """Returns True if the Accept-Encoding of a request allows gzip"""
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        params = [param.strip() for param in coding.split(";")]
+        if params[0].lower() != "gzip":
+            continue
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    if float(param[2:]) == 0:
+                        return False
+                except ValueError:
+                    return False
+        return True
+    return False
+
+class PrecompressedFileHandler(tornado.web.StaticFileHandler):
+    """Serves static sitemaps; the precompressed file.gz instead of a file
+    if there is one and the client accepts gzip"""
+    
+    def parse_url_path(self, url_path):
+        self.set_header("Vary", "Accept-Encoding")
+        self.gzipped = False
+        if (not url_path.endswith(".gz") and accepts_gzip(self.request) and
+                os.path.isfile(os.path.join(self.root, url_path + ".gz"))):
+            self.set_header("Content-Encoding", "gzip")
+            self.gzipped = True
+            url_path = url_path + ".gz"
+        return url_path
+    
+    def get_content_type(self):
+        if self.gzipped:
+            mime_type = mimetypes.guess_type(self.absolute_path[:-3])[0]
+            return mime_type or "application/octet-stream"
+        return super(PrecompressedFileHandler, self).get_content_type()
+
+# Sitemap Handlers
+
+class SitemapExecutor(object):
+    """Runs functions for the request handlers in a fixed number of worker
+    threads, so that generating sitemaps does not block the IOLoop; the
+    results are returned as futures resolved on the IOLoop of the caller"""
+    
+    def __init__(self, workers=2):
+        self.tasks = Queue.Queue()
+        self.workers = [threading.Thread(target=self.work)
+                        for n in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+    
+    def submit(self, fn, *args):
+        """Returns a future of the result of fn(*args)"""
+        future = tornado.concurrent.Future()
+        self.tasks.put((future, tornado.ioloop.IOLoop.current(), fn, args))
+        return future
+    
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            (future, io_loop, fn, args) = task
+            try:
+                result = fn(*args)
+            except Exception:
+                io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                io_loop.add_callback(future.set_result, result)
+    
+    def shutdown(self):
+        """Stops the workers once the submitted functions have run"""
+        for worker in self.workers:
+            self.tasks.put(None)
+
+class ResponseCache(object):
+    """Caches the serialized sitemaps of the latest version of the source by
+    key (request path and encoding); at most maxsize of them, the least
+    recently used ones are evicted"""
+    
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.version = None
+        self.responses = collections.OrderedDict() # {key: body}
+        self.lock = threading.Lock()
+    
+    def get(self, version, key):
+        """Returns the cached body or None"""
+        with self.lock:
+            if version != self.version or key not in self.responses:
+                return None
+            body = self.responses.pop(key)
+            self.responses[key] = body # most recently used
+            return body
+    
+    def put(self, version, key, body):
+        """Caches a body generated for a version; bodies of older versions
+        are dropped"""
+        with self.lock:
+            if self.version is not None and version < self.version:
+                return
+            if version != self.version:
+                self.responses.clear()
+                self.version = version
+            self.responses.pop(key, None)
+            self.responses[key] = body
+            while len(self.responses) > self.maxsize:
+                self.responses.popitem(last=False)
+
+class SitemapHandler(tornado.web.RequestHandler):
+    """Base class of the handlers which serve a sitemap of the source. The
+    XML is sent in chunks of CHUNK_SIZE url elements while it is generated,
+    so neither the document nor the list of resources is held in memory,
+    and cached for the version of the source it was generated for. The
+    version is also the strong ETag of the response, so a client which
+    already has it gets 304 Not Modified without any generation. Clients
+    accepting gzip get the sitemap gzip encoded, with an ETag of its own.
+    The chunks are generated by the executor while the IOLoop serves other
+    requests; at most as many sitemaps as the semaphore allows are
+    generated at the same time, further requests wait."""
+    
+    CHUNK_SIZE = 1000
+    
+    def initialize(self, source, cache=None, executor=None, semaphore=None):
+        self.source = source
+        self.cache = cache
+        if executor is None:
+            executor = tornado.concurrent.dummy_executor
+        self.executor = executor
+        self.semaphore = semaphore
+    
+    def compute_etag(self):
+        return '"%x-%x%s"' % (int(self.source.started), self.version,
+                              "-gzip" if self.gzip else "")
+    
+    @tornado.gen.coroutine
+    def write_sitemap(self, generate):
+        """Writes the sitemap whose XML chunks are iterated over by the
+        result of generate, flushing after each chunk"""
+        self.version = self.source.version
+        self.gzip = accepts_gzip(self.request)
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header("Content-Type", "application/xml")
+        if self.gzip:
+            self.set_header("Content-Encoding", "gzip")
+        key = (self.request.uri, self.gzip)
+        if self.cache is not None:
+            body = self.cache.get(self.version, key)
+            if body is not None:
+                self.write(body)
+                return
+        if self.semaphore is not None:
+            yield self.semaphore.acquire()
+        try:
+            chunks = yield self.executor.submit(generate)
+            if self.gzip:
+                chunks = self.gzip_chunks(chunks)
+            body = []
+            while True:
+                chunk = yield self.executor.submit(next, chunks, None)
+                if chunk is None:
+                    break
+                if self.cache is not None:
+                    body.append(chunk)
+                self.write(chunk)
+                yield self.flush()
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+        if self.cache is not None:
+            self.cache.put(self.version, key, ''.join(body))
+    
+    def xml_chunks(self, resources, capabilities=None):
+        """The XML chunks of a sitemap of resources"""
+        return Sitemap().resources_as_xml_chunks(resources,
+                        capabilities=capabilities, chunk_size=self.CHUNK_SIZE)
+    
+    def gzip_chunks(self, chunks):
+        """Compresses chunks to the parts of one gzip stream; each part can
+        be decompressed as soon as it is received"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                        compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
 # Inventory Handlers
             
-class InventoryHandler(tornado.web.RequestHandler):
+class InventoryHandler(SitemapHandler):
     """The HTTP request handler for the Inventory"""
     
-    def initialize(self, inventory_builder):
+    def initialize(self, inventory_builder, **options):
+        super(InventoryHandler, self).initialize(inventory_builder.source,
+                                               **options)
         self.inventory_builder = inventory_builder
     
-    def generate_sitemap(self):
-        """Creates a sitemap inventory"""
+    def generate_inventory(self):
+        """The inventory; a sitemapindex if it does not fit into a single
+        sitemap"""
+        if self.inventory_builder.sitemap_count > 1:
+            index = self.inventory_builder.generate_index()
+            return [Sitemap().sitemapindex_as_xml(
+                        sitemaps=dict((r.uri, r.timestamp) for r in index),
+                        capabilities=index.capabilities)]
         inventory = self.inventory_builder.generate()
-        return Sitemap().resources_as_xml(inventory,
-                                        capabilities=inventory.capabilities)
+        return self.xml_chunks(inventory, inventory.capabilities)
     
+    @tornado.gen.coroutine
     def get(self):
-        self.set_header("Content-Type", "application/xml")
-        self.write(self.generate_sitemap())
+        yield self.write_sitemap(self.generate_inventory)
+
+class InventorySitemapHandler(InventoryHandler):
+    """The HTTP request handler for the sitemaps of the sitemapindex of an
+    Inventory"""
+    
+    @tornado.gen.coroutine
+    def get(self, n):
+        n = int(n)
+        if n >= self.inventory_builder.sitemap_count:
+            raise tornado.web.HTTPError(404)
+        yield self.write_sitemap(lambda: self.generate_sitemap(n))
+    
+    def generate_sitemap(self, n):
+        inventory = self.inventory_builder.generate_sitemap(n)
+        return self.xml_chunks(inventory, inventory.capabilities)
 
 # Changememory Handlers
 
-class DynamicChangeSetHandler(tornado.web.RequestHandler):
+class DynamicChangeSetHandler(SitemapHandler):
     """The HTTP request handler for dynamically generated changesets"""
 
-    def initialize(self, changememory):
+    def initialize(self, changememory, **options):
+        super(DynamicChangeSetHandler, self).initialize(changememory.source,
+                                                      **options)
         self.changememory = changememory
     
     def generate_changeset(self, changeid=None):
-        """Serialize the changes in the changememory"""
-        changeset = self.changememory.generate(from_changeid=changeid)
-        return Sitemap().resources_as_xml(changeset,
-                                        capabilities=changeset.capabilities)
+        """The changeset of the changes from changeid on"""
+        if changeid is None:
+            changeid = self.changememory.first_change_id
+        return self.xml_chunks(self.changememory.changeset_changes(changeid),
+                               self.changememory.capabilities(changeid))
     
+    @tornado.gen.coroutine
     def get(self):
-        self.set_header("Content-Type", "application/xml")
-        self.write(self.generate_changeset())
+        yield self.write_sitemap(self.generate_changeset)
 
 class DynamicChangeSetDiffHandler(DynamicChangeSetHandler):
     """The HTTP request handler for the dynamically generated sub-changesets"""
@@ -188,23 +436,37 @@ class DynamicChangeSetDiffHandler(DynamicChangeSetHandler):
     def write_error(self, status_code, **kwargs):
         self.write("Error %d - %s" % (status_code, kwargs['message']))
     
+    @tornado.gen.coroutine
     def get(self, changeid):
-        changeid = int(changeid)
-        self.set_header("Content-Type", "application/xml")
-        self.write(self.generate_changeset(changeid=changeid))
+        yield self.write_sitemap(
+                        lambda: self.generate_changeset(int(changeid)))
             
-class StaticChangeSetHandler(tornado.web.RequestHandler):
+class DynamicChangeSetSinceHandler(DynamicChangeSetHandler):
+    """The HTTP request handler for the changes recorded since a W3C
+    datetime"""
+    
+    @tornado.gen.coroutine
+    def get(self, since):
+        try:
+            timestamp = Resource(uri=None, lastmod=since).timestamp
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Bad datetime %s" % since)
+        yield self.write_sitemap(lambda: self.generate_changeset(
+                            self.changememory.changeid_since(timestamp)))
+
+class StaticChangeSetHandler(SitemapHandler):
     """The HTTP request handler for static changesets"""
     
-    def initialize(self, changememory):
+    def initialize(self, changememory, **options):
+        super(StaticChangeSetHandler, self).initialize(changememory.source,
+                                                     **options)
         self.changememory = changememory
-        
+    
     def generate_changeset(self):
-        "Serialize the changes in the changememory"
+        """The changes not yet written to a static changeset"""
         changeset = self.changememory.generate()
-        return Sitemap().resources_as_xml(changeset, 
-                                        capabilities=changeset.capabilities)
+        return self.xml_chunks(changeset, changeset.capabilities)
     
+    @tornado.gen.coroutine
     def get(self):
-        self.set_header("Content-Type", "application/xml")
-        self.write(self.generate_changeset())
\ No newline at end of file
+        yield self.write_sitemap(self.generate_changeset)
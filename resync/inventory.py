@@ -18,26 +18,25 @@ import sys
 import StringIO
 
 from resource_container import ResourceContainer
+from sorted_index import SortedKeyDict
 
-class InventoryDict(dict):
+class InventoryDict(SortedKeyDict):
     """Default implementation of class to store resources in Inventory
 
     Key properties of this class are:
     - has add(resource) method
     - is iterable and results given in alphanumeric order by resource.uri
+
+    The URIs are kept sorted as resources are added and removed, so
+    iterating does not sort or copy them.
     """
 
     def __iter__(self):
         """Iterator over all the resources in this inventory"""
-        self._iter_next_list = sorted(self.keys())
-        self._iter_next_list.reverse()
-        return(iter(self._iter_next, None))
-
-    def _iter_next(self):
-        if (len(self._iter_next_list)>0):
-            return(self[self._iter_next_list.pop()])
-        else:
-            return(None)
+        for uri in self.index:
+            resource = self.get(uri)
+            if (resource is not None):
+                yield resource
 
     def add(self, resource, replace=False):
         """Add just a single resource"""
@@ -15,6 +15,12 @@ class Observer(object):
     
     def notify(self, event):
         pass
+    
+    def notify_batch(self, events):
+        """Informs about a list of events at once; observers which can
+        handle many events faster than one at a time override this"""
+        for event in events:
+            self.notify(event)
 
 
 class Observable(object):
@@ -30,4 +36,9 @@ class Observable(object):
         """Notifies observers about change events"""
         for observer in self.observers:
             observer.notify(event)
+    
+    def notify_observers_batch(self, events):
+        """Notifies observers about a list of change events"""
+        for observer in self.observers:
+            observer.notify_batch(events)
         
\ No newline at end of file
@@ -32,6 +32,10 @@ class ConsolePublisher(Publisher):
     
     def notify(self, event):
         print "Bleep!!!: " + str(event)
+    
+    def notify_batch(self, events):
+        sys.stdout.write("".join(["Bleep!!!: %s\n" % event
+                                  for event in events]))
 
 
 class XMPPPublisher(Publisher, ClientXMPP):
@@ -76,6 +80,12 @@ class XMPPPublisher(Publisher, ClientXMPP):
         sys.stdout.flush()
         self.publish(event)
 
+    def notify_batch(self, events):
+        print "XMPP publisher received %d events. Now it bleeps..." % len(events)
+        sys.stdout.flush()
+        for event in events:
+            self.publish(event)
+
     def session_start(self, event):
         self.send_presence()
 
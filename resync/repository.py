@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+repository.py: Storage backends for the resources of a source
+
+A repository keeps two mappings: resources (basename -> {'timestamp': ...})
+and identifiers (OAI identifier -> basename). The default implementation
+keeps both in memory; SQLiteRepository stores them durably in a sqlite3
+database so that a restarted source does not need to harvest everything
+again and the resource set may grow past the available memory.
+CompactRepository keeps them in memory with a fraction of the footprint of
+plain dicts. The in-memory repositories keep their basenames in a
+SortedIndex, updated as resources are created and deleted, so that they
+can be iterated over in sorted order without sorting them each time.
+"""
+
+import sqlite3
+import threading
+import logging
+import heapq
+import itertools
+from UserDict import DictMixin
+
+from resync.sorted_index import SortedIndex, SortedKeyDict
+
+class Repository(object):
+    """An in-memory repository"""
+
+    persistent = False # whether the resources survive a restart
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else {}
+        self.resources = SortedKeyDict() # {basename: {timestamp}}
+        self.identifiers = {} # {identifier: basename}
+        # common prefix of the GetRecord URIs of the OAI-PMH records, set by
+        # the source once the endpoint is known
+        self.metadata_uri_prefix = None
+
+    def basenames(self):
+        """Iterates over the basenames of all resources; the repository may
+        be modified while iterating"""
+        return iter(self.resources.keys())
+
+    def sorted_basenames(self, start=0, stop=None):
+        """Iterates over the basenames from position start to stop of all
+        basenames in sorted order; the repository may be modified while
+        iterating"""
+        return self.resources.index.islice(start, stop)
+
+    def sorted_basenames_from(self, first=None):
+        """Iterates over the basenames from first on (all if None) in
+        sorted order; the repository may be modified while iterating"""
+        return self.resources.index.iter_from(first)
+
+    def commit(self):
+        """Makes all changes durable; nothing to do in memory"""
+        pass
+
+    def close(self):
+        """Commits and releases the repository"""
+        self.commit()
+
+class CompactRepository(Repository):
+    """An in-memory repository for millions of resources: URIs and
+    identifiers are stored prefix-compressed, with one timestamp per
+    resource. The GetRecord URIs of the records are not stored at all but
+    derived from the identifiers; they share the timestamp of the resource
+    they describe."""
+
+    def __init__(self, config=None):
+        super(CompactRepository, self).__init__(config)
+        self.uris = PrefixCompressor('/', 3)
+        self.resources = CompactResourceTable(self)
+        self.identifiers = CompactIdentifierTable(self)
+
+    def basenames(self):
+        return self.resources.iterkeys()
+
+    def sorted_basenames(self, start=0, stop=None):
+        """Merges the sorted basenames of each prefix and the sorted derived
+        GetRecord URIs from the basename at position start on, which is
+        found by bisecting the runs of the prefixes in the indexes"""
+        runs = self.uris.runs(self.resources.index)
+        prefix = self.metadata_uri_prefix
+        if prefix is not None:
+            runs += self.identifiers.identifiers.runs(self.identifiers.index,
+                                                      prefix)
+        first = select(runs, start)
+        if first is None:
+            return iter([])
+        if stop is not None:
+            stop = max(stop - start, 0)
+        return itertools.islice(self.sorted_basenames_from(first), stop)
+
+    def sorted_basenames_from(self, first=None):
+        sources = self.uris.sorted_values(self.resources.index, first=first)
+        prefix = self.metadata_uri_prefix
+        if prefix is not None:
+            sources += self.identifiers.identifiers.sorted_values(
+                                self.identifiers.index, prefix, first)
+        return heapq.merge(*sources)
+
+class PrefixCompressor(object):
+    """Replaces the part of a string up to the n-th separator (e.g., the
+    scheme and host of a URI) by a short code; every distinct prefix is
+    stored only once"""
+
+    def __init__(self, separator, n):
+        self.separator = separator
+        self.n = n
+        self.prefixes = []
+        self.codes = {} # {prefix: code}
+
+    def compress(self, value, add=True):
+        """Returns the compressed value; None if its prefix is unknown and
+        add is False"""
+        i = 0
+        for n in range(self.n):
+            i = value.find(self.separator, i) + 1
+            if i == 0:
+                break
+        code = self.codes.get(value[:i])
+        if code is None:
+            if not add:
+                return None
+            code = "%x" % len(self.prefixes)
+            self.prefixes.append(value[:i])
+            self.codes[value[:i]] = code
+        return code + "\x00" + value[i:]
+
+    def decompress(self, key):
+        code, suffix = key.split("\x00", 1)
+        return self.prefixes[int(code, 16)] + suffix
+
+    def sorted_values(self, index, prefix="", first=None):
+        """Returns one iterator per known prefix over the decompressed
+        values (from first on) of the compressed keys in index with that
+        prefix, in sorted order; the keys of a prefix are adjacent in the
+        index"""
+        sources = []
+        for (code, value) in enumerate(self.prefixes[:]):
+            code = "%x\x00" % code
+            value = prefix + value
+            if first is None or value >= first:
+                sources.append(self.iter_prefix(index, code, value, code))
+            elif first.startswith(value):
+                sources.append(self.iter_prefix(index, code, value,
+                                                code + first[len(value):]))
+        return sources
+
+    def iter_prefix(self, index, code, value, start):
+        for key in index.iter_from(start):
+            if not key.startswith(code):
+                return
+            yield value + key[len(code):]
+
+    def runs(self, index, prefix=""):
+        """Returns the keys of each known prefix in index as a PrefixRun"""
+        return [PrefixRun(index, "%x\x00" % code, prefix + value)
+                for (code, value) in enumerate(self.prefixes[:])]
+
+class PrefixRun(object):
+    """The adjacent keys of a prefix in a SortedIndex of compressed keys,
+    read decompressed and by position"""
+
+    def __init__(self, index, code, value):
+        self.index = index
+        self.code = code
+        self.value = value
+        self.start = index.rank(code)
+        self.stop = index.rank(code[:-1] + "\x01")
+
+    def __len__(self):
+        return max(self.stop - self.start, 0)
+
+    def value_at(self, position):
+        key = self.index.key_at(self.start + position)
+        if key is None or not key.startswith(self.code):
+            return None
+        return self.value + key[len(self.code):]
+
+    def rank(self, value):
+        """The number of values of the run less than value"""
+        if value.startswith(self.value):
+            n = self.index.rank(self.code + value[len(self.value):])
+            return min(max(n - self.start, 0), len(self))
+        if value < self.value:
+            return 0
+        return len(self)
+
+def select(runs, position):
+    """Returns the value at a position of the merged sorted values of
+    several runs (None if there are fewer values) by bisecting the longest
+    remaining part of a run until the values before one are counted
+    exactly"""
+    lows = [0] * len(runs)
+    highs = [len(run) for run in runs]
+    if position < 0 or position >= sum(highs):
+        return None
+    while True:
+        i = max(range(len(runs)), key=lambda i: highs[i] - lows[i])
+        if highs[i] <= lows[i]:
+            return None # changed while bisecting
+        value = runs[i].value_at((lows[i] + highs[i]) // 2)
+        if value is None:
+            return None
+        ranks = [run.rank(value) for run in runs]
+        n = sum(ranks)
+        if n == position:
+            return value
+        for j in range(len(runs)):
+            if n < position:
+                lows[j] = max(lows[j], ranks[j] + (1 if j == i else 0))
+            else:
+                highs[j] = min(highs[j], ranks[j])
+
+class CompactResourceTable(DictMixin):
+    """Dictionary view (basename -> {'timestamp': ...}) of the resources of
+    a CompactRepository; compressed basenames map to bare float timestamps
+    and are kept in a SortedIndex. Derived GetRecord URIs are not stored,
+    their timestamp is the one of the resource of the identifier."""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.uris = repository.uris
+        self.timestamps = {} # {compressed basename: timestamp}
+        self.index = SortedIndex() # compressed basenames
+
+    def identifier(self, basename):
+        """Returns the identifier if basename is a derived GetRecord URI"""
+        prefix = self.repository.metadata_uri_prefix
+        if prefix is not None and basename.startswith(prefix):
+            return basename[len(prefix):]
+        return None
+
+    def timestamp(self, basename):
+        key = self.uris.compress(basename, add=False)
+        if key is None:
+            return None
+        return self.timestamps.get(key)
+
+    def compress(self, basename):
+        """Returns the compressed basename, the stored object if basename is
+        a resource, so that other tables can share it"""
+        key = self.uris.compress(basename)
+        return self.index.get(key, key)
+
+    def __getitem__(self, basename):
+        identifier = self.identifier(basename)
+        if identifier is not None:
+            try:
+                return self[self.repository.identifiers[identifier]]
+            except KeyError:
+                raise KeyError(basename)
+        timestamp = self.timestamp(basename)
+        if timestamp is None:
+            raise KeyError(basename)
+        return {'timestamp': timestamp}
+
+    def __setitem__(self, basename, value):
+        if self.identifier(basename) is not None:
+            return # derived from the resource of the identifier
+        key = self.uris.compress(basename)
+        if key not in self.timestamps:
+            self.index.add(key)
+        self.timestamps[key] = float(value['timestamp'])
+
+    def __delitem__(self, basename):
+        identifier = self.identifier(basename)
+        if identifier is not None:
+            if identifier not in self.repository.identifiers:
+                raise KeyError(basename)
+            return # disappears with the identifier
+        key = self.uris.compress(basename, add=False)
+        if key is None or key not in self.timestamps:
+            raise KeyError(basename)
+        del self.timestamps[key]
+        self.index.discard(key)
+
+    def __contains__(self, basename):
+        identifier = self.identifier(basename)
+        if identifier is not None:
+            return identifier in self.repository.identifiers
+        return self.timestamp(basename) is not None
+
+    def has_key(self, basename):
+        return basename in self
+
+    def __len__(self):
+        if self.repository.metadata_uri_prefix is None:
+            return len(self.timestamps)
+        return len(self.timestamps) + len(self.repository.identifiers)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        """Iterates over the basenames followed by the derived GetRecord
+        URIs; the table may be modified while iterating"""
+        for key in self.index:
+            yield self.uris.decompress(key)
+        prefix = self.repository.metadata_uri_prefix
+        if prefix is not None:
+            for identifier in self.repository.identifiers.keys():
+                yield prefix + identifier
+
+    def keys(self):
+        return list(self.iterkeys())
+
+class CompactIdentifierTable(DictMixin):
+    """Dictionary view (identifier -> basename) of the identifiers of a
+    CompactRepository; both are stored compressed, basenames of resources
+    are shared with the resource table"""
+
+    def __init__(self, repository):
+        self.uris = repository.uris
+        self.resources = repository.resources
+        self.identifiers = PrefixCompressor(':', 2)
+        self.basenames = {} # {compressed identifier: compressed basename}
+        self.index = SortedIndex() # compressed identifiers
+
+    def __getitem__(self, identifier):
+        key = self.identifiers.compress(identifier, add=False)
+        if key is None or key not in self.basenames:
+            raise KeyError(identifier)
+        return self.uris.decompress(self.basenames[key])
+
+    def __setitem__(self, identifier, basename):
+        key = self.identifiers.compress(identifier)
+        if key not in self.basenames:
+            self.index.add(key)
+        self.basenames[key] = self.resources.compress(basename)
+
+    def __delitem__(self, identifier):
+        key = self.identifiers.compress(identifier, add=False)
+        if key is None or key not in self.basenames:
+            raise KeyError(identifier)
+        del self.basenames[key]
+        self.index.discard(key)
+
+    def __contains__(self, identifier):
+        key = self.identifiers.compress(identifier, add=False)
+        return key is not None and key in self.basenames
+
+    def has_key(self, identifier):
+        return identifier in self
+
+    def __len__(self):
+        return len(self.basenames)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [self.identifiers.decompress(key)
+                                        for key in self.basenames.keys()]
+
+class SQLiteRepository(Repository):
+    """A repository stored in a sqlite3 database file. Writes are collected
+    in transactions of at most batch_size changes; commit() ends the
+    current transaction early, e.g. after each harvested page."""
+
+    persistent = True
+
+    def __init__(self, config):
+        super(SQLiteRepository, self).__init__(config)
+        self.logger = logging.getLogger('repository')
+        self.path = config['path']
+        self.batch_size = config.get('batch_size', 1000)
+        self.pending = 0 # number of uncommitted changes
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS resources "
+                        "(basename TEXT PRIMARY KEY, timestamp REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS identifiers "
+                        "(identifier TEXT PRIMARY KEY, basename TEXT)")
+        self.db.commit()
+        self.resources = SQLiteTable(self, "resources", "basename",
+                        "timestamp", lambda timestamp: {'timestamp': timestamp},
+                        lambda value: value['timestamp'])
+        self.identifiers = SQLiteTable(self, "identifiers", "identifier",
+                                       "basename")
+        self.logger.info("Opened repository %s with %d resources" %
+                                            (self.path, len(self.resources)))
+
+    def basenames(self):
+        """Iterates over the basenames in sorted order, fetching them in
+        chunks, so the set of basenames never has to fit into memory"""
+        return self.resources.iterkeys()
+
+    def sorted_basenames_from(self, first=None):
+        return self.resources.iterkeys(first=first)
+
+    def sorted_basenames(self, start=0, stop=None):
+        """Iterates over a slice of the sorted basenames; only the slice is
+        read from the database, in chunks"""
+        return self.resources.iterkeys(start, stop)
+
+    def query(self, sql, args=()):
+        """Executes a query and returns all result rows"""
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def update(self, sql, args=()):
+        """Executes a change and returns the number of affected rows;
+        commits after batch_size changes"""
+        with self.lock:
+            rowcount = self.db.execute(sql, args).rowcount
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.commit()
+            return rowcount
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+
+class SQLiteTable(DictMixin):
+    """Dictionary view of a two column table of a SQLiteRepository"""
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, repository, table, key_column, value_column,
+                 from_db=None, to_db=None):
+        self.repository = repository
+        self.table = table
+        self.key_column = key_column
+        self.value_column = value_column
+        self.from_db = from_db
+        self.to_db = to_db
+        self.count = repository.query("SELECT COUNT(*) FROM %s" %
+                                                    table)[0][0]
+
+    def __getitem__(self, key):
+        rows = self.repository.query("SELECT %s FROM %s WHERE %s=?" %
+                (self.value_column, self.table, self.key_column), (key,))
+        if len(rows) == 0:
+            raise KeyError(key)
+        if self.from_db is not None:
+            return self.from_db(rows[0][0])
+        return rows[0][0]
+
+    def __setitem__(self, key, value):
+        if self.to_db is not None:
+            value = self.to_db(value)
+        with self.repository.lock:
+            updated = self.repository.update("UPDATE %s SET %s=? WHERE %s=?" %
+                    (self.table, self.value_column, self.key_column),
+                    (value, key))
+            if updated == 0:
+                self.repository.update("INSERT INTO %s (%s, %s) VALUES (?, ?)" %
+                    (self.table, self.key_column, self.value_column),
+                    (key, value))
+                self.count += 1
+
+    def __delitem__(self, key):
+        with self.repository.lock:
+            deleted = self.repository.update("DELETE FROM %s WHERE %s=?" %
+                    (self.table, self.key_column), (key,))
+            if deleted == 0:
+                raise KeyError(key)
+            self.count -= 1
+
+    def __contains__(self, key):
+        return len(self.repository.query("SELECT 1 FROM %s WHERE %s=?" %
+                (self.table, self.key_column), (key,))) > 0
+
+    def has_key(self, key):
+        return key in self
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self, start=0, stop=None, first=None):
+        """Iterates over the keys in sorted order (from position start to
+        stop of the keys from first on), CHUNK_SIZE keys per query"""
+        last = None
+        remaining = stop - start if stop is not None else None
+        while remaining is None or remaining > 0:
+            limit = self.CHUNK_SIZE
+            if remaining is not None:
+                limit = min(limit, remaining)
+            if last is None and first is None:
+                rows = self.repository.query(
+                        "SELECT %s FROM %s ORDER BY %s LIMIT ? OFFSET ?" %
+                        (self.key_column, self.table, self.key_column),
+                        (limit, start))
+            elif last is None:
+                rows = self.repository.query(
+                        "SELECT %s FROM %s WHERE %s>=? ORDER BY %s "
+                        "LIMIT ? OFFSET ?" % (self.key_column, self.table,
+                        self.key_column, self.key_column),
+                        (first, limit, start))
+            else:
+                rows = self.repository.query(
+                        "SELECT %s FROM %s WHERE %s>? ORDER BY %s LIMIT ?" %
+                        (self.key_column, self.table, self.key_column,
+                         self.key_column), (last, limit))
+            for row in rows:
+                yield row[0]
+            if len(rows) < limit:
+                return
+            last = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def keys(self):
+        return list(self.iterkeys())
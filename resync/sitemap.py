@@ -3,6 +3,8 @@
 import re
 import os
 import sys
+import gzip
+import zlib
 import logging
 from urllib import URLopener
 from xml.etree.ElementTree import ElementTree, Element, parse, tostring
@@ -52,6 +54,7 @@ class Sitemap(object):
         self.allow_multifile=allow_multifile
         self.mapper=mapper
         self.max_sitemap_entries=50000
+        self.gzip=False # write gzip compressed sitemaps
         # Classes used when parsing
         self.inventory_class=Inventory
         self.resource_class=Resource
@@ -84,6 +87,11 @@ class Sitemap(object):
         be written as one sitemap. If there are more entries and 
         self.allow_multifile is set true then a set of sitemap files, 
         with an sitemapindex, will be written.
+
+        If self.gzip is set true then the sitemap files of a sitemapindex 
+        are written gzip compressed as .xml.gz files and a compressed copy 
+        basename.gz of the sitemap or sitemapindex is written next to it, 
+        e.g. for servers which send precompressed files.
         """
         # Access resources trough iterator only
         resources_iter = iter(resources)
@@ -95,6 +103,8 @@ class Sitemap(object):
             # Work out how to name the sitemaps, attempt to add %05d before ".xml$", else append
             sitemap_prefix = basename
             sitemap_suffix = '.xml'
+            if (self.gzip):
+                sitemap_suffix = '.xml.gz'
             if (basename[-4:] == '.xml'):
                 sitemap_prefix = basename[:-4]
             # Use iterator over all resources and count off sets of
@@ -104,26 +114,35 @@ class Sitemap(object):
             while (len(chunk)>0):
                 file = sitemap_prefix + ( "%05d" % (len(sitemaps)) ) + sitemap_suffix
                 self.logger.info("Writing sitemap %s..." % (file))
-                f = open(file, 'w')
-                f.write(self.resources_as_xml(chunk,changeset=changeset))
-                f.close()
+                self.write_file(file, self.resources_as_xml(chunk,changeset=changeset))
                 # Record timestamp
                 sitemaps[file] = os.stat(file).st_mtime
                 # Get next chunk
                 ( chunk, next ) = self.get_resources_chunk(resources_iter,next)
             self.logger.info("Wrote %d sitemaps" % (len(sitemaps)))
-            f = open(basename, 'w')
             self.logger.info("Writing sitemapindex %s..." % (basename))
-            f.write(self.sitemapindex_as_xml(sitemaps=sitemaps,inventory=resources,capabilities=resources.capabilities,changeset=changeset))
-            f.close()
+            self.write_file(basename, self.sitemapindex_as_xml(sitemaps=sitemaps,inventory=resources,capabilities=resources.capabilities,changeset=changeset), precompress=self.gzip)
             self.logger.info("Wrote sitemapindex %s" % (basename))
         else:
-            f = open(basename, 'w')
             self.logger.info("Writing sitemap %s..." % (basename))
-            f.write(self.resources_as_xml(chunk,capabilities=resources.capabilities,changeset=changeset))
-            f.close()
+            self.write_file(basename, self.resources_as_xml(chunk,capabilities=resources.capabilities,changeset=changeset), precompress=self.gzip)
             self.logger.info("Wrote sitemap %s" % (basename))
 
+    def write_file(self, file, xml, precompress=False):
+        """Write xml to file, gzip compressed if the name ends with .gz
+
+        If precompress is set true then a compressed copy file.gz is 
+        written as well.
+        """
+        if (file[-3:] == '.gz'):
+            f = gzip.open(file, 'wb')
+        else:
+            f = open(file, 'w')
+        f.write(xml)
+        f.close()
+        if (precompress and file[-3:] != '.gz'):
+            self.write_file(file + '.gz', xml)
+
     def get_resources_chunk(self, resource_iter, first=None):
         """Return next chunk of resources from resource_iter, and next item
         
@@ -182,7 +201,7 @@ class Sitemap(object):
             self.logger.debug( "Read ????? bytes from %s" % (uri) )
             pass
         self.logger.info( "Read sitemap/sitemapindex from %s" % (uri) )
-        etree = parse(fh)
+        etree = parse(self.decompressed(fh))
         # check root element: urlset (for sitemap), sitemapindex or bad
         self.sitemaps_created=0
         root = etree.getroot()
@@ -246,12 +265,20 @@ class Sitemap(object):
                     # If we don't get a length then c'est la vie
                     pass
                 self.logger.info( "Read sitemap from %s (%d)" % (sitemap_uri,self.content_length) )
-                sitemap_xml_parser( fh=fh, resources=resources )
+                sitemap_xml_parser( fh=self.decompressed(fh), resources=resources )
                 self.sitemaps_created+=1
         else:
             raise ValueError("XML read from %s is not a sitemap or sitemapindex" % (uri))
         return(resources)
 
+    def decompressed(self, fh):
+        """Return a file handle to the content of fh, uncompressed if fh 
+        is gzip compressed (e.g. a .xml.gz sitemap)"""
+        data = fh.read()
+        if (data[:2] == '\x1f\x8b'):
+            data = zlib.decompress(data, 16+zlib.MAX_WBITS)
+        return(StringIO.StringIO(data))
+
     ##### Resource methods #####
 
     def resource_etree_element(self, resource, element_name='url'):
@@ -385,6 +412,42 @@ class Sitemap(object):
         If num_resources is not None then only that number will be written
         before exiting.
         """
+        root = self.urlset_etree(capabilities, changeset)
+        # now add the entries from either an iterable or an iterator
+        for r in resources:
+            e=self.resource_etree_element(r)
+            root.append(e)
+            if (num_resources is not None):
+                num_resources-=1
+                if (num_resources==0):
+                    break
+        # have tree, now serialize
+        return(self.etree_as_xml(root))
+
+    def resources_as_xml_chunks(self, resources, capabilities=None, changeset=False, chunk_size=1000):
+        """Iterate over the XML of a sitemap for a set of resources in pieces
+
+        Yields the XML declaration and the opening urlset element, then
+        the url elements of chunk_size resources at a time and finally
+        the closing tag, so that a sitemap can be sent while it is
+        generated. The pieces add up to the output of resources_as_xml.
+        """
+        root = self.urlset_etree(capabilities, changeset)
+        root.append(Element('chunks'))
+        (header, footer) = self.etree_as_xml(root).split('<chunks />')
+        yield header
+        chunk = []
+        for r in resources:
+            chunk.append(tostring(self.resource_etree_element(r), encoding='utf-8'))
+            if (len(chunk)>=chunk_size):
+                yield ''.join(chunk)
+                chunk = []
+        if (len(chunk)>0):
+            yield ''.join(chunk)
+        yield footer
+
+    def urlset_etree(self, capabilities=None, changeset=False):
+        """Return the urlset root element of a sitemap without entries"""
         # will include capabilities if allowed and if there are some
         namespaces = { 'xmlns': SITEMAP_NS, 'xmlns:rs': RS_NS }
         if ( capabilities is not None and len(capabilities)>0 ):
@@ -396,15 +459,10 @@ class Sitemap(object):
             root.text="\n"
         if ( capabilities is not None and len(capabilities)>0 ):
             self.add_capabilities_to_etree(root,capabilities)
-        # now add the entries from either an iterable or an iterator
-        for r in resources:
-            e=self.resource_etree_element(r)
-            root.append(e)
-            if (num_resources is not None):
-                num_resources-=1
-                if (num_resources==0):
-                    break
-        # have tree, now serialize
+        return(root)
+
+    def etree_as_xml(self, root):
+        """Serialize an element as UTF-8 XML document"""
         tree = ElementTree(root);
         xml_buf=StringIO.StringIO()
         if (sys.version_info < (2,7)):
@@ -512,12 +570,16 @@ class Sitemap(object):
             root.text="\n"
         if (include_capabilities):
             self.add_capabilities_to_etree(root,capabilities)
-        for file in sitemaps.keys():
-            try:
-                uri = self.mapper.dst_to_src(file)
-            except MapperError:
-                uri = 'file://'+file
-                self.logger.error("sitemapindex: can't map %s into URI space, writing %s" % (file,uri))
+        for file in sorted(sitemaps.keys()):
+            if (self.mapper is None):
+                # Already the URI of the sitemap
+                uri = file
+            else:
+                try:
+                    uri = self.mapper.dst_to_src(file)
+                except MapperError:
+                    uri = 'file://'+file
+                    self.logger.error("sitemapindex: can't map %s into URI space, writing %s" % (file,uri))
             # Make a Resource for the Sitemap and serialize
             smr = Resource( uri=uri, timestamp=sitemaps[file] )
             root.append( self.resource_etree_element(smr, element_name='sitemap') )
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+snapshot.py: Point-in-time views of the resources of a repository
+
+The harvester changes the resources of a repository while inventories are
+generated from them in other threads. A reader takes a Snapshot, which
+reads the repository directly; before a resource is changed, its previous
+value is saved in all open snapshots (copy-on-write), so that readers see
+the resources as they were when the snapshot was taken. Changes which are
+not yet committed, e.g. the first records of a ListRecords page, are
+treated as if they had happened after the snapshot. Readers never lock the
+repository and the memory of a snapshot grows only with the changes made
+while it is open.
+"""
+
+import heapq
+import threading
+
+class Snapshots(object):
+    """Keeps the snapshots of a repository which are open"""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.lock = threading.Lock()
+        self.snapshots = [] # open snapshots
+        # values of the resources changed since the last commit, before
+        # their first change; None if a resource did not exist
+        self.pending = {}
+
+    def value(self, basename):
+        """The current value of a resource, None if it does not exist"""
+        try:
+            return self.repository.resources[basename]
+        except KeyError:
+            return None
+
+    def before_change(self, basename):
+        """Saves the value of a resource which is about to be created,
+        updated or deleted for the open snapshots"""
+        with self.lock:
+            if basename in self.pending:
+                return
+            value = self.value(basename)
+            self.pending[basename] = value
+            for snapshot in self.snapshots:
+                snapshot.save(basename, value)
+
+    def commit(self):
+        """Marks the current state of the repository as consistent; the
+        changes so far are seen by snapshots taken from now on"""
+        with self.lock:
+            self.pending = {}
+
+    def snapshot(self):
+        """Takes a snapshot of the last committed state; it must be
+        released when it is no longer read"""
+        with self.lock:
+            snapshot = Snapshot(self, self.pending)
+            self.snapshots.append(snapshot)
+            return snapshot
+
+    def release(self, snapshot):
+        with self.lock:
+            if snapshot in self.snapshots:
+                self.snapshots.remove(snapshot)
+
+class Snapshot(object):
+    """The resources of a repository at some point in time"""
+
+    def __init__(self, snapshots, saved):
+        self.snapshots = snapshots
+        self.saved = dict(saved) # {basename: value at the snapshot or None}
+        # saved resources the sorted iteration has not passed yet
+        self.missing = [basename for (basename, value) in saved.items()
+                        if value is not None]
+        heapq.heapify(self.missing)
+        self.position = None # last basename of the sorted iteration
+        self.iterated = False
+        self.read_to = None # end of the last range read
+
+    def save(self, basename, value):
+        """Saves the value of a resource before its first change after the
+        snapshot; called with the lock of the snapshots held"""
+        if basename in self.saved:
+            return
+        self.saved[basename] = value
+        if value is not None and (self.position is None or
+                                  basename > self.position):
+            heapq.heappush(self.missing, basename)
+
+    def get(self, basename):
+        """The value of a resource at the snapshot, None if it did not
+        exist"""
+        value = self.snapshots.value(basename)
+        # saved before the resource is changed, so checked after reading it
+        if basename in self.saved:
+            return self.saved[basename]
+        return value
+
+    def basenames(self, first=None, stop=None):
+        """Iterates over the basenames at the snapshot from first to
+        before stop (from the first to the last if None) in sorted order;
+        a snapshot is read only once, in ascending ranges"""
+        if self.iterated or (self.read_to is not None and
+                             (first is None or first < self.read_to)):
+            raise RuntimeError("Snapshot has already been iterated over")
+        if stop is None:
+            self.iterated = True
+        else:
+            self.read_to = stop
+        if first is not None:
+            self.pop_missing(first) # in ranges which are not read
+        seen = set() # saved basenames already yielded
+        for basename in \
+                self.snapshots.repository.sorted_basenames_from(first):
+            if stop is not None and basename >= stop:
+                break
+            for missing in self.pop_missing(basename):
+                if missing not in seen:
+                    seen.add(missing)
+                    yield missing
+            self.position = basename
+            if basename in self.saved:
+                if self.saved[basename] is None or basename in seen:
+                    continue
+                seen.add(basename)
+            yield basename
+        for missing in self.pop_missing(stop):
+            if missing not in seen:
+                seen.add(missing)
+                yield missing
+
+    def changed(self):
+        """The basenames changed since the snapshot, or not committed when
+        it was taken"""
+        with self.snapshots.lock:
+            return self.saved.keys()
+
+    def pop_missing(self, before):
+        """Removes and returns the missing basenames sorting before a
+        basename (all if it is None)"""
+        missing = []
+        while self.missing and (before is None or self.missing[0] < before):
+            with self.snapshots.lock:
+                if self.missing and (before is None or
+                                     self.missing[0] < before):
+                    missing.append(heapq.heappop(self.missing))
+        return missing
+
+    def sorted_basenames(self, start=0, stop=None):
+        """Iterates over the basenames from position start to stop of the
+        sorted basenames at the snapshot; seeks to the slice by position in
+        the repository and corrects the position by the resources created
+        or deleted since the snapshot, so only they and the slice are read"""
+        repository = self.snapshots.repository
+        with self.snapshots.lock:
+            saved = self.saved.items()
+        # (basename, whether it existed at the snapshot)
+        changed = [(basename, value is not None)
+                   for (basename, value) in saved
+                   if (value is None) != (self.snapshots.value(basename) is None)]
+        first = None
+        position = 0 # of first at the snapshot
+        offset = min(start - len(changed), len(repository.resources) - 1)
+        if offset > 0:
+            for first in repository.sorted_basenames(offset, offset + 1):
+                position = offset + sum((1 if existed else -1)
+                                        for (basename, existed) in changed
+                                        if basename < first)
+        # a change made while seeking may shift the slice, just like a
+        # change between the requests of two slices does
+        position = min(position, start)
+        for (i, basename) in enumerate(self.basenames(first), position):
+            if stop is not None and i >= stop:
+                return
+            if i >= start:
+                yield basename
+
+    def release(self):
+        self.snapshots.release(self)
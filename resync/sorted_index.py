@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+sorted_index.py: A set of keys which is kept sorted while it changes
+
+Keys are stored in blocks, each a sorted list of at most 2*BLOCK_SIZE keys,
+so a key is added or removed by a bisection and an insert into one short
+list instead of sorting all keys again. Iteration reads one block at a
+time and continues after the last key read, so the index may be changed
+while it is iterated over; keys which are neither added nor removed in the
+meantime are always seen.
+"""
+
+import bisect
+import threading
+
+class SortedIndex(object):
+    """A sorted set of keys in blocks"""
+
+    BLOCK_SIZE = 1000
+
+    def __init__(self, keys=()):
+        self.lock = threading.Lock()
+        self.blocks = [] # sorted lists of keys
+        self.maxes = [] # the last key of each block
+        self.count = 0
+        keys = sorted(set(keys))
+        for i in range(0, len(keys), self.BLOCK_SIZE):
+            self.blocks.append(keys[i:i + self.BLOCK_SIZE])
+            self.maxes.append(self.blocks[-1][-1])
+        self.count = len(keys)
+
+    def locate(self, key):
+        """The block a key belongs into and its position in the block"""
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            i -= 1
+        return (i, bisect.bisect_left(self.blocks[i], key))
+
+    def add(self, key):
+        with self.lock:
+            if self.count == 0:
+                self.blocks = [[key]]
+                self.maxes = [key]
+                self.count = 1
+                return
+            (i, j) = self.locate(key)
+            block = self.blocks[i]
+            if j < len(block) and block[j] == key:
+                return
+            block.insert(j, key)
+            self.maxes[i] = block[-1]
+            self.count += 1
+            if len(block) > 2 * self.BLOCK_SIZE:
+                half = len(block) // 2
+                self.blocks[i:i + 1] = [block[:half], block[half:]]
+                self.maxes[i:i + 1] = [block[half - 1], block[-1]]
+
+    def discard(self, key):
+        with self.lock:
+            if self.count == 0:
+                return
+            (i, j) = self.locate(key)
+            block = self.blocks[i]
+            if j == len(block) or block[j] != key:
+                return
+            del block[j]
+            self.count -= 1
+            if len(block) == 0:
+                del self.blocks[i]
+                del self.maxes[i]
+            else:
+                self.maxes[i] = block[-1]
+
+    def __contains__(self, key):
+        with self.lock:
+            if self.count == 0:
+                return False
+            (i, j) = self.locate(key)
+            return j < len(self.blocks[i]) and self.blocks[i][j] == key
+
+    def get(self, key, default=None):
+        """The stored key equal to key, so that it can be shared"""
+        with self.lock:
+            if self.count == 0:
+                return default
+            (i, j) = self.locate(key)
+            if j < len(self.blocks[i]) and self.blocks[i][j] == key:
+                return self.blocks[i][j]
+            return default
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.iter_from()
+
+    def iter_from(self, key=None):
+        """Iterates over the keys from key (the first one if None) on in
+        sorted order"""
+        inclusive = True
+        while True:
+            with self.lock:
+                if key is None:
+                    chunk = self.blocks[0][:] if self.blocks else []
+                else:
+                    search = bisect.bisect_left if inclusive else \
+                                                        bisect.bisect_right
+                    i = search(self.maxes, key)
+                    if i == len(self.maxes):
+                        return
+                    chunk = self.blocks[i][search(self.blocks[i], key):]
+            if len(chunk) == 0:
+                return
+            for k in chunk:
+                yield k
+            key = chunk[-1]
+            inclusive = False
+
+    def rank(self, key):
+        """The number of keys less than key"""
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, key)
+            n = sum(len(self.blocks[j]) for j in xrange(i))
+            if i < len(self.blocks):
+                n += bisect.bisect_left(self.blocks[i], key)
+            return n
+
+    def key_at(self, position):
+        """The key at a position of the sorted keys, None if there are
+        fewer keys"""
+        with self.lock:
+            for block in self.blocks:
+                if position < len(block):
+                    return block[position]
+                position -= len(block)
+        return None
+
+    def islice(self, start=0, stop=None):
+        """Iterates over the keys from position start to stop"""
+        first = self.key_at(start)
+        if first is None:
+            return
+        for (n, key) in enumerate(self.iter_from(first)):
+            if stop is not None and start + n >= stop:
+                return
+            yield key
+
+class SortedKeyDict(dict):
+    """A dict which keeps its keys in a SortedIndex; iterates over the keys
+    in sorted order"""
+
+    def __init__(self, *args, **kwargs):
+        super(SortedKeyDict, self).__init__(*args, **kwargs)
+        self.index = SortedIndex(dict.keys(self))
+
+    def __setitem__(self, key, value):
+        if not dict.__contains__(self, key):
+            self.index.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.index.discard(key)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def iterkeys(self):
+        return iter(self.index)
+
+    def pop(self, key, *default):
+        value = dict.pop(self, key, *default)
+        self.index.discard(key)
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self.index = SortedIndex()
@@ -18,22 +18,31 @@ import pprint
 import logging
 import time
 import shutil
+import sys
+import threading
+import Queue
+import bisect
 
 import tornado.ioloop
 import tornado.web
 
 from apscheduler.scheduler import Scheduler
 
-from resync.observer import Observable
+from resync.observer import Observable, Observer
 from resync.resource_change import ResourceChange
 from resync.resource import Resource
 from resync.digest import compute_md5_for_string
 from resync.inventory import Inventory
-from resync.sitemap import Sitemap, Mapper
+from resync.sitemap import Sitemap, SitemapIndex, Mapper
+from resync.checkpoint import HarvestCheckpoint
+from resync.repository import Repository
+from resync.snapshot import Snapshots
 
 ##oai imports
 from oaipmh.oai import Client, Header, Record, NoRecordsException
 from oaipmh.common import Common
+from oaipmh.urlcheck import UrlChecker
+from oaipmh import connection
 import datetime
 from urllib2 import URLError
 from dateutil import parser as dateutil_parser
@@ -43,12 +52,14 @@ import socket
 #### Source-specific capability implementations ####
 
 class DynamicInventoryBuilder(object):
-    """Generates an inventory snapshot from a source"""
+    """Generates an inventory snapshot from a source; a sitemapindex and its
+    sitemaps if the source has more than max_sitemap_entries resources"""
     
     def __init__(self, source, config):
         self.source = source
         self.config = config
         self.logger = logging.getLogger('inventory_builder')
+        self.max_sitemap_entries = config.get('max_sitemap_entries', 50000)
         
     def bootstrap(self):
         """Bootstrapping procedures implemented in subclasses"""
@@ -64,28 +75,87 @@ class DynamicInventoryBuilder(object):
         """The inventory URI (e.g., http://localhost:8080/sitemap.xml)"""
         return self.source.base_uri + "/" + self.path
     
-    def generate(self):
-        """Generates an inventory (snapshot from the source)"""
-        then = time.time()
+    @property
+    def sitemap_count(self):
+        """The number of sitemaps of the inventory, 1 if it fits into a
+        single sitemap"""
+        return max(1, (self.source.resource_count +
+                       self.max_sitemap_entries - 1) // self.max_sitemap_entries)
+    
+    def sitemap_path(self, n):
+        """The path of the n-th sitemap of the sitemapindex (e.g.,
+        sitemap00000.xml)"""
+        prefix = self.path
+        if prefix.endswith('.xml'):
+            prefix = prefix[:-4]
+        return "%s%05d.xml" % (prefix, n)
+    
+    def capabilities(self):
         capabilities = {}
         if self.source.has_changememory:
             next_changeset = self.source.changememory.next_changeset_uri()
             capabilities[next_changeset] = {"rel": "next http://www.openarchives.org/rs/changeset"}
+        return capabilities
+    
+    def generate(self):
+        """Generates an inventory (snapshot from the source)"""
+        then = time.time()
         inventory = Inventory(resources=self.source.resources,
-                              capabilities=capabilities)
+                              capabilities=self.capabilities())
         now = time.time()
         self.logger.info("Generated inventory: %f" % (now-then))
         return inventory
+    
+    def generate_index(self):
+        """Generates the sitemapindex of the sitemaps of the inventory"""
+        index = SitemapIndex(capabilities=self.capabilities())
+        for n in range(self.sitemap_count):
+            index.add(Resource(self.source.base_uri + "/" +
+                               self.sitemap_path(n)))
+        return index
+    
+    def generate_sitemap(self, n):
+        """Generates the n-th sitemap of the inventory; only its resources,
+        a slice of the resources sorted by URI, are looked up"""
+        start = n * self.max_sitemap_entries
+        return Inventory(resources=self.source.sorted_resources(start,
+                                        start + self.max_sitemap_entries),
+                         capabilities=self.capabilities())
         
-class StaticInventoryBuilder(DynamicInventoryBuilder):
-    """Periodically writes an inventory to the file system"""
+class StaticInventoryBuilder(DynamicInventoryBuilder, Observer):
+    """Periodically writes an inventory to the file system. The sitemaps of
+    a sitemapindex each cover a fixed range of URIs (a chunk); only the
+    chunks in which resources changed since the last run are written again,
+    together with the sitemapindex. A chunk which grows beyond
+    max_sitemap_entries is split, an empty one is dropped.
+
+    Each run writes a complete generation of the files into a directory of
+    its own, sharing the unchanged sitemaps with the previous one through
+    hard links, and publishes it by switching a symbolic link, so clients
+    never see a mix of generations."""
     
     def __init__(self, source, config):
         super(StaticInventoryBuilder, self).__init__(source, config)
+        self.gzip = config.get('gzip', False)
+        # [[first URI, sitemap number]] sorted by URI, the first chunk
+        # starting at ""; None until the inventory has been written
+        self.chunks = None
+        self.next_sitemap = 0
+        # every run which changes the inventory writes a new generation
+        # directory; the link current_path points to the one served
+        self.generation = 0
+        self.current = None # directory of the current generation
+        self.generation_grace = config.get('generation_grace', 60)
+        self.retired = [] # [(time replaced, directory)]
+        self.retired_lock = threading.Lock()
+        self.dirty = set() # URIs changed since the last run
+        self.dirty_lock = threading.Lock()
+        source.register_observer(self)
                                 
     def bootstrap(self):
         """Bootstraps the static inventory writer background job"""
         self.rm_sitemap_files(Source.STATIC_FILE_PATH)
+        self.rm_generations()
         self.write_static_inventory()
         logging.basicConfig()
         interval = self.config['interval']
@@ -94,40 +164,55 @@ class StaticInventoryBuilder(DynamicInventoryBuilder):
         sched.add_interval_job(self.write_static_inventory,
                                 seconds=interval)
     
-    def generate(self):
-        """Generates an inventory (snapshot from the source)
-        TODO: remove as soon as resource container _len_ is fixed"""
+    def notify(self, change):
+        self.notify_batch([change])
+    
+    def notify_batch(self, changes):
+        """Marks the chunks of the changed resources for the next run"""
+        with self.dirty_lock:
+            self.dirty.update(change.uri for change in changes
+                              if change.uri != self.uri)
+    
+    def capabilities(self):
         capabilities = {}
         if self.source.has_changememory:
             next_changeset = self.source.changememory.next_changeset_uri()
             capabilities[next_changeset] = {"type": "changeset"}
-        # inventory = Inventory(resources=self.source.resources,
-        #                       capabilities=capabilities)
-        inventory = Inventory(resources=None, capabilities=capabilities)
-        for resource in self.source.resources:
-            if resource is not None: inventory.add(resource)
-        return inventory
+        return capabilities
+    
+    def generate(self):
+        """Generates an inventory (snapshot from the source); the resources
+        are read in sorted order while the sitemaps are written"""
+        return Inventory(resources=self.source.resources,
+                         capabilities=self.capabilities())
     
     def write_static_inventory(self):
-        """Writes the inventory to the filesystem"""
-        # Generate sitemap in temp directory
+        """Writes the changed parts of the inventory (all of it the first
+        time) to the filesystem"""
         then = time.time()
-        self.ensure_temp_dir(Source.TEMP_FILE_PATH)
-        inventory = self.generate()
-        basename = Source.TEMP_FILE_PATH + "/sitemap.xml"
-        s=Sitemap()
-        s.max_sitemap_entries=self.config['max_sitemap_entries']
-        s.mapper=Mapper([self.source.base_uri, Source.TEMP_FILE_PATH])
-        s.write(inventory, basename)
-        # Delete old sitemap files; move the new ones; delete the temp dir
-        self.rm_sitemap_files(Source.STATIC_FILE_PATH)
-        self.mv_sitemap_files(Source.TEMP_FILE_PATH, Source.STATIC_FILE_PATH)
-        shutil.rmtree(Source.TEMP_FILE_PATH)
+        with self.dirty_lock:
+            dirty = self.dirty
+            self.dirty = set()
+        snapshot = self.source.snapshots.snapshot()
+        try:
+            written = self.write_chunks(snapshot, dirty)
+        except:
+            with self.dirty_lock:
+                self.dirty.update(dirty)
+            raise
+        finally:
+            # changes the snapshot does not see are written next time
+            with self.dirty_lock:
+                self.dirty.update(snapshot.changed())
+            snapshot.release()
+        if written == 0:
+            return
         now = time.time()
         # Log Sitemap create start event
-        sitemap_size = self.compute_sitemap_size(Source.STATIC_FILE_PATH)
+        sitemap_size = self.compute_sitemap_size(self.current_path)
         log_data = {'time': (now-then), 
-                    'no_resources': self.source.resource_count}
+                    'no_resources': self.source.resource_count,
+                    'no_sitemaps': written}
         self.logger.info("Wrote static sitemap inventory. %s" % log_data)
         sm_write_end = ResourceChange(
                 resource = ResourceChange(self.uri, 
@@ -135,14 +220,195 @@ class StaticInventoryBuilder(DynamicInventoryBuilder):
                                 timestamp=then),
                                 changetype = "UPDATED")
         self.source.notify_observers(sm_write_end)
-        
-    def ensure_temp_dir(self, temp_dir):
-        """Create temp directory if it doesn't exist; removes existing one"""
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            os.makedirs(temp_dir)
+    
+    def write_chunks(self, snapshot, dirty):
+        """Writes a new generation with the sitemaps of the chunks which
+        contain a dirty URI and publishes it; returns the number of files
+        written"""
+        chunks = self.chunks
+        if chunks is None:
+            chunks = [["", None]]
+            targets = set([0])
         else:
-            os.makedirs(temp_dir)
+            firsts = [chunk[0] for chunk in chunks]
+            targets = set(bisect.bisect_right(firsts, uri) - 1
+                          for uri in dirty)
+        if len(targets) == 0:
+            return 0
+        directory = self.new_generation()
+        try:
+            (chunks, written) = self.write_generation(directory, snapshot,
+                                                      chunks, targets)
+        except:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        self.publish(directory)
+        self.chunks = chunks
+        return written
+    
+    def write_generation(self, directory, snapshot, chunks, targets):
+        """Writes the sitemaps of the target chunks and the sitemap or
+        sitemapindex into directory, the sitemaps of the other chunks are
+        linked from the current generation; returns the new chunks and the
+        number of files written"""
+        s = Sitemap()
+        s.gzip = self.gzip
+        written = 0
+        new_chunks = []
+        held = None # the last piece, not written until it is known
+                    # whether it is the only one
+        for (i, (first, number)) in enumerate(chunks):
+            if i not in targets:
+                new_chunks.append([first, number])
+                continue
+            stop = chunks[i + 1][0] if i + 1 < len(chunks) else None
+            pieces = self.split(self.source.snapshot_resources(snapshot,
+                                                        first or None, stop))
+            for (j, piece) in enumerate(pieces):
+                if held is not None:
+                    self.write_chunk(s, directory, *held)
+                    written += 1
+                if j == 0:
+                    chunk = [first, number]
+                else:
+                    chunk = [piece[0].uri, None]
+                new_chunks.append(chunk)
+                held = (chunk, piece)
+        basename = os.path.join(directory, self.path)
+        if len(new_chunks) == 0 or (len(new_chunks) == 1 and
+                                    held is not None and
+                                    held[0] is new_chunks[0]):
+            # a single sitemap
+            resources = held[1] if held is not None else []
+            self.write_sitemap_file(s, basename, s.resources_as_xml(
+                    resources, capabilities=self.capabilities()))
+            new_chunks = [["", None]]
+        else:
+            if held is not None:
+                self.write_chunk(s, directory, *held)
+                written += 1
+            sitemaps = {}
+            for (first, number) in new_chunks:
+                path = self.sitemap_file(directory, number)
+                if not os.path.exists(path):
+                    self.link_file(self.sitemap_file(self.current, number),
+                                   path)
+                sitemaps[self.source.base_uri + "/" + os.path.basename(path)] = \
+                                                    os.stat(path).st_mtime
+            self.write_sitemap_file(s, basename, s.sitemapindex_as_xml(
+                    sitemaps=sitemaps, capabilities=self.capabilities()))
+        written += 1
+        new_chunks[0][0] = ""
+        return (new_chunks, written)
+    
+    def split(self, resources):
+        """Splits sorted resources into pieces of at most
+        max_sitemap_entries; the last two are balanced, so that a chunk
+        which has grown is split into halves"""
+        size = self.max_sitemap_entries
+        previous = None
+        piece = []
+        for resource in resources:
+            piece.append(resource)
+            if len(piece) == size:
+                if previous is not None:
+                    yield previous
+                previous = piece
+                piece = []
+        if previous is not None and len(piece) > 0:
+            piece = previous + piece
+            half = (len(piece) + 1) // 2
+            yield piece[:half]
+            yield piece[half:]
+        elif previous is not None:
+            yield previous
+        elif len(piece) > 0:
+            yield piece
+    
+    def sitemap_file(self, directory, number):
+        """The file of a sitemap of the sitemapindex"""
+        path = os.path.join(directory, self.sitemap_path(number))
+        if self.gzip:
+            path += ".gz"
+        return path
+    
+    def write_chunk(self, s, directory, chunk, resources):
+        """Writes the sitemap of a chunk, numbering it if it is new"""
+        if chunk[1] is None:
+            chunk[1] = self.next_sitemap
+            self.next_sitemap += 1
+        self.write_sitemap_file(s, self.sitemap_file(directory, chunk[1]),
+                                s.resources_as_xml(resources),
+                                precompress=False)
+    
+    def write_sitemap_file(self, s, path, xml, precompress=None):
+        """Writes a file of a generation; the sitemap or sitemapindex gets
+        a compressed copy if gzip is set"""
+        if precompress is None:
+            precompress = self.gzip
+        s.write_file(path, xml, precompress=precompress)
+    
+    def link_file(self, src, dst):
+        """Shares an unchanged file with the previous generation"""
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    
+    @property
+    def current_path(self):
+        """The link to the directory of the current generation, from which
+        the sitemaps are served"""
+        return os.path.join(Source.STATIC_FILE_PATH, "current")
+    
+    @property
+    def generations_path(self):
+        return os.path.join(Source.STATIC_FILE_PATH, "generations")
+    
+    def new_generation(self):
+        """Creates the directory of the next generation"""
+        path = os.path.join(self.generations_path, "%08d" % self.generation)
+        self.generation += 1
+        os.makedirs(path)
+        return path
+    
+    def publish(self, directory):
+        """Makes a generation the current one by replacing the link to the
+        current generation in a single rename; the previous generation is
+        removed in the background once requests reading it are done"""
+        link = self.current_path + ".tmp"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.relpath(directory, Source.STATIC_FILE_PATH), link)
+        os.rename(link, self.current_path)
+        previous = self.current
+        self.current = directory
+        if previous is not None:
+            with self.retired_lock:
+                self.retired.append((time.time(), previous))
+            collector = threading.Timer(self.generation_grace,
+                                        self.collect_generations)
+            collector.daemon = True
+            collector.start()
+    
+    def collect_generations(self):
+        """Removes the generations which were replaced at least
+        generation_grace seconds ago"""
+        now = time.time()
+        with self.retired_lock:
+            expired = [path for (retired, path) in self.retired
+                       if retired + self.generation_grace <= now]
+            self.retired = [(retired, path) for (retired, path) in
+                    self.retired if retired + self.generation_grace > now]
+        for path in expired:
+            shutil.rmtree(path, ignore_errors=True)
+    
+    def rm_generations(self):
+        """Deletes the generations of previous runs"""
+        if os.path.lexists(self.current_path):
+            os.remove(self.current_path)
+        shutil.rmtree(self.generations_path, ignore_errors=True)
+        self.current = None
     
     def ls_sitemap_files(self, directory):
         """Returns the list of sitemaps in a directory"""
@@ -160,16 +426,6 @@ class StaticInventoryBuilder(DynamicInventoryBuilder):
                 filepath = directory + "/" + f
                 os.remove(filepath)
     
-    def mv_sitemap_files(self, src_directory, dst_directory):
-        """Moves sitemaps from src to dst directory"""
-        filelist = self.ls_sitemap_files(src_directory)
-        if len(filelist) > 0:
-            self.logger.debug("*** Moving %d sitemap files ***" % 
-                                                                len(filelist))
-            for f in filelist:
-                filepath = src_directory + "/" + f
-                shutil.move(filepath, dst_directory)
-    
     def compute_sitemap_size(self, directory):
         """Computes the size of all sitemap files in a given directory"""
         return sum([os.stat(directory + "/" + f).st_size 
@@ -182,7 +438,6 @@ class Source(Observable):
     
     RESOURCE_PATH = "/resources"
     STATIC_FILE_PATH = os.path.join(os.path.dirname(__file__), "static")
-    TEMP_FILE_PATH = os.path.join(os.path.dirname(__file__), "temp")
     
     def __init__(self, config, hostname, port):
         """Initalize the source"""
@@ -193,16 +448,29 @@ class Source(Observable):
         self.hostname = hostname
         self.port = port
         self.max_res_id = 1
-        self._repository = {} # {basename, {timestamp, size}}
         self.inventory_builder = None # The inventory builder implementation
         self.changememory = None # The change memory implementation
         self.no_events = 0
-        self.oaimapping = {} #oai
+        self.add_repository(Repository())
         self.client=None #oai
         self.lastcheckdate=dateutil_parser.parse(config['fromdate'].strftime("%Y-%m-%d %H:%SZ")) #oai
+        self.checkpoint=None # journal of the harvest progress
+        self.batch=None # changes not yet notified while batching
+        self.started=time.time()
+        self.version=0 # increases with every change of the source
+        self.version_lock=threading.Lock()
+        if config.get('checkpoint_file'):
+            self.checkpoint=HarvestCheckpoint(config['checkpoint_file'])
     
     ##### Source capabilities #####
     
+    def add_repository(self, repository):
+        """Sets the repository implementation which stores the resources"""
+        self.repository = repository
+        self._repository = repository.resources # {basename, {timestamp}}
+        self.oaimapping = repository.identifiers #oai {identifier, basename}
+        self.snapshots = Snapshots(repository)
+    
     def add_inventory_builder(self, inventory_builder):
         """Adds an inventory builder implementation"""
         self.inventory_builder = inventory_builder
@@ -244,14 +512,38 @@ class Source(Observable):
     
     @property
     def resources(self):
-        """Iterates over resources and yields resource objects"""
-        for basename in self._repository.keys():
-            resource = self.resource(basename)
-            if resource is None:
-                self.logger.error("Cannot create resource %s " % basename + \
-                      "because source object has been deleted.")
-            else:
+        """Iterates over resources and yields resource objects, sorted by
+        URI, as they were when the iteration started"""
+        return self.sorted_resources()
+    
+    def sorted_resources(self, start=0, stop=None):
+        """Iterates over the resources from position start to stop of the
+        resources sorted by URI; reads a snapshot of the repository, so
+        changes made while iterating are not seen"""
+        snapshot = self.snapshots.snapshot()
+        try:
+            for resource in self._snapshot_resources(snapshot,
+                                    snapshot.sorted_basenames(start, stop)):
                 yield resource
+        finally:
+            snapshot.release()
+    
+    def snapshot_resources(self, snapshot, first=None, stop=None):
+        """Iterates over the resources of a snapshot with URIs from first to
+        before stop, sorted by URI; several ranges of the same snapshot can
+        be read one after the other in ascending order"""
+        return self._snapshot_resources(snapshot,
+                                        snapshot.basenames(first, stop))
+    
+    def _snapshot_resources(self, snapshot, basenames):
+        for basename in basenames:
+            value = snapshot.get(basename)
+            if value is None:
+                self.logger.error("Cannot create resource %s " % 
+                        basename + "because it is not in the snapshot.")
+            else:
+                yield Resource(uri = basename,
+                               timestamp = value['timestamp'])
     
     @property
     def random_resource(self):
@@ -265,10 +557,11 @@ class Source(Observable):
     def resource(self, basename):
         """Creates and returns a resource object from internal resource
         repository. Repositoy values are copied into the object."""
-        if not self._repository.has_key(basename): return None
-        uri = basename
-        timestamp = self._repository[basename]['timestamp']
-        return Resource(uri = uri, timestamp = timestamp)
+        try:
+            timestamp = self._repository[basename]['timestamp']
+        except KeyError:
+            return None
+        return Resource(uri = basename, timestamp = timestamp)
     
     def random_resources(self, number = 1):
         "Return a random set of resources, at most all resources"
@@ -278,63 +571,146 @@ class Source(Observable):
         return [self.resource(basename) for basename in rand_basenames]
     
     
+    def begin_batch(self):
+        """Collects the following changes instead of notifying the
+        observers about each of them"""
+        self.batch=[]
+    
+    def flush_batch(self):
+        """Notifies the observers about the collected changes at once; the
+        changes become visible to new snapshots"""
+        self.snapshots.commit()
+        if self.batch:
+            changes=self.batch
+            self.batch=[]
+            self.notify_observers_batch(changes)
+            self._changed()
+            self.logger.debug("Notified %d changes" % len(changes))
+    
+    def end_batch(self):
+        """Notifies the collected changes and stops collecting"""
+        self.flush_batch()
+        self.batch=None
+    
+    def metadata_uri(self, identifier):
+        """The GetRecord URI of the metadata of an OAI-PMH record"""
+        return self.client.endpoint+"?verb=GetRecord&metadataPrefix=oai_dc&identifier="+identifier
+    
     # Private Methods
     
     def _create_resource(self, basename = None, identifier = None, timestamp=time.time(), notify_observers = True, oai = True):
         """Create a new resource, add it to the source, notify observers."""
+        self.snapshots.before_change(basename)
         self._repository[basename] = {'timestamp': timestamp}
         change = ResourceChange(resource = self.resource(basename),
                                 changetype = "CREATED")
         if notify_observers:
-            self.notify_observers(change)
-            self.logger.debug("Event: %s" % repr(change))
+            self._notify(change)
         # add metadata resource url            
         if oai:
-            self._create_resource(basename=self.client.endpoint+"?verb=GetRecord&metadataPrefix=oai_dc&identifier="+identifier,timestamp=timestamp,notify_observers=notify_observers,oai=False)
-            self.oaimapping[identifier]=basename;
+            self.snapshots.before_change(self.metadata_uri(identifier))
+            self.oaimapping[identifier]=basename
+            self._create_resource(basename=self.metadata_uri(identifier),timestamp=timestamp,notify_observers=notify_observers,oai=False)
+        self._changed()
         
     def _update_resource(self, basename, identifier, timestamp, oai = True):
         """Update a resource, notify observers."""
+        self.snapshots.before_change(basename)
+        if oai:
+            # may be derived from the resource
+            self.snapshots.before_change(self.metadata_uri(identifier))
         self._repository[basename] = {'timestamp': timestamp}
         change = ResourceChange(
                     resource = self.resource(basename),
                     changetype = "UPDATED")
-        self.notify_observers(change)
-        self.logger.debug("Event: %s" % repr(change))
+        self._notify(change)
         # update metadata resource url
         if oai:
-            self._update_resource(self.client.endpoint+"?verb=GetRecord&metadataPrefix=oai_dc&identifier="+identifier,identifier,timestamp,oai=False)
+            self._update_resource(self.metadata_uri(identifier),identifier,timestamp,oai=False)
+        self._changed()
 
     def _delete_resource(self, identifier, timestamp, notify_observers = True, oai = True):
         """Delete a given resource, notify observers."""
         basename=None
         if oai:
             basename=self.oaimapping[identifier]
-            del self.oaimapping[identifier]
             # delete metadata resource url
             self._delete_resource(identifier,timestamp,notify_observers=notify_observers,oai=False)
+            self.snapshots.before_change(self.metadata_uri(identifier))
+            del self.oaimapping[identifier]
         else:
-            basename=self.client.endpoint+"?verb=GetRecord&metadataPrefix=oai_dc&identifier="+identifier
+            basename=self.metadata_uri(identifier)
 
         res = self.resource(basename)
+        self.snapshots.before_change(basename)
         del self._repository[basename]
         res.timestamp = timestamp
         
         if notify_observers:
             change = ResourceChange(resource = res, changetype = "DELETED")
+            self._notify(change)
+        self._changed()
+    
+    def _changed(self):
+        """Increases the version after the resources or the notified changes
+        have changed; responses generated for an older version are stale.
+        Outside of batches every change is visible to new snapshots at
+        once."""
+        if self.batch is None:
+            self.snapshots.commit()
+        self.touch()
+    
+    def touch(self):
+        """Increases the version; called whenever something served changes,
+        e.g. when a change memory publishes a changeset file"""
+        with self.version_lock:
+            self.version+=1
+    
+    def notify_observers(self, event):
+        """Notifies the observers; what they serve changes"""
+        super(Source, self).notify_observers(event)
+        self.touch()
+    
+    def notify_observers_batch(self, events):
+        super(Source, self).notify_observers_batch(events)
+        self.touch()
+    
+    def _notify(self, change):
+        """Notifies the observers about a change or adds it to the batch"""
+        if self.batch is not None:
+            self.batch.append(change)
+        else:
             self.notify_observers(change)
-            self.logger.debug("Event: %s" % repr(change))
+        self.logger.debug("Event: %s" % repr(change))
     
     def bootstrap_oai(self,endpoint): #todo update granularity
         """bootstraps OAI-PMH Source"""
         startdate=self.config['fromdate']
         self.logger.debug("Connecting to OAI-Endpoint %s" % endpoint)
-        self.client=Client(endpoint,self.config['limit'],self.config['checkurl'])
+        connection.configure(self.config.get('max_connections',4),
+                             self.config.get('idle_timeout',30))
+        urlchecker=None
+        if self.config['checkurl']:
+            urlchecker=UrlChecker(self.config.get('checkurl_workers',8),
+                                  self.config.get('checkurl_ttl',3600),
+                                  self.config.get('checkurl_cache_size',100000))
+        self.client=Client(endpoint,self.config['limit'],self.config['checkurl'],
+                           self.config.get('streaming',False),
+                           self.config.get('prefetch',0),
+                           urlchecker)
+        self.repository.metadata_uri_prefix=self.metadata_uri("")
         try:
             no_records=0
-            for i,record in enumerate(self.client.listRecords(startdate,delay=self.config['delay_time'])):
-                no_records+=self.process_record(record,init=True)
-                self.lastcheckdate=record.responseDate()
+            state=self._load_checkpoint()
+            if state is not None:
+                no_records=self.resume_harvest(startdate,state)
+            elif self.config.get('bootstrap_sets',False):
+                no_records=self.bootstrap_sets(startdate)
+            elif self.config.get('bootstrap_workers',1)>1:
+                no_records=self.bootstrap_windows(startdate)
+            else:
+                no_records=self.bootstrap_sequential(startdate)
+            self._save_checkpoint()
             self.logger.info("Finished adding  %d initial resources with checkdate: %s" % ((no_records*2),self.lastcheckdate))
         except URLError, e:
             self.logger.error("URLError: %s" % (e))
@@ -342,6 +718,313 @@ class Source(Observable):
             self.logger.info("No new records found: %s" % e) 
         self.check_for_updates()
 
+    def bootstrap_sequential(self,startdate,rtoken=None,no_records=0):
+        """harvests all records since startdate in a single resumptionToken
+        chain (or the rest of the chain at rtoken); the progress is
+        checkpointed after each page; returns the number of processed records"""
+        progress={'no_records': no_records}
+        def checkpoint(page):
+            self.flush_batch()
+            self._save_checkpoint(page.get('resumptionToken'),
+                                  progress['no_records'],
+                                  startdate,
+                                  page.get('responseDate'))
+        self.begin_batch()
+        try:
+            for i,record in enumerate(self.client.listRecords(startdate,delay=self.config['delay_time'],
+                                        rtoken=rtoken,checkpoint=checkpoint)):
+                progress['no_records']+=self.process_record(record,init=True)
+                self.lastcheckdate=record.responseDate()
+        finally:
+            self.end_batch()
+        return progress['no_records']
+    
+    def resume_harvest(self,startdate,state):
+        """continues the harvest recorded in a checkpoint: at its
+        resumptionToken if the bootstrap was interrupted, if the token has
+        expired, from the from date of the interrupted harvest again (records
+        are not listed in datestamp order, so a later date could skip
+        records); otherwise only the updates since its checkdate are
+        harvested
+        returns the number of processed records"""
+        self.lastcheckdate=state['lastcheckdate']
+        if state.get('partitions') is not None:
+            return self.resume_partitions(startdate,state)
+        rtoken=state.get('resumptionToken')
+        if rtoken is None:
+            self.logger.info("Resuming from checkdate %s" % self.lastcheckdate)
+            return 0
+        self.logger.info("Resuming harvest at resumptionToken %s after %d records" % 
+                                                (rtoken,state['no_records']))
+        afrom=state.get('fromdate') or startdate
+        try:
+            return self.bootstrap_sequential(afrom,rtoken=rtoken,
+                                             no_records=state['no_records'])
+        except NoRecordsException as e:
+            if e.args[0]!='badResumptionToken':
+                raise
+        self.logger.info("resumptionToken expired, harvesting from %s" % afrom)
+        return self.bootstrap_sequential(afrom,no_records=state['no_records'])
+    
+    def resume_partitions(self,startdate,state):
+        """continues an interrupted bootstrap of partitions: the applied
+        partitions are skipped, the partition being applied continues at
+        the resumptionToken, the following ones are harvested again
+        returns the number of processed records"""
+        progress=state['partitions']
+        partitions=progress['partitions']
+        if progress['mode']=='windows':
+            partitions=[(dateutil_parser.parse(window[0]),
+                         window[1] and dateutil_parser.parse(window[1]))
+                        for window in partitions]
+        self.logger.info("Resuming harvest of %s at partition %d of %d after %d records" % 
+                (progress['mode'],progress['applied']+1,len(partitions),
+                 state['no_records']))
+        return self.bootstrap_partitions(progress['mode'],partitions,
+                state.get('fromdate') or startdate,progress['applied'],
+                state.get('resumptionToken'),state['no_records'],
+                state['lastcheckdate'])
+    
+    def _load_checkpoint(self):
+        """returns the harvest progress of a previous run, if a checkpoint
+        file is configured; a checkpoint is only valid together with the
+        resources harvested so far, so it is cleared if the repository does
+        not keep them across restarts"""
+        if self.checkpoint is None:
+            return None
+        if not self.repository.persistent:
+            self.logger.warning("Ignoring checkpoint %s: the repository is "
+                    "not persistent, harvesting everything again" %
+                    self.checkpoint.path)
+            self.checkpoint.clear()
+            self.checkpoint=None
+            return None
+        return self.checkpoint.load()
+    
+    def _save_checkpoint(self,rtoken=None,no_records=0,fromdate=None,checkdate=None,
+                         partitions=None):
+        """commits the repository and records the harvest progress, if a
+        checkpoint file is configured"""
+        self.repository.commit()
+        if self.checkpoint is None:
+            return
+        if checkdate is None:
+            checkdate=self.lastcheckdate
+        self.checkpoint.save(checkdate,rtoken,no_records,fromdate,partitions)
+    
+    def bootstrap_sets(self,startdate):
+        """harvests the records of each (top-level) set of the endpoint,
+        bootstrap_workers sets at a time, and applies them set after set;
+        records which are not part of any set are only harvested if
+        bootstrap_unset_records is set, by a final pass without a set (the
+        records seen before are skipped)
+        falls back to a sequential harvest if the endpoint has no sets
+        returns the number of processed records"""
+        try:
+            setspecs=self.client.topLevelSets()
+        except NoRecordsException as e:
+            setspecs=[]
+            self.logger.info("No sets found: %s" % e)
+        if len(setspecs)==0:
+            return self.bootstrap_sequential(startdate)
+        workers=self.config.get('bootstrap_workers',1)
+        self.logger.info("Harvesting %d sets with %d workers" % 
+                                                    (len(setspecs),workers))
+        if self.config.get('bootstrap_unset_records',False):
+            setspecs=setspecs+[None]
+        return self.bootstrap_partitions('sets',setspecs,startdate)
+    
+    def bootstrap_windows(self,startdate):
+        """harvests startdate..now as from/until windows, bootstrap_workers
+        windows at a time, and applies them window after window
+        returns the number of processed records"""
+        workers=self.config['bootstrap_workers']
+        windows=self.client.dateWindows(startdate,datetime.datetime.utcnow(),
+                                self.config.get('bootstrap_windows',workers))
+        self.logger.info("Harvesting %d date windows with %d workers" % 
+                                                    (len(windows),workers))
+        return self.bootstrap_partitions('windows',windows,startdate)
+    
+    def bootstrap_partitions(self,mode,partitions,startdate,applied=0,rtoken=None,
+                             no_records=0,checkdate=None):
+        """harvests the partitions of a mode ('sets' of startdate or date
+        'windows') from the applied-th one on (the first of them at rtoken)
+        and applies them in order; the progress is checkpointed after each
+        page of the partition being applied
+        returns the number of processed records"""
+        workers=self.config.get('bootstrap_workers',1)
+        delay=self.config['delay_time']
+        def harvest(partition,checkpoint,rtoken=None):
+            if mode=='sets':
+                return self.client.listRecords(startdate,delay=delay,setspec=partition,
+                                               rtoken=rtoken,checkpoint=checkpoint)
+            return self.client.listRecords(partition[0],delay=delay,until=partition[1],
+                                           rtoken=rtoken,checkpoint=checkpoint)
+        stored=partitions
+        if mode=='windows':
+            stored=[[window[0].isoformat(),window[1] and window[1].isoformat()]
+                    for window in partitions]
+        def checkpoint(i,page,no_records,checkdate):
+            rtoken=page.get('resumptionToken') if page else None
+            progress={'mode': mode, 'partitions': stored,
+                      'applied': applied+i+(0 if rtoken else 1)}
+            self._save_checkpoint(rtoken,no_records,startdate,checkdate,progress)
+        return self._apply_partitions(
+                self._harvest_partitions(partitions[applied:],harvest,workers,rtoken),
+                checkpoint,no_records,checkdate)
+    
+    def _harvest_partitions(self,partitions,harvest,workers,rtoken=None):
+        """Harvests the records of each partition with
+        harvest(partition,checkpoint,rtoken) in up to workers threads, the
+        first partition from rtoken on (from scratch if it has expired);
+        yields the records partition after partition, as soon as a partition
+        and all before it are harvested, and a tuple (number of the
+        partition, page) after each page, with page None after a partition
+        records of later partitions wait in a buffer of at most
+        reorder_buffer records, their workers stall while it is full
+        a partition failing with an IOError is harvested again from scratch,
+        at most partition_retries times
+        each worker keeps a connection to the endpoint, also while it
+        stalls, so there are at most max_connections workers"""
+        max_connections=self.config.get('max_connections',4)
+        if workers>max_connections:
+            self.logger.warning("Using %d workers, at most max_connections" % 
+                                                            max_connections)
+            workers=max_connections
+        retries=self.config.get('partition_retries',0)
+        limit=self.config.get('reorder_buffer',10000)
+        buffers=[[] for partition in partitions]
+        done=[False for partition in partitions]
+        errors=[]
+        state={'current': 0, 'buffered': 0, 'closed': False}
+        cond=threading.Condition()
+        tasks=Queue.Queue()
+        for i,partition in enumerate(partitions):
+            tasks.put((i,partition))
+        def put(i,item):
+            """buffers an item; False if the harvest has been given up"""
+            with cond:
+                while (i!=state['current'] and state['buffered']>=limit and
+                       len(errors)==0 and not state['closed']):
+                    cond.wait(1)
+                if len(errors)>0 or state['closed']:
+                    return False
+                buffers[i].append(item)
+                state['buffered']+=1
+                cond.notify_all()
+                return True
+        def harvest_partition(i,partition):
+            """returns True once the partition is harvested completely"""
+            token=rtoken if i==0 else None
+            attempt=0
+            while True:
+                try:
+                    for record in harvest(partition,lambda page: put(i,(i,page)),
+                                          token):
+                        if not put(i,record):
+                            return False
+                    return True
+                except NoRecordsException as e:
+                    if token is None or e.args[0]!='badResumptionToken':
+                        self.logger.debug("No records in %s: %s" % (partition,e))
+                        return True
+                    self.logger.info("resumptionToken expired, harvesting %s again" % 
+                                                                    partition)
+                except IOError as e:
+                    if attempt==retries:
+                        raise
+                    attempt+=1
+                    self.logger.warning("Retrying %s after error: %s" % 
+                                                        (partition,e))
+                token=None
+                with cond:
+                    # records already applied are applied again
+                    state['buffered']-=len(buffers[i])
+                    del buffers[i][:]
+        def work():
+            while len(errors)==0 and not state['closed']:
+                try:
+                    i,partition=tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    complete=harvest_partition(i,partition)
+                except Exception:
+                    complete=False
+                    errors.append(sys.exc_info())
+                with cond:
+                    done[i]=complete
+                    cond.notify_all()
+        threads=[threading.Thread(target=work) 
+                        for n in range(min(workers,len(partitions)))]
+        for thread in threads:
+            thread.daemon=True
+            thread.start()
+        try:
+            for i in range(len(partitions)):
+                finished=False
+                while not finished:
+                    with cond:
+                        while (len(buffers[i])==0 and not done[i] and
+                               len(errors)==0):
+                            cond.wait(1)
+                        # what has been harvested before an error is applied
+                        if len(buffers[i])==0 and not done[i]:
+                            raise errors[0][0], errors[0][1], errors[0][2]
+                        items=buffers[i]
+                        buffers[i]=[]
+                        state['buffered']-=len(items)
+                        finished=done[i]
+                        if finished:
+                            state['current']=i+1
+                        cond.notify_all()
+                    for item in items:
+                        yield item
+                yield (i,None)
+        finally:
+            with cond:
+                state['closed']=True
+                cond.notify_all()
+    
+    def _apply_partitions(self,records,checkpoint=None,no_records=0,checkdate=None):
+        """Processes the records of separately harvested partitions in order,
+        notifying the changes after each page (a tuple (number of the
+        partition, page) instead of a record) and calling
+        checkpoint(partition,page,no_records,checkdate) then; a record older
+        than the resource of its identifier, e.g. from a set harvested before
+        a change, is skipped. The earliest responseDate (or checkdate, if
+        earlier) becomes the checkdate, so changes made during the harvest
+        are picked up by the next check
+        returns the number of processed records (no_records before)"""
+        self.begin_batch()
+        try:
+            for record in records:
+                if isinstance(record,tuple):
+                    self.flush_batch()
+                    if checkpoint is not None:
+                        checkpoint(record[0],record[1],no_records,checkdate)
+                    continue
+                timestamp=self._stored_timestamp(record.header().identifier())
+                if timestamp is None:
+                    no_records+=self.process_record(record,init=True)
+                elif timestamp<Common.tofloat(record.header().datestamp()):
+                    # also deletes a record harvested before
+                    no_records+=self.process_record(record)
+                if checkdate is None or record.responseDate()<checkdate:
+                    checkdate=record.responseDate()
+        finally:
+            self.end_batch()
+        if checkdate is not None:
+            self.lastcheckdate=checkdate
+        return no_records
+    
+    def _stored_timestamp(self,identifier):
+        """the timestamp of the resource of an identifier, None if unknown"""
+        try:
+            return self._repository[self.oaimapping[identifier]]['timestamp']
+        except KeyError:
+            return None
+    
     def _log_stats(self):
         """Log current source statistics"""
         stats = {
@@ -352,12 +1035,17 @@ class Source(Observable):
     
     def process_record(self,record,init=False):
         """reads record, extract and returns record with information about (resource uri, timestamp, identifier)
-        return true, if record was processed successfully"""
+        return true, if record was processed successfully
+        a record with the datestamp of the stored resource is not changed,
+        e.g. when a persistent repository is harvested again after a restart"""
         timestamp=Common.tofloat(record.header().datestamp())
         identifier=record.header().identifier()
         if(not record.header().isDeleted()):    #if resource new or updated
             basename=record.resource()
-            if identifier in self.oaimapping: # if update
+            if self._stored_timestamp(identifier)==timestamp:
+                self.logger.debug("unchanged resource: identifier: %s" % identifier)
+                return False
+            elif identifier in self.oaimapping: # if update
                 self.logger.debug("updating resource: identifier: %s basename: %s, timestamp %s" % (identifier, basename, timestamp))                    
                 self._update_resource(basename,identifier,timestamp)
                 return True
@@ -389,7 +1077,9 @@ class Source(Observable):
         try:
             checkdate=self.lastcheckdate
             self.logger.debug("Requesting new records with date: %s" % checkdate)
-            for i,record in enumerate(self.client.listRecords(checkdate)): # limit to specific date
+            self.begin_batch()
+            for i,record in enumerate(self.client.listRecords(checkdate,
+                        checkpoint=lambda page: self.flush_batch())): # limit to specific date
                 if record.id() in self.oaimapping:
                     if record.header().isDeleted():
                         self.process_record(record) # record in list, but now deleted
@@ -402,12 +1092,15 @@ class Source(Observable):
                     self.process_record(record) # record not in list, and not deleted -> must be a new record
                 checkdate=record.responseDate()
             self.lastcheckdate=checkdate
+            self._save_checkpoint()
         except NoRecordsException as e:
             self.logger.info("No new records found: %s" % e)
         except URLError, e:
             self.logger.error("URL-Error: %s" % e)
         except socket.error, e:
             self.logger.error("Socket-Error: %s" % e)
+        finally:
+            self.end_batch()
             
              
     def __str__(self):
@@ -0,0 +1,59 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from resync.resource_change import ResourceChange
+from resync.changelog import SegmentedChangeLog, RECORD
+
+def changes(first, last):
+    return [ResourceChange(uri=u"http://example.org/%d" % i, timestamp=1.5 * i,
+                           changeid=i, changetype="UPDATED")
+            for i in range(first, last + 1)]
+
+class TestSegmentedChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = SegmentedChangeLog(self.directory, segment_size=10)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def test_append(self):
+        self.assertEqual(list(self.log.changes_from(1)), [])
+        self.log.append(changes(1, 25))
+        self.assertEqual(len(self.log.segments), 3)
+        self.assertEqual((self.log.first, self.log.last), (1, 25))
+        read = list(self.log.changes_from(8, 12))
+        self.assertEqual([c.changeid for c in read], [8, 9, 10, 11, 12])
+        self.assertEqual(read[0].uri, "http://example.org/8")
+        self.assertEqual(read[0].timestamp, 12.0)
+        self.assertEqual(read[0].changetype, "UPDATED")
+        self.assertEqual([c.changeid for c in self.log.changes_from(21)],
+                         [21, 22, 23, 24, 25])
+
+    def test_reopen(self):
+        self.log.append(changes(1, 15))
+        self.log.close()
+        # a partially written record is discarded
+        with open(os.path.join(self.directory, "%020d.rec" % 11), "ab") as f:
+            f.write("\0" * (RECORD.size // 2))
+        self.log = SegmentedChangeLog(self.directory, segment_size=10)
+        self.assertEqual((self.log.first, self.log.last), (1, 15))
+        self.log.append(changes(16, 17))
+        self.assertEqual([c.changeid for c in self.log.changes_from(14)],
+                         [14, 15, 16, 17])
+
+    def test_retention(self):
+        self.log.retention_size = 2 * 10 * (RECORD.size + 21)
+        self.log.append(changes(1, 45))
+        self.assertEqual(self.log.first, 21)
+        self.assertEqual(self.log.changes_from(1).next().changeid, 21)
+        self.log.retention_age = -1
+        self.log.append(changes(46, 51))
+        self.assertEqual(self.log.first, 51)
+
+if __name__ == '__main__':
+    unittest.main()
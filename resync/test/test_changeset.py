@@ -83,6 +83,21 @@ class TestChangeSet(unittest.TestCase):
         self.assertEqual(dst.resources['d'].timestamp, 4)
         self.assertEqual(dst.resources['d'].changetype, 'created')
 
+    def test6_compact(self):
+        c = ChangeSet()
+        c.add( ResourceChange('a',timestamp=1,changeid=1,changetype='CREATED') )
+        c.add( ResourceChange('b',timestamp=1,changeid=2,changetype='UPDATED') )
+        c.add( ResourceChange('a',timestamp=2,changeid=3,changetype='UPDATED') )
+        c.add( ResourceChange('c',timestamp=3,changeid=4,changetype='CREATED') )
+        c.add( ResourceChange('b',timestamp=4,changeid=5,changetype='DELETED') )
+        c.add( ResourceChange('c',timestamp=5,changeid=6,changetype='DELETED') )
+        c.add( ResourceChange('d',timestamp=6,changeid=7,changetype='DELETED') )
+        c.add( ResourceChange('d',timestamp=7,changeid=8,changetype='CREATED') )
+        c.compact()
+        self.assertEqual( [(r.uri, r.changetype, r.timestamp, r.changeid) for r in c],
+                          [('a','CREATED',2,3), ('b','DELETED',4,5),
+                           ('d','UPDATED',7,8)] )
+
 if __name__ == '__main__':
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestChangeSet)
     unittest.TextTestRunner().run(suite)
@@ -0,0 +1,50 @@
+import unittest
+import os
+import shutil
+import tempfile
+import datetime
+from dateutil import parser as dateutil_parser
+
+from resync.checkpoint import HarvestCheckpoint
+
+class TestHarvestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint = HarvestCheckpoint(
+                            os.path.join(self.tmpdir, "harvest.checkpoint"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_missing(self):
+        self.assertEqual(self.checkpoint.load(), None)
+
+    def test_save_load(self):
+        checkdate = dateutil_parser.parse("2012-09-25T10:00:00Z")
+        fromdate = dateutil_parser.parse("2012-09-01T00:00:00Z")
+        self.checkpoint.save(checkdate, "token-1", 42, fromdate)
+        state = self.checkpoint.load()
+        self.assertEqual(state['lastcheckdate'], checkdate)
+        self.assertEqual(state['resumptionToken'], "token-1")
+        self.assertEqual(state['no_records'], 42)
+        self.assertEqual(state['fromdate'], fromdate)
+        self.checkpoint.save(checkdate)
+        state = self.checkpoint.load()
+        self.assertEqual(state['resumptionToken'], None)
+        self.assertEqual(state['fromdate'], None)
+        self.assertEqual(os.listdir(self.tmpdir), ["harvest.checkpoint"])
+
+    def test_corrupt(self):
+        with open(self.checkpoint.path, 'w') as f:
+            f.write("{\"lastcheck")
+        self.assertEqual(self.checkpoint.load(), None)
+
+    def test_clear(self):
+        self.checkpoint.save(datetime.datetime(2012, 9, 25))
+        self.checkpoint.clear()
+        self.assertEqual(self.checkpoint.load(), None)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestHarvestCheckpoint)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,134 @@
+import unittest
+import os
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+from oaipmh.connection import ConnectionPool
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        self.server.paths.append(self.path)
+        if self.path == "/missing":
+            body = "not found"
+            self.send_response(404)
+        elif self.path == "/moved":
+            body = ""
+            self.send_response(302)
+            self.send_header("Location", "/oai")
+        else:
+            body = "<OAI-PMH/>"
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.server.clients.add(self.client_address)
+        self.send_response(200)
+        self.send_header("Content-Length", "1234")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # e.g. a client closing a connection before reading the response
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = KeepAliveServer(("localhost", 0), KeepAliveHandler)
+        self.server.clients = set()
+        self.server.paths = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = "http://localhost:%d" % self.server.server_address[1]
+        self.pool = ConnectionPool(maxsize=2, idle_timeout=30)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for i in range(5):
+            fh = self.pool.urlopen(self.base + "/oai?verb=Identify")
+            self.assertEqual(fh.read(), "<OAI-PMH/>")
+            self.assertEqual(fh.getcode(), 200)
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual(self.pool.idle_count(), 1)
+
+    def test_head(self):
+        fh = self.pool.urlopen(self.base + "/file", method='HEAD')
+        self.assertEqual(fh.info().getheaders("Content-Length"), ["1234"])
+        self.pool.urlopen(self.base + "/oai").read()
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_errors_and_redirects(self):
+        self.assertRaises(urllib2.HTTPError, self.pool.urlopen,
+                          self.base + "/missing")
+        self.assertEqual(self.pool.urlopen(self.base + "/moved").read(),
+                         "<OAI-PMH/>")
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        self.pool.urlopen(self.base + "/oai").read()
+        self.pool.urlopen(self.base + "/oai").read()
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_stale_connection(self):
+        self.pool.urlopen(self.base + "/oai").read()
+        key = self.pool._idle.keys()[0]
+        conn, last_used = self.pool._idle[key][0]
+        conn.sock.close()
+        self.assertEqual(self.pool.urlopen(self.base + "/oai").read(),
+                         "<OAI-PMH/>")
+
+    def test_max_connections(self):
+        self.pool = ConnectionPool(maxsize=1, idle_timeout=30, timeout=0.5)
+        fh = self.pool.urlopen(self.base + "/oai")
+        # the only connection to the host is in use until fh is read
+        self.assertRaises(urllib2.URLError, self.pool.urlopen,
+                          self.base + "/oai")
+        responses = []
+        def request():
+            responses.append(self.pool.urlopen(self.base + "/oai").read())
+        thread = threading.Thread(target=request)
+        thread.start()
+        fh.read()
+        thread.join()
+        self.assertEqual(responses, ["<OAI-PMH/>"])
+        self.assertEqual(len(self.server.clients), 1)
+        # a response which is not read releases its connection when closed
+        fh = self.pool.urlopen(self.base + "/oai")
+        fh.close()
+        self.assertEqual(self.pool.urlopen(self.base + "/oai").read(),
+                         "<OAI-PMH/>")
+
+    def test_proxy(self):
+        environ = dict(os.environ)
+        try:
+            os.environ['http_proxy'] = self.base
+            os.environ['no_proxy'] = "localhost"
+            fh = self.pool.urlopen("http://example.org/oai?verb=Identify")
+            self.assertEqual(fh.read(), "<OAI-PMH/>")
+            self.pool.urlopen(self.base + "/oai").read() # not proxied
+            self.assertEqual(self.server.paths,
+                             ["http://example.org/oai?verb=Identify", "/oai"])
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestConnectionPool)
+    unittest.TextTestRunner(verbosity=2).run(suite)
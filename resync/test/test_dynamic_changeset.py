@@ -0,0 +1,179 @@
+import unittest
+import datetime
+import shutil
+import tempfile
+
+from resync.source import Source
+from resync.resource_change import ResourceChange
+from resync.changememory import DynamicChangeSet, PersistentChangeSet, ChangeRing
+
+class TestDynamicChangeSet(unittest.TestCase):
+
+    def setUp(self):
+        source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                        "localhost", "8888")
+        self.changememory = DynamicChangeSet(source, {'uri_path': "changes",
+                                                      'max_changes': 5})
+
+    def changes(self, first, last):
+        return [ResourceChange(uri="http://example.org/%d" % i, timestamp=i,
+                               changetype="UPDATED")
+                for i in range(first, last)]
+
+    def test_notify_batch(self):
+        self.changememory.notify_batch(self.changes(0, 3))
+        self.changememory.notify(self.changes(3, 4)[0])
+        self.changememory.notify_batch(self.changes(4, 8))
+        self.assertEqual(self.changememory.change_count, 5)
+        self.assertEqual(self.changememory.first_change_id, 4)
+        self.assertEqual(self.changememory.latest_change_id, 8)
+        self.assertEqual([c.uri for c in self.changememory.changes_from(6)],
+            ["http://example.org/5", "http://example.org/6",
+             "http://example.org/7"])
+
+    def test_changes_from(self):
+        self.changememory.notify_batch(self.changes(0, 12))
+        self.assertEqual([c.changeid for c in self.changememory.changes_from(0)],
+                         [8, 9, 10, 11, 12])
+        self.assertEqual([c.changeid for c in self.changememory.changes_from(11)],
+                         [11, 12])
+        self.assertEqual(list(self.changememory.changes_from(13)), [])
+        changeset = self.changememory.generate(10)
+        self.assertEqual(len(changeset), 3)
+        self.assertTrue(
+            "http://localhost:8888/changes/from/13" in changeset.capabilities)
+
+    def test_compact(self):
+        changes = self.changes(0, 3) + self.changes(1, 2)
+        changes[0].changetype = "CREATED"
+        changes[3].changetype = "DELETED"
+        self.changememory.notify_batch(changes)
+        self.assertEqual(len(list(self.changememory.changeset_changes(1))), 4)
+        self.changememory.compact = True
+        self.assertEqual([(c.uri, c.changetype)
+                          for c in self.changememory.generate(1)],
+            [("http://example.org/0", "CREATED"),
+             ("http://example.org/2", "UPDATED"),
+             ("http://example.org/1", "DELETED")])
+
+    def test_changeid_since(self):
+        self.assertEqual(self.changememory.changeid_since(0), 1)
+        changes = self.changes(0, 7)
+        for i, change in enumerate(changes):
+            change.changeid = i + 1
+            self.changememory.changes.append(change, 100.0 + i // 2)
+        self.changememory.latest_change_id = 7
+        self.assertEqual(self.changememory.changeid_since(0), 3)
+        self.assertEqual(self.changememory.changeid_since(102), 5)
+        self.assertEqual(self.changememory.changeid_since(102.5), 7)
+        self.assertEqual(self.changememory.changeid_since(104), 8)
+
+class TestPersistentChangeSet(TestDynamicChangeSet):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                             "localhost", "8888")
+        self.config = {'uri_path': "changes", 'max_changes': 5,
+                       'directory': self.directory, 'segment_size': 4}
+        self.changememory = PersistentChangeSet(self.source, self.config)
+
+    def tearDown(self):
+        self.changememory.close()
+        shutil.rmtree(self.directory)
+
+    def test_notify_batch(self):
+        self.changememory.notify_batch(self.changes(0, 8))
+        self.assertEqual(self.changememory.change_count, 5)
+        self.assertEqual(self.changememory.first_change_id, 1)
+        self.assertEqual([c.changeid for c in self.changememory.changes_from(2)],
+                         range(2, 9))
+
+    def test_changes_from(self):
+        self.changememory.notify_batch(self.changes(0, 12))
+        self.assertEqual([c.uri for c in self.changememory.changes_from(3)],
+                         ["http://example.org/%d" % i for i in range(2, 12)])
+        self.assertEqual(list(self.changememory.changes_from(13)), [])
+
+    def test_page(self):
+        self.changememory.page_size = 4
+        self.changememory.notify_batch(self.changes(0, 12))
+        self.assertEqual([c.changeid for c in self.changememory.changeset_changes(5)],
+                         [5, 6, 7, 8])
+        self.assertTrue("http://localhost:8888/changes/from/9" in
+                        self.changememory.capabilities(5))
+        self.assertTrue("http://localhost:8888/changes/from/13" in
+                        self.changememory.capabilities(10))
+
+    def test_restart(self):
+        self.changememory.notify_batch(self.changes(0, 6))
+        self.changememory.close()
+        self.changememory = PersistentChangeSet(self.source, self.config)
+        self.assertEqual(self.changememory.latest_change_id, 6)
+        self.changememory.notify(self.changes(6, 7)[0])
+        self.assertEqual([c.changeid for c in self.changememory.changes_from(0)],
+                         range(1, 8))
+
+    def test_changeid_since(self):
+        self.assertEqual(self.changememory.changeid_since(0), 1)
+        log = self.changememory.changelog
+        for i in range(0, 12, 3):
+            changes = self.changes(i, i + 3)
+            for j, change in enumerate(changes):
+                change.changeid = i + j + 1
+            self.changememory.latest_change_id = i + 3
+            self.changememory.store(changes, 100.0 + i)
+        self.assertEqual(log.changeid_since(104), 7)
+        self.assertEqual(log.changeid_since(110), 13)
+        self.assertEqual(self.changememory.changeid_since(0), 1)
+        self.assertEqual(self.changememory.changeid_since(101), 4)
+        self.assertEqual(self.changememory.changeid_since(109), 10)
+        self.assertEqual(self.changememory.changeid_since(110), 13)
+
+    def test_changeid_since_recovered(self):
+        changes = self.changes(0, 1)
+        changes[0].changeid = self.changememory.latest_change_id = 1
+        self.changememory.store(changes, 50.0)
+        self.changememory.close()
+        self.changememory = PersistentChangeSet(self.source, self.config)
+        self.assertEqual(self.changememory.changeid_since(50), 1)
+        self.assertEqual(self.changememory.changeid_since(51), 2)
+
+class TestChangeRing(unittest.TestCase):
+
+    def change(self, changeid):
+        return ResourceChange(uri="http://example.org/%d" % changeid,
+                              changeid=changeid)
+
+    def test_append(self):
+        ring = ChangeRing(3)
+        self.assertEqual(len(ring), 0)
+        self.assertEqual(list(ring.changes_from(1)), [])
+        for changeid in range(1, 4):
+            self.assertEqual(ring.append(self.change(changeid)), None)
+        self.assertEqual(ring.append(self.change(4)).changeid, 1)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.get(1), None)
+        self.assertEqual(ring.get(3).changeid, 3)
+        self.assertEqual([c.changeid for c in ring], [2, 3, 4])
+        self.assertEqual([c.changeid for c in ring.changes_from(1, 3)], [2, 3])
+
+    def test_evicted_while_iterating(self):
+        ring = ChangeRing(3)
+        for changeid in range(1, 4):
+            ring.append(self.change(changeid))
+        changes = ring.changes_from(1)
+        self.assertEqual(changes.next().changeid, 1)
+        ring.append(self.change(4))
+        ring.append(self.change(5))
+        self.assertEqual([c.changeid for c in changes], [3])
+
+    def test_unbounded(self):
+        ring = ChangeRing()
+        for changeid in range(5, 1005):
+            self.assertEqual(ring.append(self.change(changeid)), None)
+        self.assertEqual(len(ring), 1000)
+        self.assertEqual(ring.get(700).changeid, 700)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import datetime
+import threading
+import StringIO
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+
+from resync.source import Source, DynamicInventoryBuilder
+from resync.http import HTTPInterface, SitemapHandler, ResponseCache, \
+                        PrecompressedFileHandler, SitemapExecutor
+from resync.resource_change import ResourceChange
+from resync.changememory import DynamicChangeSet, StaticChangeSet
+from resync.sitemap import Sitemap
+
+class TestDynamicChangeSetHTTP(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                             "localhost", "8888")
+        self.changememory = DynamicChangeSet(self.source, {
+                'class': "DynamicChangeSet", 'uri_path': "changeset.xml",
+                'max_changes': 100})
+        self.source.add_changememory(self.changememory)
+        return tornado.web.Application(HTTPInterface(self.source).handlers)
+
+    def notify(self, first, last, recorded):
+        changes = [ResourceChange(uri="http://example.org/%d" % i,
+                                  timestamp=i, changetype="UPDATED")
+                   for i in range(first, last)]
+        for change in changes:
+            change.changeid = self.changememory.latest_change_id + 1
+            self.changememory.latest_change_id = change.changeid
+        self.changememory.store(changes, recorded)
+        self.source._changed()
+
+    def uris(self, response):
+        self.assertEqual(response.code, 200)
+        changeset = Sitemap().changeset_parse_xml(fh=response.buffer)
+        return sorted(change.uri for change in changeset)
+
+    def test_from(self):
+        self.notify(0, 5, 1346457600.0)
+        self.assertEqual(self.uris(self.fetch("/changeset.xml/from/4")),
+                         ["http://example.org/3", "http://example.org/4"])
+
+    def test_since(self):
+        self.notify(0, 3, 1346457600.0) # 2012-09-01T00:00:00Z
+        self.notify(3, 5, 1346544000.0) # 2012-09-02T00:00:00Z
+        self.assertEqual(self.uris(self.fetch(
+                            "/changeset.xml/since/2012-09-01T12:00:00Z")),
+                         ["http://example.org/3", "http://example.org/4"])
+        self.assertEqual(len(self.uris(self.fetch(
+                            "/changeset.xml/since/2012-09-01"))), 5)
+        self.assertEqual(self.fetch("/changeset.xml/since/yesterday").code, 400)
+
+    def test_pages(self):
+        self.changememory.page_size = 2
+        self.notify(0, 5, 1346457600.0)
+        uris = []
+        path = "/changeset.xml"
+        while True:
+            response = self.fetch(path)
+            uris += self.uris(response)
+            response.buffer.seek(0)
+            changeset = Sitemap().changeset_parse_xml(fh=response.buffer)
+            next_uri = [uri for (uri, link) in changeset.capabilities.items()
+                        if link['attributes'][0] == "next"][0]
+            path = next_uri[len(self.source.base_uri):]
+            if path == "/changeset.xml/from/6":
+                break
+        self.assertEqual(sorted(uris),
+                         ["http://example.org/%d" % i for i in range(5)])
+        self.assertEqual(len(self.uris(self.fetch("/changeset.xml/from/3"))), 2)
+
+    def test_streaming(self):
+        chunk_size = SitemapHandler.CHUNK_SIZE
+        SitemapHandler.CHUNK_SIZE = 2
+        try:
+            self.notify(0, 5, 1346457600.0)
+            response = self.fetch("/changeset.xml")
+        finally:
+            SitemapHandler.CHUNK_SIZE = chunk_size
+        self.assertEqual(response.headers['Transfer-Encoding'], "chunked")
+        self.assertEqual(self.uris(response),
+                         ["http://example.org/%d" % i for i in range(5)])
+
+    def test_not_modified(self):
+        self.notify(0, 2, 1346457600.0)
+        response = self.fetch("/changeset.xml")
+        etag = response.headers['Etag']
+        self.assertEqual(len(self.uris(response)), 2)
+        response = self.fetch("/changeset.xml",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.notify(2, 3, 1346457600.0)
+        response = self.fetch("/changeset.xml",
+                              headers={'If-None-Match': etag})
+        self.assertNotEqual(response.headers['Etag'], etag)
+        self.assertEqual(len(self.uris(response)), 3)
+
+    def test_cache(self):
+        self.notify(0, 2, 1346457600.0)
+        body = self.fetch("/changeset.xml").body
+        generated = []
+        changeset_changes = self.changememory.changeset_changes
+        def counting_changeset_changes(changeid):
+            generated.append(changeid)
+            return changeset_changes(changeid)
+        self.changememory.changeset_changes = counting_changeset_changes
+        self.assertEqual(self.fetch("/changeset.xml").body, body)
+        self.assertEqual(generated, [])
+        self.fetch("/changeset.xml/from/2")
+        self.assertEqual(generated, [2])
+        self.notify(2, 3, 1346457600.0)
+        self.assertEqual(len(self.uris(self.fetch("/changeset.xml"))), 3)
+        self.assertEqual(len(generated), 2)
+
+    def test_gzip(self):
+        self.notify(0, 2, 1346457600.0)
+        plain = self.fetch("/changeset.xml", decompress_response=False)
+        self.assertFalse('Content-Encoding' in plain.headers)
+        for n in range(2): # generated and cached
+            response = self.fetch("/changeset.xml", decompress_response=False,
+                                  headers={'Accept-Encoding': "gzip"})
+            self.assertEqual(response.headers['Content-Encoding'], "gzip")
+            self.assertNotEqual(response.headers['Etag'],
+                                plain.headers['Etag'])
+            self.assertEqual(gzip.GzipFile(
+                    fileobj=StringIO.StringIO(response.body)).read(),
+                    plain.body)
+        response = self.fetch("/changeset.xml", decompress_response=False,
+                              headers={'Accept-Encoding': "gzip;q=0"})
+        self.assertEqual(response.body, plain.body)
+
+class TestDynamicInventoryHTTP(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                             "localhost", "8888")
+        self.inventory_builder = DynamicInventoryBuilder(self.source, {
+                'class': "DynamicInventoryBuilder", 'uri_path': "sitemap.xml",
+                'max_sitemap_entries': 2})
+        self.source.add_inventory_builder(self.inventory_builder)
+        self.source.add_changememory(DynamicChangeSet(self.source, {
+                'class': "DynamicChangeSet", 'uri_path': "changeset.xml",
+                'max_changes': 100}))
+        for i in range(5):
+            self.source._create_resource(basename="http://example.org/%d" % i,
+                                         timestamp=i, oai=False)
+        return tornado.web.Application(HTTPInterface(self.source).handlers)
+
+    def test_sitemapindex(self):
+        response = self.fetch("/sitemap.xml")
+        self.assertEqual(response.code, 200)
+        index = Sitemap().sitemapindex_parse_xml(fh=response.buffer)
+        self.assertEqual(sorted(index.resources.keys()),
+                         ["http://localhost:8888/sitemap%05d.xml" % n
+                          for n in range(3)])
+        uris = []
+        for n in range(3):
+            response = self.fetch("/sitemap%05d.xml" % n)
+            self.assertEqual(response.code, 200)
+            inventory = Sitemap().inventory_parse_xml(fh=response.buffer)
+            uris += sorted(inventory.resources.keys())
+        self.assertEqual(uris, ["http://example.org/%d" % i for i in range(5)])
+        self.assertEqual(self.fetch("/sitemap00003.xml").code, 404)
+
+    def test_single_sitemap(self):
+        self.inventory_builder.max_sitemap_entries = 5
+        response = self.fetch("/sitemap.xml")
+        inventory = Sitemap().inventory_parse_xml(fh=response.buffer)
+        self.assertEqual(len(inventory), 5)
+
+    def test_not_blocking(self):
+        generated = threading.Event()
+        generate = self.inventory_builder.generate_sitemap
+        def slow_generate_sitemap(n):
+            generated.wait(5)
+            return generate(n)
+        self.inventory_builder.generate_sitemap = slow_generate_sitemap
+        self.http_client.fetch(self.get_url("/sitemap00000.xml"), self.stop)
+        # served while the sitemap is being generated
+        self.assertEqual(self.fetch("/changeset.xml").code, 200)
+        self.assertFalse(generated.is_set())
+        generated.set()
+        response = self.wait()
+        self.assertEqual(len(Sitemap().inventory_parse_xml(
+                                            fh=response.buffer)), 2)
+
+class TestStaticChangeSetHTTP(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.static_file_path = Source.STATIC_FILE_PATH
+        Source.STATIC_FILE_PATH = tempfile.mkdtemp()
+        self.source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                             "localhost", "8888")
+        self.changememory = StaticChangeSet(self.source, {
+                'class': "StaticChangeSet", 'uri_path': "changesets",
+                'uri_file': "most_recent.xml", 'max_changes': 2,
+                'max_sitemap_entries': 100})
+        self.source.add_changememory(self.changememory)
+        return tornado.web.Application(HTTPInterface(self.source).handlers)
+
+    def tearDown(self):
+        super(TestStaticChangeSetHTTP, self).tearDown()
+        self.changememory.close()
+        shutil.rmtree(Source.STATIC_FILE_PATH)
+        Source.STATIC_FILE_PATH = self.static_file_path
+
+    def changeset(self, response):
+        self.assertEqual(response.code, 200)
+        return Sitemap().changeset_parse_xml(fh=response.buffer)
+
+    def test_written_changeset(self):
+        written = threading.Event()
+        write_changeset = self.changememory.write_changeset
+        def delayed_write_changeset(changes=None):
+            written.wait()
+            write_changeset(changes)
+        self.changememory.write_changeset = delayed_write_changeset
+        self.source.notify_observers_batch([ResourceChange(
+                uri="http://example.org/%d" % i, timestamp=i,
+                changetype="UPDATED") for i in range(3)])
+        # served and cached before the writer thread has written the full
+        # changeset
+        response = self.fetch("/changesets/most_recent.xml")
+        etag = response.headers['Etag']
+        changeset = self.changeset(response)
+        self.assertEqual(len(changeset), 1)
+        self.assertEqual(len(changeset.capabilities), 1)
+        written.set()
+        self.changememory.flush()
+        self.assertEqual(self.changememory.previous_changeset_id, 1)
+        response = self.fetch("/changesets/most_recent.xml",
+                              headers={'If-None-Match': etag})
+        changeset = self.changeset(response)
+        self.assertEqual(len(changeset), 1)
+        self.assertTrue(self.changememory.previous_changeset_uri() in
+                        changeset.capabilities)
+
+class TestPrecompressedFileHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.directory = tempfile.mkdtemp()
+        generation = os.path.join(self.directory, "1")
+        os.mkdir(generation)
+        with open(os.path.join(generation, "sitemap.xml"), "w") as f:
+            f.write("<urlset/>")
+        f = gzip.open(os.path.join(generation, "sitemap.xml.gz"), "wb")
+        f.write("<urlset/>")
+        f.close()
+        # served through a link to the current generation
+        os.symlink("1", os.path.join(self.directory, "current"))
+        return tornado.web.Application([(r"/(sitemap\d*\.xml(?:\.gz)?)",
+                PrecompressedFileHandler,
+                dict(path = os.path.join(self.directory, "current")))])
+
+    def tearDown(self):
+        super(TestPrecompressedFileHandler, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_precompressed(self):
+        response = self.fetch("/sitemap.xml", decompress_response=False,
+                              headers={'Accept-Encoding': "gzip"})
+        self.assertEqual(response.headers['Content-Encoding'], "gzip")
+        self.assertEqual(response.headers['Content-Type'], "application/xml")
+        self.assertEqual(gzip.GzipFile(
+                fileobj=StringIO.StringIO(response.body)).read(), "<urlset/>")
+        response = self.fetch("/sitemap.xml", decompress_response=False)
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(response.body, "<urlset/>")
+
+    def test_swap(self):
+        generation = os.path.join(self.directory, "2")
+        os.mkdir(generation)
+        with open(os.path.join(generation, "sitemap.xml"), "w") as f:
+            f.write("<sitemapindex/>")
+        os.symlink("2", os.path.join(self.directory, "current.tmp"))
+        os.rename(os.path.join(self.directory, "current.tmp"),
+                  os.path.join(self.directory, "current"))
+        self.assertEqual(self.fetch("/sitemap.xml").body, "<sitemapindex/>")
+
+class TestSitemapExecutor(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return tornado.web.Application([])
+
+    def test_submit(self):
+        executor = SitemapExecutor(2)
+        try:
+            executor.submit(sum, [1, 2]).add_done_callback(self.stop)
+            self.assertEqual(self.wait().result(), 3)
+            executor.submit(int, "x").add_done_callback(self.stop)
+            self.assertRaises(ValueError, self.wait().result)
+        finally:
+            executor.shutdown()
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_versions(self):
+        cache = ResponseCache(maxsize=2)
+        cache.put(1, "/a", "a1")
+        cache.put(1, "/b", "b1")
+        self.assertEqual(cache.get(1, "/a"), "a1")
+        cache.put(1, "/c", "c1")
+        self.assertEqual(cache.get(1, "/b"), None) # least recently used
+        cache.put(2, "/a", "a2")
+        self.assertEqual(cache.get(1, "/c"), None)
+        self.assertEqual(cache.get(2, "/a"), "a2")
+        cache.put(1, "/a", "a1") # generated for an older version
+        self.assertEqual(cache.get(2, "/a"), "a2")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import unittest
+import StringIO
+import datetime
+import urlparse
+import time
+
+import oaipmh.oai
+from oaipmh.oai import Client, Record, Header, NoRecordsException
+
+PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>2012-09-25T10:00:00Z</responseDate>
+<request verb="ListRecords">http://example.org/oai</request>
+<ListRecords>
+<record>
+<header><identifier>oai:example.org:1</identifier><datestamp>2012-09-01T10:00:00Z</datestamp></header>
+<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier>http://example.org/1/</dc:identifier>
+</oai_dc:dc></metadata>
+</record>
+<record>
+<header status="deleted"><identifier>oai:example.org:2</identifier><datestamp>2012-09-02</datestamp></header>
+</record>
+<resumptionToken>token-1</resumptionToken>
+</ListRecords>
+</OAI-PMH>"""
+
+ERROR_PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>2012-09-25T10:00:00Z</responseDate>
+<request verb="ListRecords">http://example.org/oai</request>
+<error code="noRecordsMatch">No records</error>
+</OAI-PMH>"""
+
+SETS_PAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>2012-09-25T10:00:00Z</responseDate>
+<request verb="ListSets">http://example.org/oai</request>
+<ListSets>
+<set><setSpec>types</setSpec><setName>Types</setName></set>
+<set><setSpec>types:article</setSpec><setName>Article</setName></set>
+<set><setSpec>subjects:cs</setSpec><setName>CS</setName></set>
+<resumptionToken>sets-1</resumptionToken>
+</ListSets>
+</OAI-PMH>"""
+
+class FakeUrlChecker(object):
+
+    def __init__(self, alive):
+        self.batches = []
+        self._alive = alive
+
+    def check(self, urls):
+        self.batches.append(urls)
+        return dict((url, url in self._alive) for url in urls)
+
+    def alive(self, url):
+        return url in self._alive
+
+class TestOAIClient(unittest.TestCase):
+
+    def read_page(self, xml, streaming):
+        client = Client("http://example.org/oai", False, False,
+                        streaming=streaming)
+        page = {}
+        records = list(client.readPage(StringIO.StringIO(xml), page))
+        return (records, page)
+
+    def test_parse_page(self):
+        (records, page) = self.read_page(PAGE, False)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].id(), "oai:example.org:1")
+        self.assertEqual(records[0].resource(), "http://example.org/1")
+        self.assertTrue(records[1].header().isDeleted())
+        self.assertEqual(records[1].resource(), None)
+        self.assertEqual(page['resumptionToken'], "token-1")
+
+    def test_iterparse_page(self):
+        (records, page) = self.read_page(PAGE, True)
+        (tree_records, tree_page) = self.read_page(PAGE, False)
+        self.assertEqual([str(r) for r in records],
+                         [str(r) for r in tree_records])
+        self.assertEqual(page, tree_page)
+
+    def test_checkurl(self):
+        for streaming in (False, True):
+            checker = FakeUrlChecker([])
+            client = Client("http://example.org/oai", False, True,
+                            streaming=streaming, urlchecker=checker)
+            records = list(client.readPage(StringIO.StringIO(PAGE), {}))
+            self.assertEqual(checker.batches, [["http://example.org/1/"]])
+            self.assertEqual([r.id() for r in records], ["oai:example.org:2"])
+            checker = FakeUrlChecker(["http://example.org/1/"])
+            client.urlchecker = checker
+            records = list(client.readPage(StringIO.StringIO(PAGE), {}))
+            self.assertEqual(records[0].resource(), "http://example.org/1")
+
+    def test_checkurl_candidates(self):
+        candidates = """<record>
+<header><identifier>oai:example.org:3</identifier><datestamp>2012-09-01</datestamp></header>
+<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier>http://example.org/3a</dc:identifier>
+<dc:identifier>http://example.org/3b</dc:identifier>
+<dc:relation>http://example.org/3c</dc:relation>
+</oai_dc:dc></metadata>
+</record>
+<resumptionToken>"""
+        xml = PAGE.replace("<resumptionToken>", candidates, 1)
+        checker = FakeUrlChecker(["http://example.org/1/",
+                                  "http://example.org/3b"])
+        client = Client("http://example.org/oai", False, True,
+                        urlchecker=checker)
+        records = list(client.readPage(StringIO.StringIO(xml), {}))
+        # a record's next candidate is only checked if none before is alive
+        self.assertEqual(checker.batches,
+            [["http://example.org/1/", "http://example.org/3a"],
+             ["http://example.org/3b"]])
+        self.assertEqual([r.resource() for r in records],
+            ["http://example.org/1", None, "http://example.org/3b"])
+
+    def test_last_page(self):
+        last_page = PAGE.replace("<resumptionToken>token-1</resumptionToken>",
+                                 "<resumptionToken/>")
+        for streaming in (False, True):
+            (records, page) = self.read_page(last_page, streaming)
+            self.assertEqual(len(records), 2)
+            self.assertFalse('resumptionToken' in page)
+
+    def test_error_page(self):
+        for streaming in (False, True):
+            self.assertRaises(NoRecordsException, self.read_page,
+                              ERROR_PAGE, streaming)
+
+    def test_prefetch(self):
+        last_page = PAGE.replace("<resumptionToken>token-1</resumptionToken>",
+                                 "").replace("example.org:", "example.org:1")
+        def fake_urlopen(url):
+            if url.endswith("resumptionToken=token-1"):
+                return StringIO.StringIO(last_page)
+            return StringIO.StringIO(PAGE)
+        urlopen = oaipmh.oai.urlopen
+        oaipmh.oai.urlopen = fake_urlopen
+        try:
+            client = Client("http://example.org/oai", False, False)
+            records = [r.id() for r in client.listRecords()]
+            self.assertEqual(len(records), 4)
+            client = Client("http://example.org/oai", False, False,
+                            prefetch=1)
+            self.assertEqual([r.id() for r in client.listRecords()], records)
+        finally:
+            oaipmh.oai.urlopen = urlopen
+
+    def test_prefetch_records(self):
+        produced = []
+        opened = []
+        def read_page(fh, page):
+            for i in range(500):
+                produced.append(i)
+                yield Record(Header("oai:example.org:%d" % i, None), None, None)
+            if len(opened) < 4:
+                page['resumptionToken'] = "token-%d" % len(opened)
+        def fake_urlopen(url):
+            opened.append(url)
+            return StringIO.StringIO(PAGE)
+        urlopen = oaipmh.oai.urlopen
+        oaipmh.oai.urlopen = fake_urlopen
+        try:
+            client = Client("http://example.org/oai", False, False,
+                            prefetch=1)
+            client.readPage = read_page
+            pages = []
+            records = client.listRecords(checkpoint=pages.append)
+            records.next()
+            time.sleep(0.2)
+            # the next page is read completely, however long it is
+            self.assertEqual(len(opened), 2)
+            self.assertEqual(len(produced), 1000)
+            self.assertEqual(len(list(records)), 1999)
+            self.assertEqual(len(pages), 4)
+            self.assertFalse('resumptionToken' in pages[-1])
+        finally:
+            oaipmh.oai.urlopen = urlopen
+
+    def test_prefetch_error(self):
+        urlopen = oaipmh.oai.urlopen
+        oaipmh.oai.urlopen = lambda url: StringIO.StringIO(ERROR_PAGE)
+        try:
+            client = Client("http://example.org/oai", False, False,
+                            prefetch=2)
+            self.assertRaises(NoRecordsException, list, client.listRecords())
+        finally:
+            oaipmh.oai.urlopen = urlopen
+
+    def test_date_windows(self):
+        client = Client("http://example.org/oai", False, False)
+        client.granularity = "date"
+        windows = client.dateWindows(datetime.datetime(2012, 9, 1, 10, 30),
+                                     datetime.datetime(2012, 9, 10), 3)
+        self.assertEqual(windows,
+            [(datetime.datetime(2012, 9, 1), datetime.datetime(2012, 9, 4)),
+             (datetime.datetime(2012, 9, 5), datetime.datetime(2012, 9, 8)),
+             (datetime.datetime(2012, 9, 9), None)])
+        params = urlparse.parse_qs(client.listRecordsParams(*windows[0]))
+        self.assertEqual(params['from'], ['2012-09-01'])
+        self.assertEqual(params['until'], ['2012-09-04'])
+        client.granularity = "dateandtime"
+        windows = client.dateWindows(datetime.datetime(2012, 9, 1),
+                                     datetime.datetime(2012, 9, 1, 0, 0, 9), 5)
+        self.assertEqual(len(windows), 5)
+        self.assertEqual(windows[0][1], datetime.datetime(2012, 9, 1, 0, 0, 1))
+        self.assertEqual(windows[1][0], datetime.datetime(2012, 9, 1, 0, 0, 2))
+
+    def test_list_sets(self):
+        last_page = SETS_PAGE.replace("<resumptionToken>sets-1</resumptionToken>",
+                                      "").replace("types", "status")
+        def fake_urlopen(url):
+            if url.endswith("resumptionToken=sets-1"):
+                return StringIO.StringIO(last_page)
+            return StringIO.StringIO(SETS_PAGE)
+        urlopen = oaipmh.oai.urlopen
+        oaipmh.oai.urlopen = fake_urlopen
+        try:
+            client = Client("http://example.org/oai", False, False)
+            self.assertEqual(list(client.listSets()),
+                ["types", "types:article", "subjects:cs",
+                 "status", "status:article", "subjects:cs"])
+            self.assertEqual(client.topLevelSets(),
+                             ["status", "subjects:cs", "types"])
+        finally:
+            oaipmh.oai.urlopen = urlopen
+        params = urlparse.parse_qs(client.listRecordsParams(setspec="types"))
+        self.assertEqual(params['set'], ['types'])
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestOAIClient)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,174 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+from resync.repository import Repository, CompactRepository, SQLiteRepository
+
+def deep_size(o, seen):
+    """Approximate number of bytes of o and the objects it references"""
+    if id(o) in seen:
+        return 0
+    seen.add(id(o))
+    size = sys.getsizeof(o)
+    if isinstance(o, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for (k, v) in o.items())
+    if isinstance(o, (list, tuple)):
+        size += sum(deep_size(v, seen) for v in o)
+    elif hasattr(o, '__dict__'):
+        size += deep_size(o.__dict__, seen)
+    return size
+
+class Plain(object):
+    """The resources and identifiers of a repository as plain dicts"""
+
+    def __init__(self):
+        self.resources = {}
+        self.identifiers = {}
+
+class TestRepository(unittest.TestCase):
+
+    def test_memory(self):
+        repository = Repository()
+        repository.resources["http://example.org/1"] = {'timestamp': 1.0}
+        repository.identifiers["oai:example.org:1"] = "http://example.org/1"
+        self.assertEqual(list(repository.basenames()), ["http://example.org/1"])
+
+    def test_sorted_basenames(self):
+        repository = Repository()
+        for i in (3, 1, 4, 0, 2):
+            repository.resources["http://example.org/%d" % i] = {'timestamp': 1.0}
+        self.assertEqual(list(repository.sorted_basenames(1, 3)),
+                         ["http://example.org/1", "http://example.org/2"])
+        self.assertEqual(len(list(repository.sorted_basenames(3))), 2)
+
+class TestCompactRepository(unittest.TestCase):
+
+    PREFIX = "http://eprints.cs.univie.ac.at/cgi/oai2?verb=GetRecord&metadataPrefix=oai_dc&identifier="
+
+    def fill(self, repository, n):
+        repository.metadata_uri_prefix = self.PREFIX
+        for i in range(n):
+            basename = "http://eprints.cs.univie.ac.at/%d/1/paper-%d.pdf" % (i, i)
+            identifier = "oai:eprints.cs.univie.ac.at:%d" % i
+            repository.resources[basename] = {'timestamp': 1.0 * i}
+            repository.identifiers[identifier] = basename
+            repository.resources[self.PREFIX + identifier] = {'timestamp': 1.0 * i}
+
+    def test_resources(self):
+        repository = CompactRepository()
+        self.fill(repository, 3)
+        resources = repository.resources
+        self.assertEqual(len(resources), 6)
+        self.assertEqual(resources["http://eprints.cs.univie.ac.at/1/1/paper-1.pdf"],
+                         {'timestamp': 1.0})
+        self.assertEqual(resources[self.PREFIX + "oai:eprints.cs.univie.ac.at:2"],
+                         {'timestamp': 2.0})
+        self.assertEqual(repository.identifiers["oai:eprints.cs.univie.ac.at:0"],
+                         "http://eprints.cs.univie.ac.at/0/1/paper-0.pdf")
+        self.assertFalse("http://eprints.cs.univie.ac.at/3/1/paper-3.pdf" in resources)
+        self.assertFalse("http://example.com/" in resources)
+        self.assertRaises(KeyError, resources.__getitem__,
+                          self.PREFIX + "oai:eprints.cs.univie.ac.at:3")
+        memory = Repository()
+        self.fill(memory, 3)
+        self.assertEqual(sorted(repository.basenames()),
+                         sorted(memory.basenames()))
+
+    def test_delete(self):
+        repository = CompactRepository()
+        self.fill(repository, 2)
+        resources = repository.resources
+        del resources[self.PREFIX + "oai:eprints.cs.univie.ac.at:0"]
+        del repository.identifiers["oai:eprints.cs.univie.ac.at:0"]
+        del resources["http://eprints.cs.univie.ac.at/0/1/paper-0.pdf"]
+        self.assertRaises(KeyError, resources.__delitem__,
+                          "http://eprints.cs.univie.ac.at/0/1/paper-0.pdf")
+        self.assertEqual(len(resources), 2)
+        resources["http://example.org/2"] = {'timestamp': 2.0}
+        self.assertEqual(len(resources.timestamps), 2)
+        self.assertEqual(resources["http://eprints.cs.univie.ac.at/1/1/paper-1.pdf"],
+                         {'timestamp': 1.0})
+        self.assertEqual(resources["http://example.org/2"], {'timestamp': 2.0})
+
+    def test_sorted_basenames(self):
+        repository = CompactRepository()
+        self.fill(repository, 12)
+        repository.resources["http://example.org/1"] = {'timestamp': 1.0}
+        repository.resources["a"] = {'timestamp': 1.0} # no prefix
+        del repository.resources["http://eprints.cs.univie.ac.at/5/1/paper-5.pdf"]
+        memory = sorted(repository.basenames())
+        self.assertEqual(list(repository.sorted_basenames()), memory)
+        self.assertEqual(list(repository.sorted_basenames(3, 20)), memory[3:20])
+        for start in range(len(memory) + 1):
+            self.assertEqual(list(repository.sorted_basenames(start, start + 2)),
+                             memory[start:start + 2])
+
+    def test_footprint(self):
+        plain = Plain()
+        compact = CompactRepository()
+        self.fill(plain, 50000)
+        self.fill(compact, 50000)
+        self.assertTrue(deep_size(plain, set()) >= 4 * deep_size(compact, set()))
+
+class TestSQLiteRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {'path': os.path.join(self.tmpdir, "repository.db"),
+                       'batch_size': 10}
+        self.repository = SQLiteRepository(self.config)
+
+    def tearDown(self):
+        self.repository.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_resources(self):
+        resources = self.repository.resources
+        resources["b"] = {'timestamp': 2.0}
+        resources["a"] = {'timestamp': 1.0}
+        resources["b"] = {'timestamp': 3.0}
+        self.assertEqual(len(resources), 2)
+        self.assertEqual(resources["b"], {'timestamp': 3.0})
+        self.assertTrue(resources.has_key("a"))
+        self.assertFalse("c" in resources)
+        self.assertRaises(KeyError, resources.__getitem__, "c")
+        del resources["a"]
+        self.assertRaises(KeyError, resources.__delitem__, "a")
+        self.assertEqual(len(resources), 1)
+        self.assertEqual(resources.keys(), ["b"])
+
+    def test_identifiers(self):
+        identifiers = self.repository.identifiers
+        identifiers["oai:example.org:1"] = "http://example.org/1"
+        self.assertEqual(identifiers.get("oai:example.org:1"),
+                         "http://example.org/1")
+        self.assertEqual(identifiers.get("oai:example.org:2"), None)
+
+    def test_basenames(self):
+        for i in range(2500):
+            self.repository.resources["%05d" % (2499 - i)] = {'timestamp': i}
+        basenames = list(self.repository.basenames())
+        self.assertEqual(len(basenames), 2500)
+        self.assertEqual(basenames, sorted(basenames))
+        self.assertEqual(list(self.repository.sorted_basenames(1000, 1003)),
+                         ["01000", "01001", "01002"])
+        self.assertEqual(list(self.repository.sorted_basenames(2498)),
+                         ["02498", "02499"])
+        self.assertEqual(len(list(self.repository.sorted_basenames(500, 2000))),
+                         1500)
+
+    def test_reopen(self):
+        for i in range(25):
+            self.repository.resources[str(i)] = {'timestamp': float(i)}
+        self.repository.identifiers["oai:example.org:1"] = "1"
+        self.repository.close()
+        self.repository = SQLiteRepository(self.config)
+        self.assertEqual(len(self.repository.resources), 25)
+        self.assertEqual(self.repository.resources["7"], {'timestamp': 7.0})
+        self.assertEqual(self.repository.identifiers["oai:example.org:1"], "1")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import sys
+import os
+import gzip
+import shutil
+import tempfile
 import unittest
 import StringIO
 from resync.resource import Resource
 from resync.resource_change import ResourceChange
 from resync.inventory import Inventory
-from resync.sitemap import Sitemap, SitemapIndexError
+from resync.sitemap import Sitemap, SitemapIndexError, Mapper
 
 # etree gives ParseError in 2.7, ExpatError in 2.6
 etree_error_class = None
@@ -160,6 +164,43 @@ class TestSitemap(unittest.TestCase):
         self.assertEqual( r2.uri, '/tmp/rs_test/src/file_b' )
         self.assertEqual( r2.changetype, None )
 
+    def test_40_xml_chunks(self):
+        m = Inventory()
+        for i in range(5):
+            m.add( Resource(uri='http://example.org/%d' % i, timestamp=i, size=i) )
+        caps = { 'http://example.org/changeset.xml': { 'rel': 'next' } }
+        s = Sitemap()
+        chunks = list(s.resources_as_xml_chunks(m, capabilities=caps, chunk_size=2))
+        # header, 3 chunks of url elements, footer
+        self.assertEqual( len(chunks), 5 )
+        self.assertEqual( chunks[2].count('<url>'), 2 )
+        self.assertEqual( chunks[-1], '</urlset>' )
+        self.assertEqual( ''.join(chunks), s.resources_as_xml(m, capabilities=caps) )
+
+    def test_41_write_read_gzip(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            m = Inventory()
+            for i in range(5):
+                m.add( Resource(uri='http://example.org/dir/%d' % i, timestamp=i) )
+            s = Sitemap()
+            s.gzip = True
+            s.max_sitemap_entries = 2
+            s.mapper = Mapper(['http://example.org/dir', tmpdir])
+            basename = os.path.join(tmpdir, 'sitemap.xml')
+            s.write(m, basename)
+            self.assertEqual( sorted(os.listdir(tmpdir)), ['sitemap.xml', 'sitemap.xml.gz', 'sitemap00000.xml.gz', 'sitemap00001.xml.gz', 'sitemap00002.xml.gz'] )
+            self.assertTrue( 'http://example.org/dir/sitemap00000.xml.gz' in open(basename).read() )
+            self.assertEqual( gzip.open(basename + '.gz').read(), open(basename).read() )
+            for name in (basename, basename + '.gz'):
+                s = Sitemap()
+                s.mapper = Mapper(['http://example.org/dir', tmpdir])
+                i = s.read(name)
+                self.assertEqual( s.read_type, 'sitemapindex' )
+                self.assertEqual( sorted(i.resources.keys()), sorted(m.resources.keys()) )
+        finally:
+            shutil.rmtree(tmpdir)
+
 if  __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestSitemap)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,143 @@
+import unittest
+import random
+import os
+import shutil
+import tempfile
+
+from resync.repository import Repository, CompactRepository, SQLiteRepository
+from resync.snapshot import Snapshots
+
+class TestSnapshot(unittest.TestCase):
+
+    def create_repository(self):
+        return Repository()
+
+    def setUp(self):
+        self.repository = self.create_repository()
+        self.snapshots = Snapshots(self.repository)
+        for i in range(10):
+            self.set("%02d" % i, float(i))
+        self.snapshots.commit()
+
+    def set(self, basename, timestamp):
+        self.snapshots.before_change(basename)
+        self.repository.resources[basename] = {'timestamp': timestamp}
+
+    def delete(self, basename):
+        self.snapshots.before_change(basename)
+        del self.repository.resources[basename]
+
+    def test_changes_after_snapshot(self):
+        snapshot = self.snapshots.snapshot()
+        self.set("01", 100.0)
+        self.set("10", 10.0)
+        self.delete("02")
+        self.assertEqual(snapshot.get("01"), {'timestamp': 1.0})
+        self.assertEqual(snapshot.get("02"), {'timestamp': 2.0})
+        self.assertEqual(snapshot.get("10"), None)
+        self.assertEqual(list(snapshot.basenames()),
+                         ["%02d" % i for i in range(10)])
+        snapshot.release()
+        self.snapshots.commit()
+        snapshot = self.snapshots.snapshot()
+        self.assertEqual(snapshot.get("01"), {'timestamp': 100.0})
+        basenames = list(snapshot.basenames())
+        self.assertEqual(len(basenames), 10)
+        self.assertFalse("02" in basenames)
+        self.assertRaises(RuntimeError, list, snapshot.basenames())
+        snapshot.release()
+        self.assertEqual(self.snapshots.snapshots, [])
+
+    def test_uncommitted(self):
+        self.set("05", 50.0)
+        self.delete("06")
+        self.set("11", 11.0)
+        snapshot = self.snapshots.snapshot()
+        self.assertEqual(snapshot.get("05"), {'timestamp': 5.0})
+        self.assertEqual(list(snapshot.basenames()),
+                         ["%02d" % i for i in range(10)])
+        self.snapshots.commit()
+        self.assertEqual(snapshot.get("05"), {'timestamp': 5.0})
+        snapshot.release()
+        snapshot = self.snapshots.snapshot()
+        self.assertEqual(list(snapshot.basenames()),
+                         ["%02d" % i for i in range(10) if i != 6] + ["11"])
+        snapshot.release()
+
+    def test_changes_while_iterating(self):
+        snapshot = self.snapshots.snapshot()
+        basenames = []
+        for basename in snapshot.basenames():
+            basenames.append(basename)
+            if basename == "03":
+                self.delete("02") # passed
+                self.delete("07") # not passed
+                self.set("055", 5.5)
+                self.snapshots.commit()
+            if basename == "05":
+                self.set("07", 70.0) # deleted and created again
+                self.delete("08")
+        self.assertEqual(basenames, ["%02d" % i for i in range(10)])
+        self.assertEqual(snapshot.get("07"), {'timestamp': 7.0})
+        snapshot.release()
+
+    def test_sorted_basenames(self):
+        snapshot = self.snapshots.snapshot()
+        self.delete("01")
+        self.set("015", 1.5)
+        self.delete("07")
+        self.assertEqual(list(snapshot.sorted_basenames(1, 3)), ["01", "02"])
+        snapshot.release()
+        snapshot = self.snapshots.snapshot()
+        self.assertEqual(list(snapshot.sorted_basenames(6, 8)), ["06", "07"])
+        snapshot.release()
+
+    def test_sorted_slices(self):
+        for i in range(10, 30):
+            self.set("%02d" % i, float(i))
+        self.snapshots.commit()
+        changes = random.Random(1)
+        for start in range(0, 34, 3):
+            expected = sorted(self.repository.basenames())
+            snapshot = self.snapshots.snapshot()
+            # resources created and deleted before, in and after the slice
+            for i in changes.sample(range(40), 8):
+                if "%02d" % i in self.repository.resources:
+                    self.delete("%02d" % i)
+                else:
+                    self.set("%02d" % i, float(i))
+            self.set("%02d5" % changes.randrange(40), 0.0)
+            self.assertEqual(list(snapshot.sorted_basenames(start, start + 4)),
+                             expected[start:start + 4])
+            snapshot.release()
+            self.snapshots.commit()
+
+    def test_ranges(self):
+        snapshot = self.snapshots.snapshot()
+        self.assertEqual(list(snapshot.basenames("015", "03")), ["02"])
+        self.delete("04") # before a range
+        self.set("065", 6.5)
+        self.delete("08") # in a range
+        self.assertEqual(list(snapshot.basenames("05", "07")), ["05", "06"])
+        self.assertRaises(RuntimeError, list, snapshot.basenames("06", "09"))
+        self.assertEqual(list(snapshot.basenames("08")), ["08", "09"])
+        self.assertRaises(RuntimeError, list, snapshot.basenames("10"))
+        snapshot.release()
+
+class TestCompactSnapshot(TestSnapshot):
+
+    def create_repository(self):
+        return CompactRepository()
+
+class TestSQLiteSnapshot(TestSnapshot):
+
+    def create_repository(self):
+        self.tmpdir = tempfile.mkdtemp()
+        return SQLiteRepository({'path': os.path.join(self.tmpdir, "repository.db")})
+
+    def tearDown(self):
+        self.repository.close()
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import random
+
+from resync.sorted_index import SortedIndex, SortedKeyDict
+
+class TestSortedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.block_size = SortedIndex.BLOCK_SIZE
+        SortedIndex.BLOCK_SIZE = 4
+
+    def tearDown(self):
+        SortedIndex.BLOCK_SIZE = self.block_size
+
+    def test_add_discard(self):
+        index = SortedIndex(["c", "a"])
+        keys = set(["a", "c"])
+        for i in random.sample(range(1000), 200):
+            index.add("%03d" % i)
+            keys.add("%03d" % i)
+        index.add("a")
+        for i in range(0, 1000, 3):
+            index.discard("%03d" % i)
+            keys.discard("%03d" % i)
+        index.discard("x")
+        self.assertEqual(list(index), sorted(keys))
+        self.assertEqual(len(index), len(keys))
+        self.assertTrue("a" in index)
+        self.assertFalse("000" in index)
+        self.assertTrue(max(len(b) for b in index.blocks) <= 8)
+
+    def test_empty(self):
+        index = SortedIndex()
+        self.assertEqual(list(index), [])
+        self.assertEqual(list(index.islice(1)), [])
+        self.assertFalse("a" in index)
+        index.add("a")
+        index.discard("a")
+        self.assertEqual(list(index), [])
+
+    def test_iter_from_islice(self):
+        index = SortedIndex("%02d" % i for i in range(30))
+        self.assertEqual(list(index.iter_from("275")), ["28", "29"])
+        self.assertEqual(list(index.iter_from("10"))[:2], ["10", "11"])
+        self.assertEqual(list(index.islice(9, 12)), ["09", "10", "11"])
+        self.assertEqual(list(index.islice(28)), ["28", "29"])
+        self.assertEqual(list(index.islice(30)), [])
+        self.assertEqual(index.key_at(13), "13")
+        self.assertEqual(index.key_at(30), None)
+        self.assertEqual(index.rank("13"), 13)
+        self.assertEqual(index.rank("135"), 14)
+        self.assertEqual(index.rank("4"), 30)
+
+    def test_changes_while_iterating(self):
+        index = SortedIndex("%02d" % i for i in range(30))
+        keys = []
+        for key in index:
+            keys.append(key)
+            if key == "05":
+                for i in range(30):
+                    if i not in (5, 20):
+                        index.discard("%02d" % i)
+                index.add("055")
+                index.add("03")
+        # keys which did not change are seen, changed ones may be
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertEqual(keys[:6], ["%02d" % i for i in range(6)])
+        self.assertEqual(keys[-1], "20")
+
+class TestSortedKeyDict(unittest.TestCase):
+
+    def test_dict(self):
+        d = SortedKeyDict({"b": 2, "c": 3})
+        d["a"] = 1
+        d["b"] = 4
+        d.update(d=5)
+        d.setdefault("e", 6)
+        del d["c"]
+        self.assertEqual(d.pop("d"), 5)
+        self.assertEqual(list(d), ["a", "b", "e"])
+        self.assertEqual(d, {"a": 1, "b": 4, "e": 6})
+        d.clear()
+        self.assertEqual(list(d), [])
+
+if __name__ == '__main__':
+    unittest.main()
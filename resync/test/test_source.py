@@ -1,7 +1,18 @@
 import unittest
 import random
+import datetime
+import os
+import tempfile
+import threading
+import shutil
+from dateutil import parser as dateutil_parser
 from resync.source import Source
 from resync.resource import Resource
+from resync.resource_change import ResourceChange
+from resync.repository import CompactRepository, SQLiteRepository
+from resync.observer import Observer
+from oaipmh.oai import Client, Header, Record, NoRecordsException
+from oaipmh.common import Common
 
 class TestSource(unittest.TestCase):
 
@@ -81,5 +92,325 @@ class TestSource(unittest.TestCase):
         self.source._update_resource(basename=rand_basename)
         self.assertEqual(self.source.resource_count, len_before)
 
+class TestOAISource(unittest.TestCase):
+
+    def setUp(self):
+        config = {}
+        config['fromdate'] = datetime.datetime(2012, 9, 1)
+        self.source = Source(config, "localhost", "8888")
+        self.source.client = Client("http://example.org/oai", False, False)
+
+    def record(self, identifier, datestamp, deleted=False,
+               response_date="2012-09-25T10:00:00Z"):
+        header = Header(identifier, dateutil_parser.parse(datestamp), deleted)
+        resource = None
+        if not deleted:
+            resource = "http://example.org/" + identifier
+        return Record(header, resource, dateutil_parser.parse(response_date))
+
+    def pages(self, partitions):
+        """The records of partitions of a single page each, as harvested"""
+        for (i, records) in enumerate(partitions):
+            for record in records:
+                yield record
+            yield (i, None)
+
+    def ids(self, records):
+        return [record.id() if isinstance(record, Record) else record
+                for record in records]
+
+    def test_apply_partitions(self):
+        partitions = [
+            [self.record("1", "2012-09-02T00:00:00Z"),
+             self.record("2", "2012-09-02T00:00:00Z")],
+            [],
+            [self.record("3", "2012-09-03T00:00:00Z",
+                         response_date="2012-09-25T09:00:00Z"),
+             self.record("1", "2012-09-04T00:00:00Z"),
+             self.record("2", "2012-09-04T00:00:00Z", deleted=True)]]
+        no_records = self.source._apply_partitions(self.pages(partitions))
+        self.assertEqual(no_records, 5)
+        self.assertEqual(sorted(self.source.oaimapping.keys()), ["1", "3"])
+        self.assertEqual(self.source.resource_count, 4)
+        self.assertEqual(self.source.resource("http://example.org/1").timestamp,
+            Common.tofloat(dateutil_parser.parse("2012-09-04T00:00:00Z")))
+        self.assertEqual(self.source.lastcheckdate,
+                         dateutil_parser.parse("2012-09-25T09:00:00Z"))
+
+    def test_compact_repository(self):
+        self.source.add_repository(CompactRepository())
+        self.source.repository.metadata_uri_prefix = self.source.metadata_uri("")
+        self.source._apply_partitions(self.pages([
+            [self.record("1", "2012-09-02T00:00:00Z"),
+             self.record("2", "2012-09-02T00:00:00Z")],
+            [self.record("2", "2012-09-04T00:00:00Z"),
+             self.record("1", "2012-09-04T00:00:00Z", deleted=True)]]))
+        self.assertEqual(self.source.resource_count, 2)
+        timestamp = Common.tofloat(dateutil_parser.parse("2012-09-04T00:00:00Z"))
+        self.assertEqual(sorted((r.uri, r.timestamp) for r in self.source.resources),
+            [("http://example.org/2", timestamp),
+             (self.source.metadata_uri("2"), timestamp)])
+        self.assertEqual(self.source.resource(self.source.metadata_uri("1")), None)
+
+    def test_batch_notification(self):
+        batches = []
+        class BatchObserver(Observer):
+            def notify(self, change):
+                batches.append([change.changetype])
+            def notify_batch(self, changes):
+                batches.append([change.changetype for change in changes])
+        self.source.register_observer(BatchObserver())
+        self.source._apply_partitions(self.pages([
+            [self.record("1", "2012-09-02T00:00:00Z"),
+             self.record("2", "2012-09-02T00:00:00Z")],
+            [self.record("3", "2012-09-03T00:00:00Z"),
+             # the same record in a second set
+             self.record("1", "2012-09-02T00:00:00Z")]]))
+        self.assertEqual(batches, [["CREATED"] * 4, ["CREATED"] * 2])
+        self.source.process_record(self.record("3", "2012-09-04T00:00:00Z"))
+        self.assertEqual(batches[2:], [["UPDATED"], ["UPDATED"]])
+
+    def test_snapshot_resources(self):
+        self.source._apply_partitions(self.pages([[self.record(str(i),
+                                "2012-09-02T00:00:00Z") for i in range(3)]]))
+        resources = self.source.resources
+        first = resources.next()
+        self.source.begin_batch()
+        self.source.process_record(self.record("3", "2012-09-03T00:00:00Z"))
+        # a page in progress is not seen by a new iteration either
+        self.assertEqual(len(list(self.source.resources)), 6)
+        self.source.end_batch()
+        self.assertEqual(len([first] + list(resources)), 6)
+        self.assertEqual(len(list(self.source.resources)), 8)
+
+    def test_version(self):
+        versions = []
+        source = self.source
+        class VersionObserver(Observer):
+            def notify_batch(self, changes):
+                versions.append(source.version)
+        source.register_observer(VersionObserver())
+        version = source.version
+        source._apply_partitions(self.pages([[self.record("1",
+                                                "2012-09-02T00:00:00Z")]]))
+        # the version increases again once the batch has been notified
+        self.assertTrue(versions[0] > version)
+        self.assertTrue(source.version > versions[0])
+        version = source.version
+        source.process_record(self.record("1", "2012-09-03T00:00:00Z"))
+        self.assertTrue(source.version > version)
+        # e.g. a static inventory builder announcing a written sitemap
+        version = source.version
+        source.notify_observers(ResourceChange(uri=source.base_uri +
+                                "/sitemap.xml", changetype="UPDATED"))
+        self.assertTrue(source.version > version)
+
+    def test_bootstrap_sets(self):
+        sets = {'a': ["1", "2"], 'b': ["2", "3"], None: ["1", "2", "3", "4"]}
+        def list_records(afrom, delay=0, setspec=None, rtoken=None,
+                         checkpoint=None):
+            for identifier in sets[setspec]:
+                yield self.record(identifier, "2012-09-02T00:00:00Z")
+        self.source.config['delay_time'] = 0
+        self.source.config['bootstrap_workers'] = 2
+        self.source.client.topLevelSets = lambda: ["a", "b"]
+        self.source.client.listRecords = list_records
+        self.assertEqual(self.source.bootstrap_sets(None), 3)
+        self.assertEqual(sorted(self.source.oaimapping.keys()),
+                         ["1", "2", "3"])
+        # the record in no set is added by the final pass, the others once
+        self.source.config['bootstrap_unset_records'] = True
+        self.assertEqual(self.source.bootstrap_sets(None), 1)
+        self.assertEqual(sorted(self.source.oaimapping.keys()),
+                         ["1", "2", "3", "4"])
+
+    def test_warm_restart(self):
+        directory = tempfile.mkdtemp()
+        config = {'path': os.path.join(directory, "source.db")}
+        try:
+            self.source.add_repository(SQLiteRepository(config))
+            self.source.process_record(self.record("1", "2012-09-02T00:00:00Z"))
+            self.source.repository.close()
+            # harvested again from fromdate without a checkpoint
+            source = Source(self.source.config, "localhost", "8888")
+            source.client = self.source.client
+            source.add_repository(SQLiteRepository(config))
+            changes = []
+            class ChangeObserver(Observer):
+                def notify(self, change):
+                    changes.append(change.changetype)
+            source.register_observer(ChangeObserver())
+            self.assertFalse(source.process_record(
+                                self.record("1", "2012-09-02T00:00:00Z")))
+            self.assertTrue(source.process_record(
+                                self.record("1", "2012-09-03T00:00:00Z")))
+            self.assertEqual(changes, ["UPDATED", "UPDATED"])
+            source.repository.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_harvest_partitions(self):
+        records = dict((str(i), [self.record(str(i), "2012-09-02T00:00:00Z")])
+                       for i in range(10))
+        partitions = self.source._harvest_partitions(
+                        sorted(records.keys()), lambda p, c, t: iter(records[p]), 3)
+        self.assertEqual(self.ids(partitions), self.ids(self.pages(
+                        [records[p] for p in sorted(records.keys())])))
+
+    def test_reorder_buffer(self):
+        self.source.config['reorder_buffer'] = 3
+        produced = []
+        stalled = []
+        released = threading.Event()
+        def release():
+            stalled.append(len(produced))
+            released.set()
+        def harvest(partition, checkpoint, rtoken):
+            if partition == "a":
+                released.wait(5)
+                yield self.record("a", "2012-09-02T00:00:00Z")
+                return
+            for i in range(10):
+                produced.append(i)
+                yield self.record("b%d" % i, "2012-09-02T00:00:00Z")
+            checkpoint({})
+        timer = threading.Timer(0.3, release)
+        timer.start()
+        records = list(self.source._harvest_partitions(["a", "b"], harvest, 2))
+        # the worker of b stalls with a full buffer until a is harvested
+        self.assertTrue(stalled[0] <= 4)
+        self.assertEqual(self.ids(records), ["a", (0, None)] +
+                         ["b%d" % i for i in range(10)] + [(1, {}), (1, None)])
+
+    def test_harvest_partitions_retry(self):
+        failures = []
+        def harvest(partition, checkpoint, rtoken):
+            yield self.record(partition, "2012-09-02T00:00:00Z")
+            if len(failures) < 2:
+                failures.append(partition)
+                raise IOError("connection reset")
+        self.assertRaises(IOError, list,
+                          self.source._harvest_partitions(["a"], harvest, 1))
+        del failures[:]
+        self.source.config['partition_retries'] = 2
+        records = list(self.source._harvest_partitions(["a"], harvest, 1))
+        # records of a failed attempt may have been passed on already
+        self.assertEqual(self.ids(records)[-2:], ["a", (0, None)])
+        self.assertEqual(set(self.ids(records)), set(["a", (0, None)]))
+
+    def test_resume_harvest(self):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        self.source.config['checkpoint_file'] = path
+        self.source.config['delay_time'] = 0
+        self.source = Source(self.source.config, "localhost", "8888")
+        requests = []
+        def list_records(afrom, delay=0, rtoken=None, checkpoint=None):
+            requests.append((afrom, rtoken))
+            if rtoken == "expired":
+                raise NoRecordsException("badResumptionToken", "expired")
+            yield self.record("1", "2012-09-03T00:00:00Z")
+            checkpoint({'resumptionToken': "token-2",
+                        'responseDate': dateutil_parser.parse("2012-09-25T10:00:00Z")})
+            yield self.record("2", "2012-09-04T00:00:00Z")
+            checkpoint({'responseDate': dateutil_parser.parse("2012-09-25T10:01:00Z")})
+        self.source.client = Client("http://example.org/oai", False, False)
+        self.source.client.listRecords = list_records
+        try:
+            fromdate = dateutil_parser.parse("2012-09-01T00:00:00Z")
+            self.source.checkpoint.save(dateutil_parser.parse("2012-09-25T09:00:00Z"),
+                                        "token-1", 10, fromdate)
+            state = self.source.checkpoint.load()
+            self.assertEqual(self.source.resume_harvest(None, state), 12)
+            self.assertEqual(requests[-1][1], "token-1")
+            state = self.source.checkpoint.load()
+            self.assertEqual(state['resumptionToken'], None)
+            self.assertEqual(state['no_records'], 12)
+            self.assertEqual(state['fromdate'], fromdate)
+            self.assertEqual(self.source.lastcheckdate,
+                             dateutil_parser.parse("2012-09-25T10:00:00Z"))
+            state['resumptionToken'] = "expired"
+            self.source.resume_harvest(None, state)
+            # records are not listed in datestamp order, so the whole
+            # harvest is repeated
+            self.assertEqual(requests[-1], (fromdate, None))
+            state['resumptionToken'] = None
+            self.assertEqual(self.source.resume_harvest(None, state), 0)
+            self.assertEqual(self.source.lastcheckdate, state['lastcheckdate'])
+        finally:
+            os.remove(path)
+
+    def test_resume_partitions(self):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        self.source.config['checkpoint_file'] = path
+        self.source.config['delay_time'] = 0
+        self.source.config['bootstrap_workers'] = 2
+        self.source = Source(self.source.config, "localhost", "8888")
+        windows = [(datetime.datetime(2012, 9, 1), datetime.datetime(2012, 9, 2)),
+                   (datetime.datetime(2012, 9, 3), None)]
+        requests = []
+        crash = [True]
+        def list_records(afrom, delay=0, until=None, rtoken=None,
+                         checkpoint=None):
+            requests.append((afrom, rtoken))
+            response_date = dateutil_parser.parse("2012-09-25T10:00:00Z")
+            if afrom == windows[0][0]:
+                yield self.record("1", "2012-09-01T00:00:00Z")
+                checkpoint({'responseDate': response_date})
+                return
+            if rtoken is None:
+                yield self.record("2", "2012-09-03T00:00:00Z")
+                checkpoint({'resumptionToken': "token-2",
+                            'responseDate': response_date})
+            if crash[0]:
+                raise RuntimeError("adapter stopped")
+            yield self.record("3", "2012-09-04T00:00:00Z")
+            checkpoint({'responseDate': response_date})
+        self.source.client = Client("http://example.org/oai", False, False)
+        self.source.client.listRecords = list_records
+        try:
+            self.assertRaises(RuntimeError, self.source.bootstrap_partitions,
+                              'windows', windows, None)
+            state = self.source.checkpoint.load()
+            self.assertEqual(state['partitions']['applied'], 1)
+            self.assertEqual(state['resumptionToken'], "token-2")
+            self.assertEqual(state['no_records'], 2)
+            crash[0] = False
+            del requests[:]
+            # the applied window is skipped, the second continues at its token
+            self.assertEqual(self.source.resume_harvest(None, state), 3)
+            self.assertEqual(requests, [(windows[1][0], "token-2")])
+            self.assertEqual(sorted(self.source.oaimapping.keys()),
+                             ["1", "2", "3"])
+            state = self.source.checkpoint.load()
+            self.assertEqual(state['partitions']['applied'], 2)
+            self.assertEqual(state['resumptionToken'], None)
+        finally:
+            os.remove(path)
+
+    def test_checkpoint_persistent_repository(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "checkpoint.json")
+        self.source.config['checkpoint_file'] = path
+        try:
+            source = Source(self.source.config, "localhost", "8888")
+            source.add_repository(CompactRepository())
+            checkdate = dateutil_parser.parse("2012-09-25T09:00:00Z")
+            source.checkpoint.save(checkdate, "token-1", 10)
+            # the harvested resources are gone, so is the progress
+            self.assertEqual(source._load_checkpoint(), None)
+            self.assertEqual(source.checkpoint, None)
+            self.assertFalse(os.path.exists(path))
+            source = Source(self.source.config, "localhost", "8888")
+            source.add_repository(SQLiteRepository(
+                            {'path': os.path.join(directory, "source.db")}))
+            source.checkpoint.save(checkdate, "token-1", 10)
+            self.assertEqual(source._load_checkpoint()['resumptionToken'],
+                             "token-1")
+            source.repository.close()
+        finally:
+            shutil.rmtree(directory)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
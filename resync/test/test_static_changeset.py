@@ -0,0 +1,66 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+from resync.source import Source
+from resync.resource_change import ResourceChange
+from resync.changememory import StaticChangeSet
+
+class TestStaticChangeSet(unittest.TestCase):
+
+    def setUp(self):
+        self.static_file_path = Source.STATIC_FILE_PATH
+        Source.STATIC_FILE_PATH = tempfile.mkdtemp()
+        source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                        "localhost", "8888")
+        self.changememory = StaticChangeSet(source, {'uri_path': "changesets",
+                        'uri_file': "most_recent.xml", 'max_changes': 3,
+                        'max_sitemap_entries': 100, 'write_queue_size': 1})
+
+    def tearDown(self):
+        self.changememory.close()
+        shutil.rmtree(Source.STATIC_FILE_PATH)
+        Source.STATIC_FILE_PATH = self.static_file_path
+
+    def changes(self, first, last):
+        return [ResourceChange(uri="http://example.org/%d" % i, timestamp=i,
+                               changetype="UPDATED")
+                for i in range(first, last)]
+
+    def test_background_write(self):
+        self.changememory.notify_batch(self.changes(0, 7))
+        self.assertEqual(len(self.changememory.changes), 1)
+        self.changememory.flush()
+        self.assertEqual(sorted(self.changememory.ls_changeset_files(
+            Source.STATIC_FILE_PATH)), ["changeset00001.xml", "changeset00002.xml"])
+        self.assertEqual(self.changememory.previous_changeset_id, 2)
+        self.changememory.close()
+        self.assertEqual(self.changememory.previous_changeset_id, 3)
+
+    def test_backpressure(self):
+        started = threading.Event()
+        proceed = threading.Event()
+        write_changeset = self.changememory.write_changeset
+        def slow_write_changeset(changes):
+            started.set()
+            proceed.wait()
+            write_changeset(changes)
+        self.changememory.write_changeset = slow_write_changeset
+        self.changememory.notify_batch(self.changes(0, 3))
+        started.wait()
+        self.changememory.notify_batch(self.changes(3, 6)) # queued
+        notifier = threading.Thread(target=self.changememory.notify_batch,
+                                    args=(self.changes(6, 9),))
+        notifier.start()
+        notifier.join(0.2)
+        self.assertTrue(notifier.is_alive())
+        proceed.set()
+        notifier.join()
+        self.changememory.flush()
+        self.assertEqual(self.changememory.previous_changeset_id, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+
+from resync.source import Source, StaticInventoryBuilder
+from resync.sitemap import Sitemap
+from oaipmh.oai import Client
+
+class TestStaticInventoryBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.static_file_path = Source.STATIC_FILE_PATH
+        Source.STATIC_FILE_PATH = tempfile.mkdtemp()
+        self.source = Source({'fromdate': datetime.datetime(2012, 9, 1)},
+                             "localhost", "8888")
+        self.source.client = Client("http://example.org/oai", False, False)
+        self.builder = StaticInventoryBuilder(self.source,
+                        {'uri_path': "sitemap.xml", 'interval': 15,
+                         'max_sitemap_entries': 10, 'generation_grace': 3600})
+        self.source.add_inventory_builder(self.builder)
+        self.written = []
+        write_sitemap_file = self.builder.write_sitemap_file
+        def record(s, path, xml, precompress=None):
+            self.written.append(os.path.basename(path))
+            write_sitemap_file(s, path, xml, precompress)
+        self.builder.write_sitemap_file = record
+
+    def tearDown(self):
+        shutil.rmtree(Source.STATIC_FILE_PATH)
+        Source.STATIC_FILE_PATH = self.static_file_path
+
+    def create(self, i):
+        self.source._create_resource(basename=self.source.metadata_uri(
+                            "%03d" % i), timestamp=float(i), oai=False)
+
+    def delete(self, i):
+        self.source._delete_resource("%03d" % i, float(i), oai=False)
+
+    def write(self):
+        self.written = []
+        self.builder.write_static_inventory()
+        return sorted(self.written)
+
+    def files(self):
+        return sorted(self.builder.ls_sitemap_files(self.builder.current_path))
+
+    def read(self, name):
+        return [r.uri for r in Sitemap().read(
+                        os.path.join(self.builder.current_path, name))]
+
+    def assertInventory(self, numbers):
+        uris = []
+        for name in self.files():
+            if name != "sitemap.xml":
+                sitemap = self.read(name)
+                self.assertTrue(0 < len(sitemap) <= 10)
+                uris.extend(sitemap)
+        self.assertEqual(sorted(uris), [self.source.metadata_uri("%03d" % i)
+                                        for i in sorted(numbers)])
+
+    def test_incremental(self):
+        for i in range(0, 50, 2):
+            self.create(i)
+        self.assertEqual(self.write(), ["sitemap.xml", "sitemap00000.xml",
+                                "sitemap00001.xml", "sitemap00002.xml"])
+        self.assertInventory(range(0, 50, 2))
+        self.assertEqual(self.write(), [])
+        # one resource changed
+        self.source._update_resource(self.source.metadata_uri("024"), None,
+                                     100.0, oai=False)
+        self.assertEqual(self.write(), ["sitemap.xml", "sitemap00001.xml"])
+        # the first chunk grows beyond max_sitemap_entries and is split
+        for i in range(1, 12, 2):
+            self.create(i)
+        self.assertEqual(self.write(), ["sitemap.xml", "sitemap00000.xml",
+                                        "sitemap00003.xml"])
+        self.assertInventory(range(0, 50, 2) + range(1, 12, 2))
+        # the last chunk becomes empty
+        for i in range(34, 50, 2):
+            self.delete(i)
+        self.assertEqual(self.write(), ["sitemap.xml", "sitemap00001.xml"])
+        self.assertFalse("sitemap00002.xml" in self.files())
+        self.assertInventory(range(0, 34, 2) + range(1, 12, 2))
+        # resources after the last chunk
+        self.create(60)
+        self.assertEqual(self.write(), ["sitemap.xml", "sitemap00001.xml"])
+        self.assertInventory(range(0, 34, 2) + range(1, 12, 2) + [60])
+
+    def test_single_sitemap(self):
+        for i in range(5):
+            self.create(i)
+        self.assertEqual(self.write(), ["sitemap.xml"])
+        self.assertEqual(self.files(), ["sitemap.xml"])
+        self.assertEqual(len(self.read("sitemap.xml")), 5)
+        for i in range(5, 15):
+            self.create(i)
+        self.write()
+        self.assertEqual(self.files(), ["sitemap.xml", "sitemap00000.xml",
+                                        "sitemap00001.xml"])
+        self.assertInventory(range(15))
+        for i in range(15):
+            self.delete(i)
+        self.write()
+        self.assertEqual(self.files(), ["sitemap.xml"])
+        self.assertEqual(self.read("sitemap.xml"), [])
+
+    def test_uncommitted_changes(self):
+        self.create(0)
+        self.write()
+        self.source.begin_batch()
+        self.create(1)
+        # not seen by the snapshot, written once committed
+        self.assertEqual(self.write(), [])
+        self.source.end_batch()
+        self.assertEqual(self.write(), ["sitemap.xml"])
+        self.assertEqual(len(self.read("sitemap.xml")), 2)
+
+    def test_generations(self):
+        for i in range(25):
+            self.create(i)
+        self.write()
+        first = os.path.realpath(self.builder.current_path)
+        self.create(30)
+        self.write()
+        current = os.path.realpath(self.builder.current_path)
+        self.assertNotEqual(current, first)
+        # unchanged sitemaps are shared, changed ones are written
+        self.assertEqual(os.stat(os.path.join(first, "sitemap00000.xml")),
+                         os.stat(os.path.join(current, "sitemap00000.xml")))
+        self.assertNotEqual(os.stat(os.path.join(first, "sitemap00002.xml")),
+                         os.stat(os.path.join(current, "sitemap00002.xml")))
+        self.assertEqual(self.write(), [])
+        self.assertEqual(os.path.realpath(self.builder.current_path), current)
+        # the replaced generation is removed after generation_grace
+        self.builder.collect_generations()
+        self.assertTrue(os.path.exists(first))
+        self.builder.generation_grace = 0
+        self.builder.collect_generations()
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(os.listdir(self.builder.generations_path),
+                         [os.path.basename(current)])
+
+if __name__ == '__main__':
+    unittest.main()
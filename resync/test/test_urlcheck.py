@@ -0,0 +1,76 @@
+import unittest
+import StringIO
+import threading
+from urllib2 import HTTPError
+
+import oaipmh.urlcheck
+from oaipmh.urlcheck import UrlChecker
+
+class FakeResponse(object):
+
+    def __init__(self, code):
+        self.code = code
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        pass
+
+class TestUrlChecker(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        def fake_urlopen(url, method='GET'):
+            with self.lock:
+                self.requests.append((url, method))
+            if url.endswith("missing"):
+                raise HTTPError(url, 404, "Not Found", {}, StringIO.StringIO())
+            if url.endswith("nohead") and method == 'HEAD':
+                raise HTTPError(url, 405, "Not Allowed", {}, StringIO.StringIO())
+            if url.endswith("down"):
+                raise IOError("connection refused")
+            return FakeResponse(200)
+        self.urlopen = oaipmh.urlcheck.urlopen
+        oaipmh.urlcheck.urlopen = fake_urlopen
+
+    def tearDown(self):
+        oaipmh.urlcheck.urlopen = self.urlopen
+
+    def test_check(self):
+        checker = UrlChecker(workers=4)
+        urls = ["http://example.org/%d" % i for i in range(10)]
+        urls += ["http://example.org/missing", "http://example.org/down",
+                 "http://example.org/nohead", "http://example.org/1"]
+        results = checker.check(urls)
+        self.assertEqual(len(results), 13)
+        self.assertTrue(results["http://example.org/1"])
+        self.assertFalse(results["http://example.org/missing"])
+        self.assertFalse(results["http://example.org/down"])
+        self.assertTrue(results["http://example.org/nohead"])
+        self.assertEqual(len([r for r in self.requests if r[1] == 'HEAD']), 13)
+        self.assertEqual(self.requests.count(("http://example.org/nohead",
+                                              'GET')), 1)
+
+    def test_cache(self):
+        checker = UrlChecker()
+        self.assertTrue(checker.alive("http://example.org/1"))
+        self.assertTrue(checker.alive("http://example.org/1"))
+        self.assertEqual(len(self.requests), 1)
+        checker.ttl = -1
+        self.assertTrue(checker.alive("http://example.org/1"))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_lru_eviction(self):
+        checker = UrlChecker(maxsize=2)
+        checker.check(["http://example.org/1", "http://example.org/2"])
+        checker.alive("http://example.org/1")
+        checker.alive("http://example.org/3")
+        self.assertEqual(len(checker), 2)
+        self.assertEqual(checker.cached("http://example.org/2"), None)
+        self.assertTrue(checker.cached("http://example.org/1"))
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestUrlChecker)
+    unittest.TextTestRunner(verbosity=2).run(suite)